@@ -2,6 +2,7 @@ import logging
 from flask_restful import Resource, Api, reqparse
 from camerastreamer.camera_streamer import CameraStreamer
 from camerastreamer.auto_focus import AutoFocus
+from camerastreamer.focus_metric import FocusMetric
 
 
 class CameraSettings(Resource):
@@ -19,6 +20,12 @@ class CameraSettings(Resource):
         choices=[(640, 480), (1280, 960), (1640, 1232)],
         location="json",
     )
+    parser.add_argument(
+        "still_mode", type=str, choices=["live", "restart"], location="json"
+    )
+    parser.add_argument(
+        "stream_mode", type=str, choices=["mjpeg", "still"], location="json"
+    )
     parser.add_argument(
         "rotation", type=int, choices=[0, 90, 180, 270], location="json"
     )
@@ -52,6 +59,13 @@ class CameraSettings(Resource):
         choices=["off", "auto", "sunlight", "shade"],
         location="json",
     )
+    parser.add_argument(
+        "focus_metric", type=str, choices=FocusMetric.METHODS, location="json"
+    )
+    parser.add_argument("focus_roi", type=float, location="json")
+    parser.add_argument(
+        "focus_downsample", type=int, choices=[1, 2, 4, 8], location="json"
+    )
     # parser.add_argument('awb_gains', type=float, choices=[(range(0.0,8.0),range(0.0,8.0))], location='json')
 
     def make_response(self):
@@ -59,6 +73,13 @@ class CameraSettings(Resource):
         values = {
             "photo_resolution": camerastreamer.photo_resolution,
             "stream_resolution": camerastreamer.stream_resolution,
+            "stream_mode": camerastreamer.stream_mode,
+            "still_mode": camerastreamer.still_mode,
+            "last_still_ms": camerastreamer.last_still_ms,
+            "simulcast": {
+                name: resolution
+                for name, (resolution, port) in camerastreamer.simulcast.items()
+            },
             "rotation": camerastreamer.camera.rotation,
             "iso": camerastreamer.camera.iso,
             "sharpness": camerastreamer.camera.sharpness,
@@ -70,6 +91,9 @@ class CameraSettings(Resource):
             "zoom": camerastreamer.camera.zoom,
             "awb_mode": camerastreamer.camera.awb_mode,
             "awb_gains": str(camerastreamer.camera.awb_gains),
+            "focus_metric": camerastreamer.focus_metric.method,
+            "focus_roi": camerastreamer.focus_metric.roi,
+            "focus_downsample": camerastreamer.focus_metric.downsample,
         }
         return values
 
@@ -80,9 +104,13 @@ class CameraSettings(Resource):
         args = self.parser.parse_args(strict=True)
         camerastreamer = CameraStreamer.get_instance()
         if args["photo_resolution"] is not None:
-            camerastreamer.photo_resolution = args["photo_resolution"]
+            camerastreamer.change_photo_resolution(args["photo_resolution"])
         if args["stream_resolution"] is not None:
             camerastreamer.change_stream_resolution(args["stream_resolution"])
+        if args["still_mode"] is not None:
+            camerastreamer.change_still_mode(args["still_mode"])
+        if args["stream_mode"] is not None:
+            camerastreamer.change_stream_mode(args["stream_mode"])
         if args["rotation"] is not None:
             camerastreamer.camera.rotation = args["rotation"]
         if args["iso"] is not None:
@@ -101,13 +129,37 @@ class CameraSettings(Resource):
             camerastreamer.camera.saturation = args["saturation"]
         if args["zoom"] is not None:
             camerastreamer.camera.zoom = args["zoom"]
+        try:
+            camerastreamer.focus_metric = camerastreamer.focus_metric.copy(
+                args["focus_metric"], args["focus_roi"], args["focus_downsample"]
+            )
+        except ValueError:
+            return {"message": "focus_roi must be in (0, 1]"}, 400
         return self.make_response(), 200
 
 
 class CameraAutoFocus(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument(
+        "metric", type=str, choices=FocusMetric.METHODS, location="args"
+    )
+    parser.add_argument("roi", type=float, location="args")
+    parser.add_argument("downsample", type=int, choices=[1, 2, 4, 8], location="args")
+    parser.add_argument(
+        "search", type=str, choices=["model", "hill", "sweep"], location="args"
+    )
+
     def get(self):
+        args = self.parser.parse_args()
+        try:
+            metric = CameraStreamer.get_instance().focus_metric.copy(
+                args["metric"], args["roi"], args["downsample"]
+            )
+        except ValueError:
+            return {"message": "roi must be in (0, 1]"}, 400
         try:
-            auto_focuser = AutoFocus()
+            auto_focuser = AutoFocus(metric)
+            auto_focuser.search = args["search"] or auto_focuser.search
             auto_focuser.auto_focus_lap()
             return "OK", 200
         except Exception as e:
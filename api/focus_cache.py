@@ -0,0 +1,29 @@
+from flask_restful import Resource, Api, reqparse
+from camerastreamer.focus_cache import FocusCache
+
+
+class FocusCacheResource(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument("enabled", type=bool, location="json")
+    parser.add_argument("tolerance", type=float, location="json")
+    parser.add_argument("max_age", type=float, location="json")
+    parser.add_argument("max_drift", type=float, location="json")
+
+    def get(self):
+        return FocusCache.get_instance().to_dict(), 200
+
+    def put(self):
+        args = self.parser.parse_args(strict=True)
+        focus_cache = FocusCache.get_instance()
+        for setting in ["tolerance", "max_age", "max_drift"]:
+            if args[setting] is not None and args[setting] <= 0:
+                return {"message": f"{setting} must be positive"}, 400
+        for setting in ["enabled", "tolerance", "max_age", "max_drift"]:
+            if args[setting] is not None:
+                setattr(focus_cache, setting, args[setting])
+        return focus_cache.to_dict(), 200
+
+    def delete(self):
+        focus_cache = FocusCache.get_instance()
+        focus_cache.clear()
+        return focus_cache.to_dict(), 200
@@ -27,11 +27,13 @@ class Leds(Resource):
     def put(self):
         arduino = Arduino.get_instance()
         args = self.parser.parse_args(strict=True)
+        # commands are queued together, the response waits for all of them
+        pending = []
         if args["bottom_light"] is not None:
             if args["bottom_light"]:
-                arduino.bottom_lights_on()
+                pending.append(arduino.bottom_lights_on(wait=False))
             else:
-                arduino.bottom_lights_off()
+                pending.append(arduino.bottom_lights_off(wait=False))
         if (
             args["rgbw_red"] is not None
             and args["rgbw_green"] is not None
@@ -39,18 +41,26 @@ class Leds(Resource):
             and args["rgbw_white"] is not None
         ):
             if args["rgbw_light"] is not None:
-                arduino.set_rgbw_light(
-                    args["rgbw_red"],
-                    args["rgbw_green"],
-                    args["rgbw_blue"],
-                    args["rgbw_white"],
-                    args["rgbw_light"],
+                pending.append(
+                    arduino.set_rgbw_light(
+                        args["rgbw_red"],
+                        args["rgbw_green"],
+                        args["rgbw_blue"],
+                        args["rgbw_white"],
+                        args["rgbw_light"],
+                        wait=False,
+                    )
                 )
             else:
-                arduino.set_rgbw_ring(
-                    args["rgbw_red"],
-                    args["rgbw_green"],
-                    args["rgbw_blue"],
-                    args["rgbw_white"],
+                pending.append(
+                    arduino.set_rgbw_ring(
+                        args["rgbw_red"],
+                        args["rgbw_green"],
+                        args["rgbw_blue"],
+                        args["rgbw_white"],
+                        wait=False,
+                    )
                 )
+        for future in pending:
+            future.result()
         return self.make_response(), 200
@@ -0,0 +1,10 @@
+from flask_restful import Resource
+from communications.device_manager import DeviceManager
+from startup_timing import StartupTiming
+
+
+class Status(Resource):
+    def get(self):
+        response = DeviceManager.get_instance().to_dict()
+        response["startup"] = StartupTiming.get_instance().to_dict()
+        return response, 200
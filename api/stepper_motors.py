@@ -22,6 +22,7 @@ class Steppers(Resource):
             "yPos": printer.yPos,
             "zPos": printer.zPos,
             "feedrate": printer.feedrate,
+            "temperatures": printer.sender.temperatures,
         }
         return response
 
@@ -31,33 +32,34 @@ class Steppers(Resource):
     def put(self):
         args = self.parser.parse_args(strict=True)
         printer = Printer.get_instance()
+        # commands are queued together, the response waits for all of them
+        pending = []
         if args["feedrate"] is not None:
             if args["feedrate"] <= 3000.0 and args["feedrate"] >= 100.0:
-                printer.set_feedrate(args["feedrate"])
+                pending.append(printer.set_feedrate(args["feedrate"], wait=False))
             else:
                 return 400
         if args["xPos"] is not None:
-            if args["xPos"] <= 100.0 and args["xPos"] > 5.0:
-                printer.set_xPos(args["xPos"])
-            else:
+            if not (args["xPos"] <= 100.0 and args["xPos"] > 5.0):
                 return 400
         if args["yPos"] is not None:
-            if args["yPos"] <= 100.0 and args["yPos"] > 5.0:
-                printer.set_yPos(args["yPos"])
-            else:
+            if not (args["yPos"] <= 100.0 and args["yPos"] > 5.0):
                 return 400
         if args["zPos"] is not None:
-            if args["zPos"] <= 100.0 and args["zPos"] > 0.2:
-                printer.set_zPos(args["zPos"])
-            else:
+            if not (args["zPos"] <= 100.0 and args["zPos"] > 0.2):
                 return 400
-
-        if args["xAxis"] is not None:
-            printer.move_xAxis(args["xAxis"])
-        if args["yAxis"] is not None:
-            printer.move_yAxis(args["yAxis"])
-        if args["zAxis"] is not None:
-            printer.move_zAxis(args["zAxis"])
+        # every axis of a request moves in one coordinated line
+        if any(args[axis] is not None for axis in ("xPos", "yPos", "zPos")):
+            pending.append(
+                printer.move_to(args["xPos"], args["yPos"], args["zPos"], wait=False)
+            )
+        if any(args[axis] is not None for axis in ("xAxis", "yAxis", "zAxis")):
+            pending.append(
+                printer.move_by(args["xAxis"], args["yAxis"], args["zAxis"], wait=False)
+            )
+        for future in pending:
+            if future is not None:  # unsafe z moves aren't sent
+                future.result()
         return self.make_response(), 200
 
 
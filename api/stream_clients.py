@@ -0,0 +1,50 @@
+from flask_restful import Resource, Api, reqparse
+from camerastreamer.camera_streamer import CameraStreamer
+from camerastreamer.stream_client import StreamClients
+from camerastreamer.adaptive_quality import AdaptiveQuality
+
+
+class StreamClientsResource(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument(
+        "default_max_fps", type=float, choices=range(1, 31), location="json"
+    )
+    parser.add_argument("adaptive", type=bool, location="json")
+    parser.add_argument(
+        "min_quality", type=int, choices=range(10, 101), location="json"
+    )
+    parser.add_argument(
+        "max_quality", type=int, choices=range(10, 101), location="json"
+    )
+    parser.add_argument("min_fps", type=float, choices=range(1, 31), location="json")
+
+    def make_response(self):
+        stream_clients = StreamClients.get_instance()
+        response = {
+            "default_max_fps": stream_clients.default_max_fps,
+            "clients": stream_clients.to_list(),
+            "stream_quality": CameraStreamer.get_instance().stream_quality,
+            "adaptive": AdaptiveQuality.get_instance().to_dict(),
+        }
+        return response
+
+    def get(self):
+        return self.make_response(), 200
+
+    def put(self):
+        args = self.parser.parse_args(strict=True)
+        stream_clients = StreamClients.get_instance()
+        if args["default_max_fps"] is not None:
+            stream_clients.default_max_fps = args["default_max_fps"]
+        adaptive = AdaptiveQuality.get_instance()
+        if args["adaptive"] is not None:
+            adaptive.enabled = args["adaptive"]
+        min_quality = args["min_quality"] or adaptive.min_quality
+        max_quality = args["max_quality"] or adaptive.max_quality
+        if min_quality > max_quality:
+            return {"message": "min_quality is above max_quality"}, 400
+        adaptive.min_quality = min_quality
+        adaptive.max_quality = max_quality
+        if args["min_fps"] is not None:
+            adaptive.min_fps = args["min_fps"]
+        return self.make_response(), 200
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import time
+from urllib.parse import parse_qs
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from camerastreamer.camera_streamer import CameraStreamer
+from camerastreamer.stream_client import StreamClients
+from camerastreamer.adaptive_quality import AdaptiveQuality
+
+# asyncio serving mode: MJPEG viewers are coroutines fed by one frame producer
+# per stream, everything else is handed to the Flask app on a thread pool
+
+
+class FrameProducer:
+    # Only reader of a camera stream broadcast, it waits for new frames on a
+    # single executor thread and wakes every client coroutine of that stream
+    def __init__(self, camera, stream):
+        self.camera = camera
+        self.stream = stream
+        self.sequence = 0
+        self.frame = None
+        self.clients = 0
+        self.condition = asyncio.Condition()
+        self.task = None
+
+    def add_client(self):
+        self.clients += 1
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    def remove_client(self):
+        self.clients -= 1
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        logging.info(f"[ASGI] Frame producer for {self.stream} started")
+        while self.clients > 0:
+            sequence, frame = await loop.run_in_executor(
+                None, self.camera.wait_frame, self.sequence, 1, self.stream
+            )
+            if sequence == self.sequence:
+                continue
+            async with self.condition:
+                self.sequence = sequence
+                self.frame = frame
+                self.condition.notify_all()
+        self.task = None
+        logging.info(f"[ASGI] Frame producer for {self.stream} stopped")
+
+    async def wait_frame(self, last_sequence, timeout=1):
+        # returns (sequence, frame), sequence == last_sequence on timeout
+        async with self.condition:
+            try:
+                await asyncio.wait_for(
+                    self.condition.wait_for(lambda: self.sequence != last_sequence),
+                    timeout,
+                )
+            except asyncio.TimeoutError:
+                pass
+            return self.sequence, self.frame
+
+
+class AsgiApp:
+    def __init__(self, flask_app, workers=10):
+        self.wsgi = WSGIMiddleware(flask_app, workers=workers)
+        self.producers = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/video_feed.mjpeg":
+            await self.video_feed(scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    def get_producer(self, stream):
+        if stream not in self.producers:
+            self.producers[stream] = FrameProducer(
+                CameraStreamer.get_instance(), stream
+            )
+        return self.producers[stream]
+
+    async def video_feed(self, scope, receive, send):
+        query = parse_qs(scope["query_string"].decode())
+        stream = query.get("res", ["high"])[0]
+        if stream not in CameraStreamer.get_instance().broadcasts:
+            await send_plain(send, 400, b"Unknown stream")
+            return
+        try:
+            max_fps = float(query.get("fps", [0])[0])
+        except ValueError:
+            await send_plain(send, 400, b"Bad args")
+            return
+        address = scope["client"][0] if scope.get("client") else None
+        # registered first, nothing else is set up if it fails. No await until
+        # the try, the finally undoes all three
+        client = StreamClients.get_instance().add(stream, address, max_fps)
+        producer = self.get_producer(stream)
+        producer.add_client()
+        disconnected = asyncio.Event()
+        watcher = asyncio.ensure_future(wait_disconnect(receive, disconnected))
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": [
+                        (b"content-type", b"multipart/x-mixed-replace; boundary=frame")
+                    ],
+                }
+            )
+            AdaptiveQuality.get_instance().start()
+            while not disconnected.is_set():
+                # send() waits while the transport is over its high-water
+                # mark, frames published meanwhile are skipped
+                await asyncio.sleep(client.wait_time())
+                sequence, frame = await producer.wait_frame(client.sequence)
+                if sequence == client.sequence:
+                    continue
+                write_start = time.time()
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": b"--frame\r\nContent-Type: image/jpeg\r\n\r\n"
+                        + frame
+                        + b"\r\n",
+                        "more_body": True,
+                    }
+                )
+                # counted only once the frame has been sent
+                client.deliver(sequence, frame, write_start)
+                client.written(len(frame), time.time() - write_start)
+        finally:
+            producer.remove_client()
+            StreamClients.get_instance().remove(client)
+            watcher.cancel()
+
+
+async def wait_disconnect(receive, disconnected):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            disconnected.set()
+            return
+
+
+async def send_plain(send, status, body):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/plain")],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def run(flask_app, host, port, workers=10):
+    uvicorn.run(AsgiApp(flask_app, workers), host=host, port=port, lifespan="off")
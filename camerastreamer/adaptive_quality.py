@@ -0,0 +1,77 @@
+import time
+import logging
+import threading
+from camerastreamer.camera_streamer import CameraStreamer
+from camerastreamer.stream_client import StreamClients
+
+
+class AdaptiveQuality:
+    # Periodically compares what each viewer's link can carry with the size
+    # of the frames of its stream. Each client gets the fps its link sustains
+    # (between min_fps and its own max_fps) and the mjpeg quality of a stream
+    # goes down when one of its clients can't keep up even at that rate.
+    __instance__ = None
+
+    def __init__(self):
+        if AdaptiveQuality.__instance__ is None:
+            self.enabled = True
+            self.min_quality = 40
+            self.max_quality = 85
+            self.quality_step = 10
+            self.min_fps = 2
+            self.headroom = 0.8  # fraction of the measured link rate used
+            self.interval = 5
+            self.thread = None
+            AdaptiveQuality.__instance__ = self
+        else:
+            raise Exception("AdaptiveQuality is a singleton")
+
+    @staticmethod
+    def get_instance():
+        if not AdaptiveQuality.__instance__:
+            AdaptiveQuality()
+        return AdaptiveQuality.__instance__
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._thread, daemon=True)
+            self.thread.start()
+
+    def _thread(self):
+        logging.info("[ADAPTIVE] Start")
+        clients = StreamClients.get_instance()
+        while True:
+            time.sleep(self.interval)
+            if not clients.get_clients():
+                break
+            if self.enabled:
+                self.update()
+        logging.info("[ADAPTIVE] No stream clients, ended")
+
+    def update(self):
+        camera = CameraStreamer.get_instance()
+        load = {}  # worst sustainable/requested fps ratio per stream
+        for client in StreamClients.get_instance().get_clients():
+            frame_size = camera.get_frame_size(client.stream)
+            if client.link_rate is None or frame_size == 0:
+                continue
+            sustainable = client.link_rate * self.headroom / frame_size
+            client.target_fps = min(max(sustainable, self.min_fps), client.max_fps)
+            ratio = sustainable / client.max_fps
+            load[client.stream] = min(load.get(client.stream, ratio), ratio)
+        for stream, ratio in load.items():
+            quality = camera.stream_quality[stream]
+            if ratio < 1:
+                # slowest client is below its requested fps, smaller frames
+                quality = max(quality - self.quality_step, self.min_quality)
+            elif ratio > 2:
+                quality = min(quality + self.quality_step // 2, self.max_quality)
+            camera.set_stream_quality(stream, quality)
+
+    def to_dict(self):
+        return {
+            "enabled": self.enabled,
+            "min_quality": self.min_quality,
+            "max_quality": self.max_quality,
+            "min_fps": self.min_fps,
+        }
@@ -1,27 +1,156 @@
 import time
 import logging
 from camerastreamer.camera_streamer import CameraStreamer
+from camerastreamer.focus_search import FocusSearch
+from camerastreamer.focus_sweep import FocusSweep
+from camerastreamer.focus_cache import FocusCache
 from communications.printer_com import Printer
 from communications.arduino_com import Arduino
 
 
 class AutoFocus:
-    def __init__(self):
+    def __init__(self, metric=None):
         self.camera = CameraStreamer.get_instance()
         self.printer = Printer.get_instance()
         self.arduino = Arduino.get_instance()
+        # FocusMetric used to score frames, camera default if None
+        self.metric = metric if metric is not None else self.camera.focus_metric
+        self.settle = True  # image based vibration check after each move
+        # "model" fits the focus curve, "hill" climbs in steps, "sweep"
+        # scores the frames of continuous z moves
+        self.search = "model"
+        self.search_step = 0.025  # mm between the first samples
+        self.search_tolerance = 0.005  # mm, about two z microsteps
+        self.sweep_duration = 2  # s of the coarse sweep, the fine one is half
+        self.fine_sweep_range = 0.1  # mm each side of the coarse peak
+        # near a cached focus the coarse search is skipped and the fine one
+        # only looks this far (mm) from the cached z
+        self.use_cache = True
+        self.cache_window = 0.03
+
+    def wait_for_stage(self):
+        # blocks until the stage stopped moving (and vibrating)
+        self.printer.wait_for_moves()
+        if self.settle:
+            self.camera.wait_until_still()
+
+    def measure(self):
+        # focus value of a frame taken after the last move finished
+        self.wait_for_stage()
+        return self.camera.get_focus_value(self.metric, wait_new=True)
 
     def auto_focus_lap(self, samples=20):
-        old_feedrate = self.printer.feedrate
+        cached = self.cached_focus()
+        if cached is not None:
+            max_focus = self.fine_from(cached)
+        elif self.search == "sweep":
+            max_focus = self.auto_focus_sweep(samples)
+        else:
+            old_feedrate = self.printer.feedrate
 
-        self.printer.set_feedrate(100)
-        focus_values = self.get_readings_up(samples)
-        max_focus = self.get_max_focus(focus_values)
-        max_focus = self.auto_focus_fine()
+            self.printer.set_feedrate(100)
+            focus_values = self.get_readings_up(samples)
+            max_focus = self.get_max_focus(focus_values)
+            max_focus = self.fine_from(None)
         self.printer.zPos_focus = max_focus[0]
+        self.printer.save_state()
+        return max_focus
+
+    def cache_key(self):
+        # (x, y, magnification, led state, ambient temperature). The X1 has
+        # no heated bed, with its heater off the hotend thermistor follows
+        # the ambient temperature around the stage
+        lens = self.printer.lens
+        hotend = self.printer.sender.temperatures.get("T")
+        temperature = None
+        if hotend is not None and hotend[1] == 0:
+            temperature = hotend[0]
+        return (
+            self.printer.xPos,
+            self.printer.yPos,
+            lens.magnification if lens is not None else None,
+            self.arduino.led_state(),
+            temperature,
+        )
+
+    def cached_focus(self):
+        if not self.use_cache:
+            return None
+        x, y, magnification, led_state, temperature = self.cache_key()
+        return FocusCache.get_instance().lookup(
+            x, y, magnification, led_state, temperature
+        )
+
+    def remember(self, max_focus):
+        x, y, magnification, led_state, temperature = self.cache_key()
+        FocusCache.get_instance().add(
+            x, y, max_focus[0], max_focus[1], magnification, led_state, temperature
+        )
+
+    def measure_at(self, zPos):
+        self.printer.set_zPos(zPos)
+        return self.measure()
+
+    def auto_focus_sweep(self, samples=20):
+        # coarse sweep over the range auto_focus_lap samples, then a fine one
+        # around its peak
+        init_pos = self.printer.lens.init_pos
+        z_to = init_pos + samples * self.printer.lens.step_focus
+        if self.sweep(init_pos, z_to) is None:
+            # no frame during the move, sample the range in steps instead
+            self.get_max_focus(self.get_readings_up(samples))
+            return self.fine_from(None, "model")
+        return self.fine_from(None, "sweep")
+
+    def sweep(self, z_from, z_to, duration=None):
+        focus_sweep = FocusSweep(self.camera, self.printer, self.metric)
+        return focus_sweep.sweep(z_from, z_to, duration or self.sweep_duration)
 
-    def auto_focus_fine(self):
-        og_focus = self.camera.get_lapacian()
+    def sweep_fine(self, narrow=False):
+        zPos = self.printer.zPos
+        z_range = self.cache_window if narrow else self.fine_sweep_range
+        max_focus = self.sweep(zPos - z_range, zPos + z_range, self.sweep_duration / 2)
+        if max_focus is None:
+            # nothing to fit, back to where the sweep was centred
+            self.printer.set_zPos(zPos)
+            return (zPos, self.measure()), False
+        return max_focus, True
+
+    def auto_focus_fine(self, search=None):
+        return self.fine_from(self.cached_focus(), search)
+
+    def fine_from(self, cached, search=None):
+        # fine focus around the current z, or around a cached focus in a
+        # narrow window. The result goes to the focus cache if a peak was
+        # found
+        search = search or self.search
+        if cached is not None:
+            logging.info(f"[AUTOFOCUSFINE] Cached focus at {cached.z}")
+            self.printer.set_zPos(cached.z)
+        if search == "hill":
+            max_focus, found = self.hill_climb_fine()
+        elif search == "sweep":
+            max_focus, found = self.sweep_fine(cached is not None)
+        else:
+            max_focus, found = self.model_search_fine(cached is not None)
+        if found:
+            self.remember(max_focus)
+        else:
+            logging.info(f"[AUTOFOCUSFINE] No peak found, {max_focus} not cached")
+        return max_focus
+
+    def model_search_fine(self, narrow=False):
+        og_zPos = self.printer.zPos
+        step = self.cache_window / 3 if narrow else self.search_step
+        focus_search = FocusSearch(self.measure_at, step, self.search_tolerance)
+        max_focus = focus_search.search(og_zPos)
+        logging.info(f"[AUTOFOCUSFINE] OG Focus at {og_zPos}")
+        logging.info(f"[AUTOFOCUSFINE] Focus at {max_focus[0]} value: {max_focus[1]}")
+        self.printer.set_zPos(max_focus[0])
+        return max_focus, focus_search.converged
+
+    def hill_climb_fine(self):
+        og_focus = self.measure()
         og_zPos = self.printer.zPos
         max_focus = (og_zPos, og_focus)
         focus, max_focus = self.fine_focus(max_focus, 0.025)
@@ -31,17 +160,16 @@ class AutoFocus:
         logging.info(f"[AUTOFOCUSFINE] OG Focus at {og_zPos} value: {og_focus}")
         logging.info(f"[AUTOFOCUSFINE] Focus at {max_focus[0]} value: {max_focus[1]}")
         self.printer.set_zPos(max_focus[0])
-        return max_focus
+        # the climb stops on the first worse step, a local peak
+        return max_focus, True
 
     def get_readings_up(self, n):
         focus_values = []
         self.printer.set_zPos(self.printer.lens.init_pos)
-        time.sleep(1)
         old_focus = 9999
         for i in range(n):
             self.printer.move_zAxis(self.printer.lens.step_focus)
-            time.sleep(1)  # movement is non blocking
-            focus_val = self.camera.get_lapacian()
+            focus_val = self.measure()
             focus_values.append((self.printer.zPos, focus_val))
             if focus_val > old_focus + 3:
                 break
@@ -52,8 +180,7 @@ class AutoFocus:
         focus = False
         while True:
             self.printer.move_zAxis(direction)
-            time.sleep(1.5)  # movement is non blocking
-            focus_val = self.camera.get_lapacian()
+            focus_val = self.measure()
             if focus_val > max_focus[1]:
                 max_focus = (self.printer.zPos, focus_val)
                 focus = True
@@ -61,7 +188,7 @@ class AutoFocus:
                 print(f"Reducing steps to {direction}")
             else:
                 self.printer.move_zAxis(-direction)
-                time.sleep(0.5)  # movement is non blocking
+                self.wait_for_stage()
                 break
         return focus, max_focus
 
@@ -73,5 +200,5 @@ class AutoFocus:
                 max_focus = focus
         max_focus = (float(format(max_focus[0], ".2f")), max_focus[1])
         self.printer.set_zPos(max_focus[0])
-        time.sleep(2)
+        self.wait_for_stage()
         return max_focus
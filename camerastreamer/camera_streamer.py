@@ -2,15 +2,117 @@ import time
 import io
 import threading
 import logging
-import cv2
 import numpy as np
 from picamerax import PiCamera
+from camerastreamer.focus_metric import FocusMetric
+
+# cv2 is imported by the methods that use it, the live feed doesn't need it
 
 # This code is based on examples provided by Miguel Grinberg: https://github.com/miguelgrinberg/flask-video
 # Miguel has an extremely thorough tutorial on how to stream video with Flask here:
 # https://blog.miguelgrinberg.com/post/video-streaming-with-flask
 
 
+class FrameBroadcast:
+    # Latest frame shared between one producer and many consumers. Every
+    # published frame gets a new sequence number so consumers can block until
+    # there is a frame newer than the last one they got.
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.frame = None
+        self.sequence = 0
+        self.timestamp = 0
+
+    def publish(self, frame):
+        with self.condition:
+            self.frame = frame
+            self.sequence += 1
+            self.timestamp = time.time()
+            self.condition.notify_all()
+
+    def wait_frame(self, last_sequence=0, timeout=None):
+        # returns (sequence, frame), sequence == last_sequence on timeout.
+        # Sequences only grow, != also copes with consumers that switched
+        # from another broadcast
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence != last_sequence, timeout)
+            return self.sequence, self.frame
+
+    def wait_timed_frame(self, last_sequence=0, timeout=None):
+        # as wait_frame, returns (sequence, timestamp, frame)
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence != last_sequence, timeout)
+            return self.sequence, self.timestamp, self.frame
+
+
+class StreamingOutput:
+    # File-like output for PiCamera.start_recording(format="mjpeg"). The
+    # hardware encoder hands over each JPEG frame in one or more buffers, a
+    # frame is published as soon as its EOI marker arrives. Single buffer
+    # frames (the usual case) are published as they are, without copies.
+    def __init__(self, broadcast):
+        self.broadcast = broadcast
+        self.chunks = []
+
+    def write(self, buf):
+        if buf.startswith(b"\xff\xd8"):
+            # new frame, drop any leftovers of an incomplete one
+            self.chunks = []
+        self.chunks.append(buf)
+        if buf.endswith(b"\xff\xd9"):
+            if len(self.chunks) == 1:
+                self.broadcast.publish(buf)
+            else:
+                self.broadcast.publish(b"".join(self.chunks))
+            self.chunks = []
+        return len(buf)
+
+    def flush(self):
+        self.chunks = []
+
+
+class LumaOutput:
+    # Output for unencoded yuv recording. Only the Y plane of each frame is
+    # kept, copied into a small ring of preallocated arrays, so focus metrics
+    # get a grayscale frame without JPEG encoding or decoding.
+    def __init__(self, resolution, broadcast, buffers=4):
+        self.width, self.height = resolution
+        # yuv420 frames are padded to a multiple of 32 columns and 16 rows
+        self.stride = (self.width + 31) // 32 * 32
+        self.rows = (self.height + 15) // 16 * 16
+        self.luma_size = self.stride * self.rows
+        self.frame_size = self.luma_size * 3 // 2
+        self.ring = [
+            np.empty((self.rows, self.stride), dtype=np.uint8) for i in range(buffers)
+        ]
+        self.index = 0
+        self.offset = 0  # bytes of the current frame received so far
+        self.broadcast = broadcast
+
+    def write(self, buf):
+        data = memoryview(buf)
+        while len(data) > 0:
+            size = min(len(data), self.frame_size - self.offset)
+            if self.offset < self.luma_size:
+                n = min(size, self.luma_size - self.offset)
+                target = self.ring[self.index].reshape(-1)
+                target[self.offset : self.offset + n] = np.frombuffer(
+                    data[:n], dtype=np.uint8
+                )
+            self.offset += size
+            data = data[size:]
+            if self.offset == self.frame_size:
+                self.broadcast.publish(
+                    self.ring[self.index][: self.height, : self.width]
+                )
+                self.index = (self.index + 1) % len(self.ring)
+                self.offset = 0
+        return len(buf)
+
+    def flush(self):
+        self.offset = 0
+
+
 class CameraStreamer:
     __instance__ = None
 
@@ -19,17 +121,48 @@ class CameraStreamer:
             self.capture_thread = (
                 None  # background thread that reads frames from camera
             )
-            self.frame = None  # current frame is stored here by background thread
+            # frames published by background thread, one broadcast per stream
+            self.broadcasts = {
+                "high": FrameBroadcast(),
+                "low": FrameBroadcast(),
+                "thumb": FrameBroadcast(),
+            }
+            self.broadcast = self.broadcasts["high"]
+            self.active_streams = ["high"]
+            self.luma_broadcast = FrameBroadcast()  # Y plane of the raw stream
+            self.luma_active = False
             self.last_access = 0  # time of last client access to the camera
             self.stop = False
-            self.lock = threading.Lock()
             self.photo_mode = False
             self.camera = PiCamera()
             self.photo_resolution = (4056, 3040)
             self.stream_resolution = (1640, 1232)
             # self.stream_resolution = (960, 720)
-            # lock init
-            self.lock.acquire()
+            # mjpeg: hardware video encoder, still: capture_continuous
+            self.stream_mode = "mjpeg"
+            # extra mjpeg encodings resized by the GPU, (resolution, splitter port)
+            self.simulcast = {
+                "low": ((640, 480), 1),
+                "thumb": ((320, 240), 2),
+            }
+            # mjpeg quality per stream, changes requested while recording are
+            # applied by the capture thread
+            self.stream_quality = {"high": 85, "low": 85, "thumb": 85}
+            self.pending_quality = {}
+            self.quality_lock = threading.Lock()  # guards the two dicts above
+            # unencoded yuv output used for focus metrics
+            self.luma_resolution = (1024, 768)
+            self.luma_port = 3
+            self.focus_metric = FocusMetric()  # default sharpness score
+            # restart: stream stops and the sensor switches mode for each still.
+            # live: sensor runs at photo resolution, the stream is resized and
+            # stills are taken from the still port while recording goes on. The
+            # full frame mode caps the preview at live_framerate, so live is
+            # opt-in through change_still_mode
+            self.still_mode = "restart"
+            self.live_sensor_mode = 3  # HQ camera 4056x3040 full frame mode
+            self.live_framerate = 10
+            self.last_still_ms = 0
             CameraStreamer.__instance__ = self
         else:
             raise Exception("Only one camera can be created at any given time")
@@ -47,14 +180,16 @@ class CameraStreamer:
 
         if self.capture_thread is None:
             logging.info("[CAPTURE_THREAD] Starting")
+            # frames left by a previous run are stale, sequences keep growing
+            # so the clients that hold one still see the new frames
+            last_sequence = self.broadcast.sequence
             # start background frame thread
             self.stop = False
             self.capture_thread = threading.Thread(target=self._thread)
             self.capture_thread.start()
 
-            # wait until frames start to be available
-            while self.frame is None:
-                time.sleep(0)
+            # wait until frames of this run start to be available
+            self.broadcast.wait_frame(last_sequence)
 
     def stop_thread(self):
         if self.capture_thread is None:
@@ -72,35 +207,120 @@ class CameraStreamer:
         self.last_access = time.time()
         if not self.photo_mode:
             self.start_thread()
+        return self.broadcast.frame
+
+    def get_broadcast(self, stream="high"):
+        # streams that are not being encoded fall back to the main stream
+        if stream not in self.active_streams:
+            stream = "high"
+        return self.broadcasts[stream]
 
-        # wait until new frame is available
-        # self.lock.acquire(True)
-        return self.frame
+    def wait_frame(self, last_sequence=0, timeout=1, stream="high"):
+        # blocks until a frame newer than last_sequence is available and
+        # returns (sequence, frame). On timeout the sequence is unchanged
+        self.last_access = time.time()
+        if not self.photo_mode:
+            self.start_thread()
+        return self.get_broadcast(stream).wait_frame(last_sequence, timeout)
 
     def _thread(self):
         # camera initial setup
         logging.info("[CAPTURE_THREAD] Start")
-        # self.camera.start_recording(stream, format='mjpeg'
 
-        self.camera.resolution = self.stream_resolution
+        if self.still_mode == "live":
+            self.camera.sensor_mode = self.live_sensor_mode
+            self.camera.resolution = self.photo_resolution
+            self.camera.framerate = self.live_framerate
+            resize = self.stream_resolution
+        else:
+            self.camera.sensor_mode = 0
+            self.camera.resolution = self.stream_resolution
+            self.camera.framerate = 30
+            resize = None
         self.camera.hflip = False
         self.camera.vflip = False
 
+        if self.stream_mode == "mjpeg":
+            self._record_mjpeg(resize)
+        else:
+            self.active_streams = ["high"]
+            self._capture_continuous(resize)
+
+        self.stop = False
+        logging.info("[CAPTURE_THREAD] Ended")
+
+    def _start_mjpeg_encoder(self, stream, resize, port):
+        self.camera.start_recording(
+            StreamingOutput(self.broadcasts[stream]),
+            format="mjpeg",
+            splitter_port=port,
+            resize=resize,
+            quality=self.stream_quality[stream],
+        )
+
+    def _apply_pending_quality(self, encoders):
+        # restarts only the encoders whose quality changed
+        with self.quality_lock:
+            pending = self.pending_quality
+            self.pending_quality = {}
+            self.stream_quality.update(pending)
+        for stream, quality in pending.items():
+            resize, port = encoders[stream]
+            self.camera.stop_recording(splitter_port=port)
+            self._start_mjpeg_encoder(stream, resize, port)
+            logging.info(f"[CAMERA] Stream {stream} quality set to {quality}")
+
+    def _record_mjpeg(self, resize=None):
+        # frames come straight from the hardware MJPEG encoder, the simulcast
+        # streams are resized and encoded on their own splitter ports
+        encoders = {"high": (resize, 0)}
+        encoders.update(self.simulcast)
+        ports = []
+        for stream, (stream_resize, port) in encoders.items():
+            self._start_mjpeg_encoder(stream, stream_resize, port)
+            ports.append(port)
+        self.active_streams = ["high"] + list(self.simulcast)
+        self.camera.start_recording(
+            LumaOutput(self.luma_resolution, self.luma_broadcast),
+            format="yuv",
+            splitter_port=self.luma_port,
+            resize=self.luma_resolution,
+        )
+        ports.append(self.luma_port)
+        self.luma_active = True
+        try:
+            while not self.stop:
+                self.camera.wait_recording(0.5)
+                if self.pending_quality:
+                    self._apply_pending_quality(encoders)
+                # if there hasn't been any clients asking for frames in
+                # the last 10 seconds stop the thread
+                if time.time() - self.last_access > 10:
+                    break
+        finally:
+            self.active_streams = ["high"]
+            self.luma_active = False
+            for port in reversed(ports):
+                self.camera.stop_recording(splitter_port=port)
+
+    def _capture_continuous(self, resize=None):
         # let camera warm up
         # self.camera.start_preview()
         # time.sleep(.5)
         # self.camera.stop_preview()
         stream = io.BytesIO()
-        for foo in self.camera.capture_continuous(stream, "jpeg", use_video_port=True):
+        for foo in self.camera.capture_continuous(
+            stream,
+            "jpeg",
+            use_video_port=True,
+            resize=resize,
+            quality=self.stream_quality["high"],
+        ):
             # store frame
             stream.seek(0)
-            self.frame = stream.read()
+            self.broadcast.publish(stream.read())
 
-            # release lock as new frame is available
-            # if not self.lock.acquire(False):
-            #    self.lock.release()
             # reset stream for next frame
-
             stream.seek(0)
             stream.truncate()
             if self.stop:
@@ -110,57 +330,167 @@ class CameraStreamer:
             if time.time() - self.last_access > 10:
                 break
 
-        self.stop = False
-        logging.info("[CAPTURE_THREAD] Ended")
+    def capture_still(self, output, format="jpeg"):
+        # full resolution still, keeps the stream running in live mode
+        start_time = time.time()
+        if self.still_mode == "live":
+            self.last_access = time.time()
+            self.start_thread()
+            self.camera.capture(output, format, use_video_port=False)
+        else:
+            self.photo_mode = True
+            self.stop_thread()
+            self.camera.resolution = self.photo_resolution
+            self.camera.capture(output, format)
+            time.sleep(0.2)
+            self.photo_mode = False
+        self.last_still_ms = (time.time() - start_time) * 1000
+        logging.info(
+            f"[CAMERA] Still ({self.still_mode}) took {self.last_still_ms:.0f} ms"
+        )
 
     def get_photo(self):
-        self.photo_mode = True
-        self.stop_thread()
-        self.camera.resolution = self.photo_resolution
         self.camera.sharpness = 75
         output = io.BytesIO()
-        self.camera.capture(output, "jpeg")
+        self.capture_still(output, "jpeg")
         output.seek(0)
         logging.info(f"[CAMERA] Photo taken")
-        time.sleep(0.2)
-        self.photo_mode = False
         return output
 
     def save_photo(self, filepath="./tmp/1.jpeg"):
-        self.photo_mode = True
-        self.stop_thread()
-        self.camera.resolution = self.photo_resolution
         self.camera.sharpness = 50
-        self.camera.capture(filepath, "jpeg")
+        self.capture_still(filepath, "jpeg")
         logging.info(f"[CAMERA] Local Photo taken")
-        time.sleep(0.2)
-        self.photo_mode = False
+
+    def get_bgr_photo(self):
+        # full resolution still as a BGR array, without a JPEG in between
+        from picamerax.array import PiRGBArray
+
+        self.camera.sharpness = 50
+        output = PiRGBArray(self.camera)
+        self.capture_still(output, "bgr")
+        return output.array
 
     def get_opencv_photo(self):
-        self.photo_mode = True
-        self.stop_thread()
-        self.camera.resolution = self.photo_resolution
+        import cv2
+
         output = io.BytesIO()
-        self.camera.capture(output, "jpeg")
-        self.photo_mode = False
+        self.capture_still(output, "jpeg")
         data = np.fromstring(output.getvalue(), dtype=np.uint8)
         image = cv2.imdecode(data, 1)
         return image
 
     def get_opencv_from_stream(self):
+        import cv2
+
         output = self.get_frame()
         data = np.fromstring(output, dtype=np.uint8)
         image = cv2.imdecode(data, 1)
         return image
 
+    def get_luma(self, wait_new=False):
+        # latest Y plane as a uint8 array. It is a view of a reused buffer,
+        # copy it if it has to outlive the next few frames
+        self.last_access = time.time()
+        if not self.photo_mode:
+            self.start_thread()
+        if self.luma_active:
+            sequence = self.luma_broadcast.sequence if wait_new else 0
+            sequence, luma = self.luma_broadcast.wait_frame(sequence, 1)
+            return luma
+        # no raw output in still stream mode, decode the stream jpeg as gray
+        import cv2
+
+        if wait_new:
+            sequence, frame = self.wait_frame(self.broadcast.sequence)
+        else:
+            frame = self.get_frame()
+        data = np.frombuffer(frame, dtype=np.uint8)
+        return cv2.imdecode(data, cv2.IMREAD_GRAYSCALE)
+
+    def wait_luma(self, last_sequence=0, timeout=1):
+        # (sequence, timestamp, Y plane) of the first luma frame newer than
+        # last_sequence, timestamp is the time it was published. The luma is
+        # None on timeout
+        import cv2
+
+        self.last_access = time.time()
+        if not self.photo_mode:
+            self.start_thread()
+        broadcast = self.luma_broadcast if self.luma_active else self.broadcast
+        sequence, timestamp, frame = broadcast.wait_timed_frame(last_sequence, timeout)
+        if sequence == last_sequence or frame is None:
+            return sequence, timestamp, None
+        if not self.luma_active:
+            data = np.frombuffer(frame, dtype=np.uint8)
+            frame = cv2.imdecode(data, cv2.IMREAD_GRAYSCALE)
+        return sequence, timestamp, frame
+
+    def get_focus_value(self, metric=None, wait_new=False):
+        if metric is None:
+            metric = self.focus_metric
+        return metric.evaluate(self.get_luma(wait_new))
+
+    def wait_until_still(self, threshold=1.5, timeout=0.5):
+        # waits until two consecutive frames barely differ, the stage has
+        # stopped vibrating after a move. False if it timed out
+        import cv2
+
+        start_time = time.time()
+        previous = self._small_luma()
+        while time.time() - start_time < timeout:
+            current = self._small_luma()
+            if cv2.mean(cv2.absdiff(current, previous))[0] < threshold:
+                return True
+            previous = current
+        logging.info("[CAMERA] Image didn't settle")
+        return False
+
+    def _small_luma(self):
+        import cv2
+
+        return cv2.resize(
+            self.get_luma(wait_new=True), (160, 120), interpolation=cv2.INTER_AREA
+        )
+
     def get_lapacian(self):
-        image = self.get_opencv_from_stream()
-        grayscale = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        return cv2.Laplacian(grayscale, cv2.CV_64F).var()
+        # full frame laplacian variance regardless of the focus_metric setting
+        return self.get_focus_value(FocusMetric())
 
-    def get_frame_size(self):
-        output = self.get_frame()
-        return len(output)
+    def get_frame_size(self, stream="high"):
+        # size of the latest frame of a stream, without waking the camera
+        frame = self.get_broadcast(stream).frame
+        if frame is None:
+            return 0
+        return len(frame)
+
+    def set_stream_quality(self, stream, quality):
+        with self.quality_lock:
+            if quality == self.stream_quality[stream]:
+                self.pending_quality.pop(stream, None)
+            elif self.capture_thread is not None and self.stream_mode == "mjpeg":
+                self.pending_quality[stream] = quality
+            else:
+                self.stream_quality[stream] = quality
+
+    def change_still_mode(self, new_mode):
+        self.photo_mode = True
+        self.stop_thread()
+        self.still_mode = new_mode
+        self.photo_mode = False
+
+    def change_photo_resolution(self, new_resolution):
+        # in live mode the sensor runs at photo resolution, restart the stream
+        self.photo_mode = True
+        self.stop_thread()
+        self.photo_resolution = new_resolution
+        self.photo_mode = False
+
+    def change_stream_mode(self, new_mode):
+        self.photo_mode = True
+        self.stop_thread()
+        self.stream_mode = new_mode
+        self.photo_mode = False
 
     def change_stream_resolution(self, new_resolution):
         self.photo_mode = True
@@ -0,0 +1,125 @@
+import os
+import math
+import shutil
+import logging
+import cv2
+import numpy as np
+
+DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"
+  Format="{format}" Overlap="{overlap}" TileSize="{tile_size}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+
+class DeepZoom:
+    # Multi-resolution tiled mosaic in the DeepZoom layout that OpenSeadragon
+    # reads: out.dzi describes the image and out_files/<level>/<col>_<row>.jpg
+    # holds the tiles. The last level is the full mosaic and every level below
+    # halves it down to 1x1 px, so a viewer only downloads what it shows.
+    def __init__(self, tile_size=254, overlap=1, quality=90, memory_mb=64):
+        self.tile_size = tile_size
+        self.overlap = overlap  # px repeated on each side of a tile
+        self.quality = quality  # JPEG quality of the tiles
+        # levels of a memory mapped mosaic larger than this stay on disk
+        self.memory_mb = memory_mb
+
+    @staticmethod
+    def levels(width, height):
+        return int(math.ceil(math.log2(max(width, height)))) + 1
+
+    def save(self, image, dzi_path):
+        # writes the tiles next to dzi_path, <name>.dzi and <name>_files/
+        files_path = f"{os.path.splitext(dzi_path)[0]}_files"
+        if os.path.exists(files_path):
+            shutil.rmtree(files_path)  # a previous mosaic may have more levels
+        height, width = image.shape[:2]
+        level_image = image
+        tiles = 0
+        scratch_path = None
+        for level in range(self.levels(width, height) - 1, -1, -1):
+            tiles += self.save_level(level_image, f"{files_path}/{level}")
+            if level == 0:
+                break
+            previous_path = scratch_path
+            scratch_path = None
+            if (
+                isinstance(level_image, np.memmap)
+                and level_image.nbytes / 4 > self.memory_mb * 1024 * 1024
+            ):
+                scratch_path = f"{dzi_path}.{level - 1}.raw"
+            level_image = self.half(level_image, scratch_path)
+            if previous_path is not None:
+                os.remove(previous_path)  # the map stays valid until released
+        if scratch_path is not None:
+            os.remove(scratch_path)
+        # the descriptor goes last, once it exists all the tiles do
+        with open(f"{dzi_path}.tmp", "w") as f:
+            f.write(
+                DZI_TEMPLATE.format(
+                    format="jpg",
+                    overlap=self.overlap,
+                    tile_size=self.tile_size,
+                    width=width,
+                    height=height,
+                )
+            )
+        os.replace(f"{dzi_path}.tmp", dzi_path)
+        logging.info(f"[DEEPZOOM] {width}x{height} mosaic, {tiles} tiles")
+        return dzi_path
+
+    @staticmethod
+    def shrink(image):
+        # 2x2 box average, an odd last row or column is averaged with itself
+        # so every level px covers the same 2x2 px of the level above
+        height, width = image.shape[:2]
+        if height % 2 or width % 2:
+            image = cv2.copyMakeBorder(
+                image, 0, height % 2, 0, width % 2, cv2.BORDER_REPLICATE
+            )
+        return cv2.resize(
+            image,
+            (image.shape[1] // 2, image.shape[0] // 2),
+            interpolation=cv2.INTER_AREA,
+        )
+
+    @staticmethod
+    def half(image, scratch_path=None, strip_height=256):
+        # next level down, rounding up as the DeepZoom level sizes do. With a
+        # scratch_path it is memory mapped there and resized a strip at a time
+        height, width = image.shape[:2]
+        size = (max(1, math.ceil(width / 2)), max(1, math.ceil(height / 2)))
+        if scratch_path is None:
+            return DeepZoom.shrink(image)
+        half = np.memmap(
+            scratch_path,
+            dtype=image.dtype,
+            mode="w+",
+            shape=(size[1], size[0]) + image.shape[2:],
+        )
+        for top in range(0, size[1], strip_height):
+            bottom = min(top + strip_height, size[1])
+            half[top:bottom] = DeepZoom.shrink(image[2 * top : 2 * bottom]).reshape(
+                half[top:bottom].shape
+            )
+        half.flush()
+        return half
+
+    def save_level(self, image, folder):
+        os.makedirs(folder, exist_ok=True)
+        height, width = image.shape[:2]
+        tiles = 0
+        for row in range(math.ceil(height / self.tile_size)):
+            for column in range(math.ceil(width / self.tile_size)):
+                x0 = max(column * self.tile_size - self.overlap, 0)
+                y0 = max(row * self.tile_size - self.overlap, 0)
+                x1 = min((column + 1) * self.tile_size + self.overlap, width)
+                y1 = min((row + 1) * self.tile_size + self.overlap, height)
+                cv2.imwrite(
+                    f"{folder}/{column}_{row}.jpg",
+                    image[y0:y1, x0:x1],
+                    [cv2.IMWRITE_JPEG_QUALITY, self.quality],
+                )
+                tiles += 1
+        return tiles
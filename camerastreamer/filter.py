@@ -39,10 +39,10 @@ class Filter:
             og_img = self.camera.get_opencv_photo()
             logging.info(f"[FILTER] OG photo taken")
         else:
-            og_img = cv2.imread(self.focus_stack.get_focus_stack_img(n_focus))
+            og_img = self.focus_stack.get_focus_stack_array(n_focus)
             logging.info(f"[FILTER] OG focus stacked photo taken")
         self.printer.move_zAxis(-0.7)
-        time.sleep(0.5)
+        self.autofocus.wait_for_stage()
         back_img = self.camera.get_opencv_photo()
         logging.info(f"[FILTER] Background photo taken")
         self.printer.move_zAxis(0.7)
@@ -0,0 +1,124 @@
+import math
+import time
+import threading
+
+
+class FocusEntry:
+    def __init__(self, x, y, z, value, magnification, led_state, temperature):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.value = value
+        self.magnification = magnification
+        self.led_state = led_state
+        self.temperature = temperature  # ambient temperature when it was found
+        self.timestamp = time.time()
+
+    def to_dict(self):
+        return {
+            "x": self.x,
+            "y": self.y,
+            "z": self.z,
+            "value": self.value,
+            "magnification": self.magnification,
+            "bottom_light": self.led_state[0],
+            "rgbw_ring": self.led_state[1],
+            "temperature": self.temperature,
+            "age_s": round(time.time() - self.timestamp, 1),
+        }
+
+
+class FocusCache:
+    # Confirmed focus positions indexed by stage position, lens and lights.
+    # Autofocus near a cached entry starts from its z with a narrow search.
+    # Entries expire with age and when the ambient temperature drifted, the
+    # frame expands and the focus moves. Without a temperature reading only
+    # the age counts.
+    __instance__ = None
+
+    def __init__(self):
+        if FocusCache.__instance__ is None:
+            self.entries = []
+            self.lock = threading.Lock()
+            self.enabled = True
+            self.tolerance = 0.2  # mm in x/y to reuse an entry
+            self.max_age = 1800  # s
+            self.max_drift = 2.0  # degrees C
+            self.hits = 0
+            self.misses = 0
+            FocusCache.__instance__ = self
+        else:
+            raise Exception("FocusCache is a singleton")
+
+    @staticmethod
+    def get_instance():
+        if not FocusCache.__instance__:
+            FocusCache()
+        return FocusCache.__instance__
+
+    def is_valid(self, entry, temperature):
+        if time.time() - entry.timestamp > self.max_age:
+            return False
+        if temperature is not None and entry.temperature is not None:
+            return abs(temperature - entry.temperature) <= self.max_drift
+        return True
+
+    def evict(self, temperature=None):
+        with self.lock:
+            self.entries = [
+                entry for entry in self.entries if self.is_valid(entry, temperature)
+            ]
+
+    def nearest(self, x, y, magnification, led_state):
+        # closest entry within the tolerance, the lock must be held
+        best = None
+        best_distance = self.tolerance
+        for entry in self.entries:
+            if entry.magnification != magnification or entry.led_state != led_state:
+                continue
+            distance = math.hypot(entry.x - x, entry.y - y)
+            if distance <= best_distance:
+                best = entry
+                best_distance = distance
+        return best
+
+    def lookup(self, x, y, magnification, led_state, temperature=None):
+        if not self.enabled:
+            return None
+        self.evict(temperature)
+        with self.lock:
+            entry = self.nearest(x, y, magnification, led_state)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def add(self, x, y, z, value, magnification, led_state, temperature=None):
+        # a new confirmation replaces the entry it falls on
+        if not self.enabled:
+            return
+        entry = FocusEntry(x, y, z, value, magnification, led_state, temperature)
+        with self.lock:
+            old = self.nearest(x, y, magnification, led_state)
+            if old is not None:
+                self.entries.remove(old)
+            self.entries.append(entry)
+
+    def clear(self):
+        with self.lock:
+            self.entries = []
+            self.hits = 0
+            self.misses = 0
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "tolerance": self.tolerance,
+                "max_age": self.max_age,
+                "max_drift": self.max_drift,
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": [entry.to_dict() for entry in self.entries],
+            }
@@ -0,0 +1,141 @@
+import time
+import logging
+import cv2
+import numpy as np
+
+
+class FocusFusion:
+    # All in focus image from a focus stack, in memory. Every slice is split
+    # into a float32 Laplacian pyramid, each coefficient is taken from the
+    # slice where the local contrast around it is highest and the coarsest
+    # level is averaged. The image is fused in horizontal bands with a
+    # margin as deep as the pyramid reaches, so only the pyramids of one
+    # band are in memory. With align, slices are shifted onto the first one
+    # by phase correlation as the stage drifts a little when z moves.
+    def __init__(
+        self, levels=5, align=True, downsample=4, max_shift=0.05, band_height=256
+    ):
+        self.levels = levels
+        self.align = align
+        self.downsample = downsample  # for the alignment only
+        # larger shifts (fraction of the width) are taken as wrong
+        self.max_shift = max_shift
+        # rows fused at a time, a multiple of 2 ** levels keeps every band
+        # on the pyramid grid of the whole image
+        self.band_height = band_height
+        self.reset()
+
+    def reset(self):
+        self.fused = None  # Laplacian pyramid, float32
+        self.contrast = None  # per level contrast of the chosen coefficients
+        self.base_sum = None
+        self.count = 0
+        self.reference = None  # downsampled gray of the first slice
+        self.window = None
+
+    def small_gray(self, image):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        size = (gray.shape[1] // self.downsample, gray.shape[0] // self.downsample)
+        return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def shift(self, image):
+        # how far the slice content moved from the first slice, None if it
+        # doesn't need to be moved
+        small = self.small_gray(image)
+        if self.reference is None:
+            self.reference = small
+            self.window = cv2.createHanningWindow(
+                (small.shape[1], small.shape[0]), cv2.CV_32F
+            )
+            return None
+        (shift_x, shift_y), response = cv2.phaseCorrelate(
+            self.reference, small, self.window
+        )
+        shift_x *= self.downsample
+        shift_y *= self.downsample
+        if max(abs(shift_x), abs(shift_y)) > self.max_shift * image.shape[1]:
+            logging.info(f"[FOCUSFUSION] Shift ({shift_x}, {shift_y}) ignored")
+            return None
+        if max(abs(shift_x), abs(shift_y)) < 0.5:
+            return None
+        return shift_x, shift_y
+
+    @staticmethod
+    def band(image, shift, top, bottom):
+        # rows top:bottom of the slice moved back by shift, only the band is
+        # warped
+        if shift is None:
+            return image[top:bottom]
+        matrix = np.float32([[1, 0, -shift[0]], [0, 1, -top - shift[1]]])
+        return cv2.warpAffine(
+            image,
+            matrix,
+            (image.shape[1], bottom - top),
+            flags=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_REFLECT,
+        )
+
+    def pyramid(self, image):
+        gaussian = image.astype(np.float32)
+        laplacian = []
+        for level in range(self.levels):
+            down = cv2.pyrDown(gaussian)
+            up = cv2.pyrUp(down, dstsize=(gaussian.shape[1], gaussian.shape[0]))
+            laplacian.append(gaussian - up)
+            gaussian = down
+        laplacian.append(gaussian)  # coarsest level, kept as is
+        return laplacian
+
+    @staticmethod
+    def local_contrast(level):
+        # absolute coefficients summed over the channels, smoothed so the
+        # choice doesn't flip from pixel to pixel on noise
+        return cv2.GaussianBlur(np.abs(level).sum(axis=2), (5, 5), 0)
+
+    def add(self, image):
+        pyramid = self.pyramid(image)
+        contrast = [self.local_contrast(level) for level in pyramid[:-1]]
+        if self.fused is None:
+            self.fused = pyramid
+            self.contrast = contrast
+            self.base_sum = pyramid[-1].copy()
+        else:
+            for level in range(self.levels):
+                sharper = contrast[level] > self.contrast[level]
+                self.fused[level][sharper] = pyramid[level][sharper]
+                self.contrast[level][sharper] = contrast[level][sharper]
+            self.base_sum += pyramid[-1]
+        self.count += 1
+
+    def result(self):
+        image = self.base_sum / self.count
+        for level in reversed(self.fused[:-1]):
+            image = cv2.pyrUp(image, dstsize=(level.shape[1], level.shape[0])) + level
+        return np.clip(image, 0, 255).astype(np.uint8)
+
+    def fuse(self, images):
+        # BGR uint8 slices, the first one is the alignment reference
+        start_time = time.time()
+        self.reset()
+        shifts = [self.shift(image) if self.align else None for image in images]
+        height = images[0].shape[0]
+        # coefficients of the coarsest level reach about 2 ** (levels + 2) px
+        margin = 2 ** (self.levels + 2)
+        result = np.empty_like(images[0])
+        for top in range(0, height, self.band_height):
+            bottom = min(top + self.band_height, height)
+            band_top = max(top - margin, 0)
+            band_bottom = min(bottom + margin, height)
+            self.fused = None
+            self.count = 0
+            for image, shift in zip(images, shifts):
+                self.add(self.band(image, shift, band_top, band_bottom))
+            result[top:bottom] = self.result()[top - band_top : bottom - band_top]
+        self.fused = None
+        self.contrast = None
+        self.base_sum = None
+        logging.info(
+            f"[FOCUSFUSION] {len(images)} slices fused in "
+            f"{time.time() - start_time:.2f} s"
+        )
+        return result
@@ -0,0 +1,107 @@
+import logging
+import numpy as np
+
+
+class FocusMap:
+    # Predicted focus z over a scan area. Autofocus only runs at a few anchor
+    # positions, a plane (or a quadratic surface with enough anchors) is
+    # fitted to them by least squares and every tile goes straight to the
+    # predicted z. Tiles that come out clearly less sharp than the anchors
+    # get a local autofocus that starts from the prediction and, if it found
+    # a sharp image, becomes a new anchor.
+    def __init__(self, autofocus, threshold=0.7):
+        self.autofocus = autofocus
+        self.printer = autofocus.printer
+        # tiles below threshold * median anchor sharpness are refined
+        self.threshold = threshold
+        self.anchors = []  # (x, y, z, focus value)
+        self.coefficients = None
+        self.refinements = 0
+
+    @staticmethod
+    def anchor_positions(x_range, y_range, tiles):
+        # corners and centre, a 3x3 grid on large scans. None if there are
+        # as many anchors as tiles
+        columns, rows = tiles
+        if columns * rows <= 5:
+            return None
+        if columns >= 6 and rows >= 6:
+            xs = np.linspace(x_range[0], x_range[1], 3)
+            ys = np.linspace(y_range[0], y_range[1], 3)
+            # serpentine so the stage doesn't go back on every row
+            return [
+                (float(x), float(y))
+                for row, y in enumerate(ys)
+                for x in (xs if row % 2 == 0 else xs[::-1])
+            ]
+        x_mid = (x_range[0] + x_range[1]) / 2
+        y_mid = (y_range[0] + y_range[1]) / 2
+        return [
+            (x_range[0], y_range[0]),
+            (x_range[1], y_range[0]),
+            (x_mid, y_mid),
+            (x_range[1], y_range[1]),
+            (x_range[0], y_range[1]),
+        ]
+
+    def build(self, x_range, y_range, tiles):
+        # autofocus at the anchors and fit, False if the map isn't worth it
+        positions = self.anchor_positions(x_range, y_range, tiles)
+        if positions is None:
+            return False
+        for x, y in positions:
+            self.printer.move_to(x=x, y=y)
+            self.add_anchor(x, y, self.autofocus.auto_focus_fine())
+        self.fit()
+        logging.info(
+            f"[FOCUSMAP] {len(self.anchors)} anchors, coefficients: {self.coefficients}"
+        )
+        return True
+
+    def add_anchor(self, x, y, max_focus):
+        z, value = max_focus
+        self.anchors.append((x, y, z, value))
+
+    def terms(self, x, y):
+        if len(self.coefficients) == 6:
+            return [1, x, y, x * x, x * y, y * y]
+        if len(self.coefficients) == 3:
+            return [1, x, y]
+        return [1]
+
+    def fit(self):
+        # quadratic with 9+ anchors, plane with 3+, mean z below
+        anchors = np.array(self.anchors, dtype=np.float64)
+        x, y, z = anchors[:, 0], anchors[:, 1], anchors[:, 2]
+        ones = np.ones_like(x)
+        if len(anchors) >= 9:
+            design = np.column_stack([ones, x, y, x * x, x * y, y * y])
+        elif len(anchors) >= 3:
+            design = np.column_stack([ones, x, y])
+        else:
+            design = ones[:, None]
+        self.coefficients, residuals, rank, singular = np.linalg.lstsq(
+            design, z, rcond=None
+        )
+
+    def predict(self, x, y):
+        return float(np.dot(self.terms(x, y), self.coefficients))
+
+    def reference_value(self):
+        return float(np.median([anchor[3] for anchor in self.anchors]))
+
+    def focus_tile(self, x, y):
+        # moves to the predicted z, returns (z, focus value)
+        z = round(self.predict(x, y), 4)
+        self.printer.set_zPos(z)
+        value = self.autofocus.measure()
+        if value >= self.threshold * self.reference_value():
+            return z, value
+        logging.info(f"[FOCUSMAP] Tile at ({x}, {y}) value {value}, refining")
+        self.refinements += 1
+        max_focus = self.autofocus.auto_focus_fine()
+        if max_focus[1] >= self.threshold * self.reference_value():
+            # featureless tiles would bend the surface, only sharp ones count
+            self.add_anchor(x, y, max_focus)
+            self.fit()
+        return max_focus
@@ -0,0 +1,91 @@
+import numpy as np
+
+# cv2 is imported by the methods that use it, creating a metric (as the
+# camera does on start) doesn't load OpenCV
+
+
+class FocusMetric:
+    # Sharpness score of a grayscale frame, higher is sharper. Every metric
+    # runs in float32 on an optional centred roi (fraction of the frame side)
+    # after pyramid downsampling by a power of two factor.
+    METHODS = ["laplacian", "tenengrad", "brenner", "normalized_variance"]
+
+    def __init__(self, method="laplacian", roi=1.0, downsample=1):
+        if method not in self.METHODS:
+            raise ValueError(method)
+        if roi <= 0 or roi > 1:
+            raise ValueError(roi)
+        if downsample < 1 or downsample & (downsample - 1):
+            raise ValueError(downsample)
+        self.method = method
+        self.roi = roi
+        self.downsample = downsample
+
+    def copy(self, method=None, roi=None, downsample=None):
+        # same settings with some of them overridden
+        return FocusMetric(
+            method if method is not None else self.method,
+            roi if roi is not None else self.roi,
+            downsample if downsample is not None else self.downsample,
+        )
+
+    def to_dict(self):
+        return {
+            "metric": self.method,
+            "roi": self.roi,
+            "downsample": self.downsample,
+        }
+
+    def evaluate(self, gray):
+        image = self.prepare(gray)
+        if self.method == "tenengrad":
+            return self._tenengrad(image)
+        if self.method == "brenner":
+            return self._brenner(image)
+        if self.method == "normalized_variance":
+            return self._normalized_variance(image)
+        return self._laplacian(image)
+
+    def prepare(self, gray):
+        # crops before downsampling so pyrDown only touches the roi
+        if self.roi < 1:
+            height, width = gray.shape[:2]
+            roi_h = int(height * self.roi)
+            roi_w = int(width * self.roi)
+            top = (height - roi_h) // 2
+            left = (width - roi_w) // 2
+            gray = gray[top : top + roi_h, left : left + roi_w]
+        factor = self.downsample
+        if factor > 1:
+            import cv2
+        while factor > 1:
+            gray = cv2.pyrDown(gray)
+            factor //= 2
+        return gray.astype(np.float32)
+
+    def _laplacian(self, image):
+        import cv2
+
+        laplacian = cv2.Laplacian(image, cv2.CV_32F)
+        mean, std = cv2.meanStdDev(laplacian)
+        return float(std[0][0] ** 2)
+
+    def _tenengrad(self, image):
+        import cv2
+
+        gx = cv2.Sobel(image, cv2.CV_32F, 1, 0, ksize=3)
+        gy = cv2.Sobel(image, cv2.CV_32F, 0, 1, ksize=3)
+        return float(cv2.mean(gx * gx + gy * gy)[0])
+
+    def _brenner(self, image):
+        dx = image[:, 2:] - image[:, :-2]
+        dy = image[2:, :] - image[:-2, :]
+        return float(np.mean(dx * dx) + np.mean(dy * dy))
+
+    def _normalized_variance(self, image):
+        import cv2
+
+        mean, std = cv2.meanStdDev(image)
+        if mean[0][0] == 0:
+            return 0.0
+        return float(std[0][0] ** 2 / mean[0][0])
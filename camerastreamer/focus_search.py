@@ -0,0 +1,156 @@
+import math
+import logging
+import numpy as np
+
+GOLDEN_RATIO = (math.sqrt(5) - 1) / 2
+MODELS = ["gaussian", "parabola"]
+
+
+def fit_peak(zs, values, model="gaussian"):
+    # z of the peak of a gaussian (parabola on the log of the values) or a
+    # parabola fitted to the samples, None if the fit has no maximum
+    zs = np.asarray(zs, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if model == "gaussian" and np.all(values > 0):
+        values = np.log(values)
+    origin = zs[np.argmax(values)]
+    a, b, c = np.polyfit(zs - origin, values, 2)
+    if a >= 0:
+        return None
+    return float(origin - b / (2 * a))
+
+
+class FocusSearch:
+    # Finds the z of maximum sharpness with as few measurements as possible.
+    # Three samples around the start are widened until the peak is bracketed,
+    # then a gaussian (parabola on the log of the values) or a parabola is
+    # fitted to the samples around the best one and the stage jumps to its
+    # vertex. When the fit is not concave or misses, golden-section search
+    # narrows the bracket down to the tolerance.
+    def __init__(
+        self,
+        measure_at,
+        step=0.025,
+        tolerance=0.005,
+        max_evaluations=12,
+        model="gaussian",
+        limits=(0, 100),
+    ):
+        if model not in MODELS:
+            raise ValueError(model)
+        self.measure_at = measure_at  # measure_at(z) moves there and scores
+        self.step = step
+        self.tolerance = tolerance
+        self.max_evaluations = max_evaluations
+        self.model = model
+        self.limits = limits
+        self.samples = {}  # z: focus value
+        # False if the last search returned its best sample without finding
+        # the peak (not bracketed or out of budget)
+        self.converged = False
+
+    def search(self, z0):
+        # returns (z, value) of the sharpest measured position
+        self.samples = {}
+        self.evaluate(z0)
+        bracket = self.bracket(z0)
+        self.converged = False
+        if bracket is not None:
+            self.converged = self.fit_peak(bracket) or self.golden_section(bracket)
+        best = self.best()
+        logging.info(
+            f"[FOCUSSEARCH] Peak at {best[0]} value: {best[1]} "
+            f"after {len(self.samples)} evaluations, converged: {self.converged}"
+        )
+        return best
+
+    def evaluate(self, z):
+        z = round(float(min(max(z, self.limits[0]), self.limits[1])), 4)
+        if z not in self.samples:
+            self.samples[z] = float(self.measure_at(z))
+        return z, self.samples[z]
+
+    def best(self):
+        z = max(self.samples, key=self.samples.get)
+        return z, self.samples[z]
+
+    def budget_left(self):
+        return len(self.samples) < self.max_evaluations
+
+    def bracket(self, z0):
+        # (low, high) around the best sample, the step grows by the golden
+        # ratio towards the side that keeps improving. None if out of budget
+        self.evaluate(z0 + self.step)
+        self.evaluate(z0 - self.step)
+        step = self.step
+        while self.budget_left():
+            zs = sorted(self.samples)
+            best_z = self.best()[0]
+            index = zs.index(best_z)
+            if 0 < index < len(zs) - 1:
+                return zs[index - 1], zs[index + 1]
+            if best_z in self.limits:
+                break
+            step *= 1 + GOLDEN_RATIO
+            direction = 1 if index == len(zs) - 1 else -1
+            self.evaluate(best_z + direction * step)
+        logging.info("[FOCUSSEARCH] Peak not bracketed")
+        return None
+
+    def fit_vertex(self, low, high):
+        # vertex of the model fitted to the best sample, its neighbours and
+        # the next ones if they are close (3 to 5 samples), None if the fit
+        # isn't a peak inside (low, high)
+        best_z = self.best()[0]
+        zs = sorted(self.samples)
+        index = zs.index(best_z)
+        zs = [
+            z
+            for z in zs[max(index - 2, 0) : index + 3]
+            if abs(z - best_z) <= 2 * self.step or low <= z <= high
+        ]
+        if len(zs) < 3:
+            return None
+        vertex = fit_peak(zs, [self.samples[z] for z in zs], self.model)
+        if vertex is None or not low < vertex < high:
+            return None
+        return vertex
+
+    def fit_peak(self, bracket):
+        # True if the fitted peak was confirmed within the tolerance
+        low, high = bracket
+        while self.budget_left():
+            vertex = self.fit_vertex(low, high)
+            if vertex is None:
+                return False
+            if min(abs(vertex - z) for z in self.samples) < self.tolerance:
+                return True
+            best_value = self.best()[1]
+            z, value = self.evaluate(vertex)
+            if value < best_value:
+                return False  # the model missed, narrow the bracket instead
+            low, high = self.neighbours(z)
+        return False  # out of budget before the peak was confirmed
+
+    def neighbours(self, z):
+        zs = sorted(self.samples)
+        index = zs.index(z)
+        low = zs[index - 1] if index > 0 else z
+        high = zs[index + 1] if index < len(zs) - 1 else z
+        return low, high
+
+    def golden_section(self, bracket):
+        # True if the bracket narrowed down to the tolerance
+        low, high = bracket
+        inner_low = high - GOLDEN_RATIO * (high - low)
+        inner_high = low + GOLDEN_RATIO * (high - low)
+        while high - low > self.tolerance and self.budget_left():
+            if self.evaluate(inner_low)[1] >= self.evaluate(inner_high)[1]:
+                high = inner_high
+                inner_high = inner_low
+                inner_low = high - GOLDEN_RATIO * (high - low)
+            else:
+                low = inner_low
+                inner_low = inner_high
+                inner_high = low + GOLDEN_RATIO * (high - low)
+        return high - low <= self.tolerance
@@ -1,3 +1,4 @@
+import io
 import time
 import logging
 import subprocess
@@ -6,28 +7,53 @@ import os
 import shutil
 from camerastreamer.camera_streamer import CameraStreamer
 from camerastreamer.auto_focus import AutoFocus
+from camerastreamer.focus_fusion import FocusFusion
 from communications.printer_com import Printer
 from communications.arduino_com import Arduino
 
-# invokes focus-stack utility by https://github.com/PetteriAimonen/focus-stack
+# the external engine invokes focus-stack utility by
+# https://github.com/PetteriAimonen/focus-stack
+ENGINES = ["native", "external"]
 
 
 class FocusStack:
-    def __init__(self):
+    def __init__(self, engine="native"):
         self.camera = CameraStreamer.get_instance()
         self.printer = Printer.get_instance()
         self.autofocus = AutoFocus()
+        # native: FocusFusion on the captured arrays, external: focus-stack
+        # on the samples saved as JPEG
+        self.engine = engine
 
-    def get_focus_stack_img(self, n_focus=3, step=0.02):
-        # returns the path of the focus stacked image
+    def get_focus_stack_img(self, n_focus=3, step=0.02, save=False):
+        # returns the focus stacked JPEG, its path if it was saved to
+        # ./tmp/fs with the samples and a BytesIO otherwise
         logging.info(f"[FOCUSSTACK] Capturing {n_focus} focus samples")
-        self.clean_tmp_folder("./tmp/fs")
-        work_folder_name = time.strftime("%d-%m-%y--%X")
-        work_path = self.check_tmp_folder(work_folder_name)
-        self.capture_samples(n_focus, step, work_path)
-        output_path = self.run_focus_stack(work_path)
-        logging.info(f"[FOCUSSTACK] Focus stack result {output_path}")
-        return output_path
+        work_path = None
+        if save or self.engine == "external":
+            self.clean_tmp_folder("./tmp/fs")
+            work_folder_name = time.strftime("%d-%m-%y--%X")
+            work_path = self.check_tmp_folder(work_folder_name)
+        images = self.capture_samples(n_focus, step, work_path)
+        if self.engine == "external":
+            output_path = self.run_focus_stack(work_path)
+            logging.info(f"[FOCUSSTACK] Focus stack result {output_path}")
+            return output_path
+        result = self.fuse(images)
+        if work_path is not None:
+            output_path = f"{work_path}/o.jpeg"
+            cv2.imwrite(output_path, result)
+            logging.info(f"[FOCUSSTACK] Focus stack result {output_path}")
+            return output_path
+        status, jpg_img = cv2.imencode(".jpg", result)
+        return io.BytesIO(jpg_img)
+
+    def get_focus_stack_array(self, n_focus=3, step=0.02):
+        # focus stacked BGR array, nothing is written to disk
+        return self.fuse(self.capture_samples(n_focus, step))
+
+    def fuse(self, images):
+        return FocusFusion().fuse(images)
 
     def run_focus_stack(self, work_path="./tmp"):
         photo_list = self.get_photo_list(work_path)
@@ -41,27 +67,37 @@ class FocusStack:
             output_path = f"{work_path}/0.jpeg"
         return output_path
 
-    def capture_samples(self, n_focus, step, work_path):
-        self.autofocus.auto_focus_fine()
+    def capture_samples(self, n_focus, step, work_path=None, autofocus=True):
+        # returns the samples as BGR arrays, the focused one first. They are
+        # also saved as JPEG if there is a work_path
+        if autofocus:
+            self.autofocus.auto_focus_fine()
         focus_per_side = (
             n_focus // 2
         )  # same number of focus sample upwards as downwards
+        images = [self.capture_sample(work_path, 0)]  # max focus sample
         logging.info(f"[FOCUSSTACK] Main sample taken")
-        self.camera.save_photo(filepath=f"{work_path}/0.jpeg")  # max focus sample
         # upwards
         for i in range(1, focus_per_side + 1):
-            self.camera.save_photo(filepath=f"{work_path}/{i}.jpeg")
-            logging.info(f"[FOCUSSTACK] Upward sample {i} taken")
             self.printer.move_zAxis(step)
-            time.sleep(1)
+            self.autofocus.wait_for_stage()
+            images.append(self.capture_sample(work_path, i))
+            logging.info(f"[FOCUSSTACK] Upward sample {i} taken")
         self.printer.move_zAxis(-step * focus_per_side)
         # downwards
         for i in range(1, focus_per_side + 1):
-            self.camera.save_photo(filepath=f"{work_path}/{-i}.jpeg")
-            logging.info(f"[FOCUSSTACK] Downward sample {i} taken")
             self.printer.move_zAxis(-step)
-            time.sleep(1)
+            self.autofocus.wait_for_stage()
+            images.append(self.capture_sample(work_path, -i))
+            logging.info(f"[FOCUSSTACK] Downward sample {i} taken")
         self.printer.move_zAxis(step * focus_per_side)
+        return images
+
+    def capture_sample(self, work_path, index):
+        image = self.camera.get_bgr_photo()
+        if work_path is not None:
+            cv2.imwrite(f"{work_path}/{index}.jpeg", image)
+        return image
 
     def check_tmp_folder(self, dir_path):
         if not os.path.exists(f"./tmp/fs/{dir_path}"):
@@ -0,0 +1,91 @@
+import time
+import logging
+import threading
+import numpy as np
+from camerastreamer.focus_search import fit_peak
+
+
+class FocusSweep:
+    # Autofocus in one continuous z move. The stage crosses the range at a
+    # constant feedrate while the luma frames are scored together with the
+    # time they were published. The z of each frame is interpolated between
+    # the time the move was accepted and the time M400 returned, and the peak
+    # is fitted on the whole curve once the move is over.
+    def __init__(self, camera, printer, metric, latency=None):
+        self.camera = camera
+        self.printer = printer
+        self.metric = metric
+        # seconds between the middle of the exposure and the frame being
+        # published, one frame interval if None
+        self.latency = latency
+        self.samples = []  # (timestamp, focus value)
+        self.curve = []  # (z, focus value) of the last sweep
+
+    def record(self, stop):
+        sequence = 0
+        while not stop.is_set():
+            sequence, timestamp, luma = self.camera.wait_luma(sequence)
+            if luma is not None:
+                self.samples.append((timestamp, self.metric.evaluate(luma)))
+
+    def sweep(self, z_from, z_to, duration=1.5):
+        # returns (z, value) of the fitted focus peak, the stage stays there.
+        # None if no frame was recorded during the move
+        old_feedrate = self.printer.feedrate
+        latency = self.latency
+        if latency is None:
+            latency = 1 / float(self.camera.camera.framerate)
+        self.printer.set_zPos(z_from)
+        self.printer.wait_for_moves()
+        self.camera.wait_until_still()
+
+        feedrate = abs(z_to - z_from) / duration * 60  # mm/min
+        self.samples = []
+        stop = threading.Event()
+        recorder = threading.Thread(target=self.record, args=(stop,), daemon=True)
+        recorder.start()
+        sent = time.time()
+        self.printer.move_to(z=z_to, feed=feedrate)
+        # the move starts once the firmware read the line, before its ok
+        move_start = (sent + time.time()) / 2
+        self.printer.send_command("M400\n")
+        move_end = time.time()
+        stop.set()
+        recorder.join()
+        if old_feedrate:
+            self.printer.set_feedrate(old_feedrate)
+
+        # linear z(t), the slow z move spends little time accelerating
+        speed = (z_to - z_from) / (move_end - move_start)
+        self.curve = [
+            (z_from + speed * (t - latency - move_start), value)
+            for t, value in self.samples
+            if move_start <= t - latency <= move_end
+        ]
+        logging.info(
+            f"[FOCUSSWEEP] {z_from} -> {z_to} in {move_end - move_start:.2f} s, "
+            f"{len(self.curve)} frames"
+        )
+        if not self.curve:
+            self.printer.wait_for_moves()
+            return None
+        peak = self.peak()
+        self.printer.set_zPos(peak[0])
+        self.printer.wait_for_moves()
+        return peak
+
+    def peak(self, neighbours=3):
+        # gaussian fit on the frames around the sharpest one, that frame if
+        # the fit has no maximum inside them
+        zs = np.array([z for z, value in self.curve])
+        values = np.array([value for z, value in self.curve])
+        best = int(np.argmax(values))
+        window = slice(max(best - neighbours, 0), best + neighbours + 1)
+        z_peak = None
+        if len(zs[window]) >= 3:
+            z_peak = fit_peak(zs[window], values[window])
+        if z_peak is None or not min(zs[window]) <= z_peak <= max(zs[window]):
+            z_peak = zs[best]
+        z_peak = round(float(z_peak), 4)
+        logging.info(f"[FOCUSSWEEP] Peak at {z_peak} value: {values[best]}")
+        return z_peak, float(values[best])
@@ -1,16 +1,26 @@
 import time
 import logging
-import cv2
 import os
 import json
 
 
 class Lens:
-    def __init__(self, init_pos, step_stitch, step_focus, magnification):
+    def __init__(
+        self,
+        init_pos,
+        step_stitch,
+        step_focus,
+        magnification,
+        fov_x=None,
+        orientation=None,
+    ):
         self.init_pos = init_pos
         self.step_stitch = step_stitch
         self.step_focus = step_focus
         self.magnification = magnification
+        self.fov_x = fov_x  # mm of sample across the image width
+        # stage axis the image x and y axes go along, "-" when opposite
+        self.orientation = orientation or ["x", "-y"]
 
 
 class LensFactory:
@@ -28,7 +38,11 @@ class LensFactory:
         step_stitch = lens_dict.get("step_stitch")
         step_focus = lens_dict.get("step_focus")
         magnification = magnification
-        return Lens(init_post, step_stitch, step_focus, magnification)
+        fov_x = lens_dict.get("fov_x")
+        orientation = lens_dict.get("orientation")
+        return Lens(
+            init_post, step_stitch, step_focus, magnification, fov_x, orientation
+        )
 
 
 class LensSerializer:
@@ -44,5 +58,7 @@ class LensSerializer:
             "init_pos": lens.init_pos,
             "step_focus": lens.step_focus,
             "magnification": lens.magnification,
+            "fov_x": lens.fov_x,
+            "orientation": lens.orientation,
         }
         return json.dumps(payload)
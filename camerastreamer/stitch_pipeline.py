@@ -0,0 +1,305 @@
+import os
+import time
+import queue
+import logging
+import threading
+import cv2
+import numpy as np
+from camerastreamer.deep_zoom import DeepZoom
+
+
+def reset_peak_rss():
+    # restarts the VmHWM high-water mark of the process (Linux 4.0+), so it
+    # covers what runs from now on and not the whole server. False without
+    # /proc
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    # VmHWM of the process in MB, None without /proc
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024  # kB
+    except OSError:
+        pass
+    return None
+
+
+class StitchPipeline:
+    # Registers tiles while the stage moves on to the next ones. Each tile is
+    # handed over as soon as it is captured and a worker thread phase
+    # correlates it with the neighbours already there, only on the strips
+    # where they overlap according to the stage positions. Once the last
+    # tile arrives only the global placement and the blend remain.
+    def __init__(
+        self,
+        step_mm,
+        fov_x,
+        orientation=("x", "-y"),
+        downsample=4,
+        min_response=0.1,
+        memory_mb=256,
+    ):
+        self.step_mm = step_mm  # (x, y) grid step, for tiles without position
+        self.fov_x = fov_x  # mm covered by the tile width
+        # stage axis the image x and y axes go along, "-" when opposite
+        self.orientation = orientation
+        self.downsample = downsample
+        self.min_response = min_response  # phase correlation peak to trust
+        # blend working set, half for the strip and half for the tile rows
+        # converted to float
+        self.memory_mb = memory_mb
+        self.tile_size = None  # (width, height) in px
+        self.px_per_mm = None
+        # (column, row): (path, downsampled gray float32, stage (x, y) mm)
+        self.tiles = {}
+        self.raw_paths = {}  # (column, row): decoded tile, uncompressed .npy
+        self.pairs = []  # (tile a, tile b, (dx, dy) px, trusted)
+        self.positions = {}  # (column, row): (x, y) px on the mosaic
+        self.register_s = 0
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._work, daemon=True)
+        self.worker.start()
+
+    def add(self, column, row, path, image=None, position=None):
+        # non blocking, the tile file must exist if image is None. position
+        # is the stage (x, y) the tile was taken at, from the grid if None
+        if position is None:
+            position = (column * self.step_mm[0], -row * self.step_mm[1])
+        self.queue.put((column, row, path, image, position))
+
+    def _work(self):
+        while True:
+            tile = self.queue.get()
+            if tile is None:
+                break
+            start_time = time.time()
+            try:
+                self.register(*tile)
+            except Exception as e:
+                logging.warning(f"[PIPELINE] Tile {tile[:2]} not registered: {e}")
+            self.register_s += time.time() - start_time
+
+    def prepare(self, image):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        size = (gray.shape[1] // self.downsample, gray.shape[0] // self.downsample)
+        return cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def register(self, column, row, path, image, position):
+        if image is None:
+            image = cv2.imread(path, 1)
+        if self.tile_size is None:
+            self.tile_size = (image.shape[1], image.shape[0])
+            self.px_per_mm = self.tile_size[0] / self.fov_x
+        tile = (column, row)
+        self.tiles[tile] = (path, self.prepare(image), position)
+        # decoded once here, the blend reads row slices of it memory mapped
+        self.raw_paths[tile] = f"{os.path.splitext(path)[0]}.npy"
+        np.save(self.raw_paths[tile], image)
+        for neighbour in [
+            (column - 1, row),
+            (column + 1, row),
+            (column, row - 1),
+            (column, row + 1),
+        ]:
+            if neighbour in self.tiles:
+                # left/top tile first
+                a, b = sorted([neighbour, tile], key=lambda t: (t[1], t[0]))
+                self.pairs.append((a, b) + self.register_pair(a, b))
+
+    def nominal_px(self, tile):
+        # mosaic px of a tile from its stage position and the orientation
+        stage = dict(zip("xy", self.tiles[tile][2]))
+        px = []
+        for axis in self.orientation:
+            sign = -1 if axis.startswith("-") else 1
+            px.append(sign * stage[axis[-1]] * self.px_per_mm)
+        return tuple(px)
+
+    def register_pair(self, a, b):
+        # offset in px of tile b from tile a and whether it was measured
+        nominal_a = self.nominal_px(a)
+        nominal_b = self.nominal_px(b)
+        nominal = (nominal_b[0] - nominal_a[0], nominal_b[1] - nominal_a[1])
+        # the overlap is along the image axis the stage moved on, with the
+        # tile on its left/top side as a
+        axis = 0 if abs(nominal[0]) >= abs(nominal[1]) else 1
+        if nominal[axis] < 0:
+            (dx, dy), trusted = self.register_pair(b, a)
+            return (-dx, -dy), trusted
+        horizontal = axis == 0
+        small_a = self.tiles[a][1]
+        small_b = self.tiles[b][1]
+        step = int(round(nominal[axis] / self.downsample))
+        overlap = small_a.shape[1 - axis] - step
+        if step <= 0 or overlap < 16:
+            return nominal, False
+        if horizontal:
+            strip_a = small_a[:, step:]
+            strip_b = small_b[:, :overlap]
+        else:
+            strip_a = small_a[step:, :]
+            strip_b = small_b[:overlap, :]
+        window = cv2.createHanningWindow(
+            (strip_a.shape[1], strip_a.shape[0]), cv2.CV_32F
+        )
+        (shift_x, shift_y), response = cv2.phaseCorrelate(strip_a, strip_b, window)
+        if response < self.min_response or max(abs(shift_x), abs(shift_y)) > (
+            overlap / 2
+        ):
+            return nominal, False
+        offset = [step * self.downsample * (1 - axis), step * self.downsample * axis]
+        return (
+            offset[0] - shift_x * self.downsample,
+            offset[1] - shift_y * self.downsample,
+        ), True
+
+    def solve(self):
+        # least squares placement from the pair offsets, the stage positions
+        # keep tiles without a trusted pair in place
+        tiles = sorted(self.tiles, key=lambda t: (t[1], t[0]))
+        index = {tile: i for i, tile in enumerate(tiles)}
+        rows = []
+        targets = []
+        weights = []
+        for a, b, offset, trusted in self.pairs:
+            row = np.zeros(len(tiles))
+            row[index[b]] = 1
+            row[index[a]] = -1
+            rows.append(row)
+            targets.append(offset)
+            weights.append(1.0 if trusted else 0.1)
+        for tile in tiles:
+            row = np.zeros(len(tiles))
+            row[index[tile]] = 1
+            rows.append(row)
+            targets.append(self.nominal_px(tile))
+            weights.append(0.01)
+        sqrt_weights = np.sqrt(np.array(weights))[:, None]
+        solution, residuals, rank, singular = np.linalg.lstsq(
+            np.array(rows) * sqrt_weights,
+            np.array(targets, dtype=np.float64) * sqrt_weights,
+            rcond=None,
+        )
+        solution -= solution.min(axis=0)
+        self.positions = {
+            tile: (int(round(x)), int(round(y)))
+            for tile, (x, y) in zip(tiles, solution)
+        }
+
+    @staticmethod
+    def ramp(length):
+        # feather weight falling linearly to the tile borders
+        ramp = np.minimum(np.arange(length) + 1, length - np.arange(length))
+        return ramp.astype(np.float32)
+
+    def read_tile(self, tile):
+        # only the rows sliced from the map are read from disk
+        return np.load(self.raw_paths[tile], mmap_mode="r")
+
+    def remove_raw(self):
+        for raw_path in self.raw_paths.values():
+            if os.path.exists(raw_path):
+                os.remove(raw_path)
+        self.raw_paths = {}
+
+    def blend(self, output_path):
+        # the mosaic is blended in float32 one strip of rows at a time into a
+        # uint8 canvas memory mapped on disk, the working set stays within
+        # memory_mb whatever the size of the scan
+        width, height = self.tile_size
+        canvas_width = max(x for x, y in self.positions.values()) + width
+        canvas_height = max(y for x, y in self.positions.values()) + height
+        canvas_path = f"{os.path.splitext(output_path)[0]}.canvas"
+        canvas = np.memmap(
+            canvas_path,
+            dtype=np.uint8,
+            mode="w+",
+            shape=(canvas_height, canvas_width, 3),
+        )
+        try:
+            # 16 bytes per px, bgr and weight in float32
+            budget = self.memory_mb * 1024 * 1024 // 2
+            strip_height = min(max(budget // (canvas_width * 16), 16), canvas_height)
+            ramp_x = self.ramp(width)
+            ramp_y = self.ramp(height)
+            for top in range(0, canvas_height, strip_height):
+                bottom = min(top + strip_height, canvas_height)
+                strip = np.zeros((bottom - top, canvas_width, 3), dtype=np.float32)
+                total_weight = np.zeros((bottom - top, canvas_width), dtype=np.float32)
+                for tile, (x, y) in self.positions.items():
+                    y0 = max(top, y)
+                    y1 = min(bottom, y + height)
+                    if y0 >= y1:
+                        continue
+                    rows = self.read_tile(tile)[y0 - y : y1 - y]
+                    weight = np.outer(ramp_y[y0 - y : y1 - y], ramp_x)
+                    strip[y0 - top : y1 - top, x : x + width] += (
+                        rows.astype(np.float32) * weight[:, :, None]
+                    )
+                    total_weight[y0 - top : y1 - top, x : x + width] += weight
+                strip /= np.maximum(total_weight, 1e-6)[:, :, None]
+                canvas[top:bottom] = strip.astype(np.uint8)
+            canvas.flush()
+            return self.save(canvas, output_path)
+        finally:
+            del canvas
+            os.remove(canvas_path)
+
+    def save(self, canvas, output_path):
+        if output_path.endswith(".dzi"):
+            return DeepZoom().save(canvas, output_path)
+        try:
+            if cv2.imwrite(output_path, canvas):
+                return output_path
+        except cv2.error as e:
+            logging.warning(f"[PIPELINE] {e}")
+        # JPEG stops at 65535 px a side
+        logging.warning("[PIPELINE] Mosaic not saved as JPEG, use the dzi output")
+        return "error"
+
+    def finish(self, output_path):
+        # waits for the queued tiles, places and blends them
+        wait_start = time.time()
+        self.queue.put(None)
+        self.worker.join()
+        wait_s = time.time() - wait_start
+        if not self.tiles:
+            logging.warning("[PIPELINE] No tiles to stitch")
+            self.remove_raw()
+            return "error"
+        trusted = sum(1 for pair in self.pairs if pair[3])
+        if trusted * 2 < len(self.pairs):
+            # the overlaps come from fov_x, a wrong one misses most of them
+            logging.warning(
+                f"[PIPELINE] Only {trusted}/{len(self.pairs)} pairs registered, "
+                f"check the lens fov_x ({self.fov_x} mm)"
+            )
+        # the peak RSS while placing and blending, the capture streams keep
+        # running so it includes their buffers
+        measured = reset_peak_rss()
+        try:
+            start_time = time.time()
+            self.solve()
+            solve_s = time.time() - start_time
+            start_time = time.time()
+            result = self.blend(output_path)
+            blend_s = time.time() - start_time
+        finally:
+            self.remove_raw()
+        peak_mb = peak_rss_mb() if measured else None
+        peak = "unknown" if peak_mb is None else f"{peak_mb:.0f} MB"
+        logging.info(
+            f"[PIPELINE] {len(self.tiles)} tiles, {trusted}/{len(self.pairs)} pairs "
+            f"registered in {self.register_s:.2f} s (waited {wait_s:.2f} s), "
+            f"solve {solve_s:.2f} s, blend {blend_s:.2f} s, "
+            f"peak RSS {peak}"
+        )
+        return result
@@ -1,4 +1,6 @@
+import re
 import time
+import json
 import logging
 import threading
 import subprocess
@@ -8,12 +10,28 @@ import shutil
 from camerastreamer.camera_streamer import CameraStreamer
 from camerastreamer.auto_focus import AutoFocus
 from camerastreamer.focus_stack import FocusStack
+from camerastreamer.focus_fusion import FocusFusion
+from camerastreamer.focus_map import FocusMap
+from camerastreamer.stitch_pipeline import StitchPipeline
+from camerastreamer.deep_zoom import DeepZoom
 from communications.printer_com import Printer
 from communications.arduino_com import Arduino
 
+BACKENDS = ["native", "hugin", "opencv"]
+OUTPUTS = ["jpeg", "dzi"]
+TILE_REGEX = re.compile(r"^c(\d+)_r(\d+)\.tif$")
+
 
 class Stitcher:
-    def __init__(self, fov_x=3, fov_y=3, step_per_fov=0.7):
+    def __init__(
+        self,
+        fov_x=3,
+        fov_y=3,
+        step_per_fov=0.7,
+        focus_map=True,
+        backend="hugin",
+        output="jpeg",
+    ):
         self.camera = CameraStreamer.get_instance()
         self.printer = Printer.get_instance()
         self.arduino = Arduino.get_instance()
@@ -22,6 +40,19 @@ class Stitcher:
         self.step_per_fov = step_per_fov
         self.image_list = []
         self.threads_list = []
+        self.fs_samples = 3  # focus stack samples per tile
+        self.fs_step = 0.02  # mm between them
+        # predicted z per tile from a few anchors instead of per tile autofocus
+        self.use_focus_map = focus_map
+        self.focus_map = None
+        # hugin: xy-stitch after, native: tiles are registered while
+        # capturing (needs a calibrated fov_x), opencv: cv2.Stitcher feature
+        # matching after
+        self.backend = backend
+        self.pipeline = None
+        self.tile_positions = {}  # photo name: stage (x, y) it was taken at
+        # jpeg: single/out.jpg, dzi: single/out.dzi and its tiles for viewers
+        self.output = output
 
     def stitch(self, pattern):
         old_feedrate = self.printer.feedrate
@@ -31,15 +62,20 @@ class Stitcher:
         self.printer.set_feedrate(100)
         self.image_list = []
         start_time = time.time()
+        self.start_pipeline()
         if pattern == 0:
             self.get_images_list_2_pattern(work_path)
         else:
             self.get_images_list_Z_pattern(work_path)
         print(self.image_list)
-        self.run_stitch(work_path)
+        self.save_tiles(work_path)
+        logging.info(f"[STITCHER] Capture time: {time.time() - start_time} s")
+        output_path = self.run_stitch(work_path)
+        if output_path == "error":
+            return "error"
         elapsed_s = time.time() - start_time
         logging.info(f"[STITCHER] Done total time: {elapsed_s} s")
-        return f"{work_path}/single/out.jpg"
+        return output_path
 
     def focus_stack_stitch(self, pattern):
         old_feedrate = self.printer.feedrate
@@ -48,162 +84,311 @@ class Stitcher:
         work_path = self.check_tmp_folder(work_folder_name)
         self.printer.set_feedrate(100)
         start_time = time.time()
+        self.start_pipeline()
         if pattern == 0:
-            self.get_fs_image_list_2_pattern(3, work_path=work_path)
+            self.get_fs_image_list_2_pattern(work_path)
         else:
-            self.get_fs_image_list_Z_pattern(3, work_path=work_path)
-        self.run_stitch(work_path)
+            self.get_fs_image_list_Z_pattern(work_path)
+        self.save_tiles(work_path)
+        logging.info(f"[STITCHER-FS] Capture time: {time.time() - start_time} s")
+        output_path = self.run_stitch(work_path)
+        if output_path == "error":
+            return "error"
         elapsed_s = time.time() - start_time
         logging.info(f"[STITCHER-FS] Done total time: {elapsed_s} s")
-        return f"{work_path}/single/out.jpg"
+        return output_path
 
-    def get_images_list_2_pattern(self, work_path, wait_per_frame=3):
+    def get_images_list_2_pattern(self, work_path):
         photo_name = ""
         old_xPos = self.printer.xPos
         old_yPos = self.printer.yPos
         step_xAxis = self.step_per_fov
         step_yAxis = (self.step_per_fov * 3) / 4  # keep aspect ratio as images are 4/3
+        self.build_focus_map(step_xAxis, step_yAxis)
         logging.info(f"[STITCHER2]: Capturing {self.fovs[0]}x{self.fovs[1]} FoVs")
         for i in range(0, self.fovs[1]):
             for j in range(0, self.fovs[0]):
-                self.autofocus.auto_focus_fine()
-                time.sleep(wait_per_frame)
+                self.focus_tile()
+                self.autofocus.wait_for_stage()
                 sample = self.camera.get_opencv_from_stream()
+                position = (self.printer.xPos, self.printer.yPos)
                 if j < self.fovs[0] - 1:
                     self.printer.move_xAxis(step_xAxis)
                 photo_name = photo_name = self.get_photo_name(i, j, 0)
                 logging.info(f"[STITCHER2]: Saving {photo_name}")
                 cv2.imwrite(f"{work_path}/{photo_name}", sample)
                 self.image_list.append(f"{photo_name}")
+                self.add_tile(i, j, 0, f"{work_path}/{photo_name}", sample, position)
             step_xAxis = -step_xAxis
             logging.info(f"[STITCHER2]: 2 Pattern changing xStep to: {step_xAxis}")
             self.printer.move_yAxis(-step_yAxis)
-            time.sleep(1)
 
-        self.printer.set_xPos(old_xPos)
-        self.printer.set_yPos(old_yPos)
+        self.printer.move_to(x=old_xPos, y=old_yPos)
         
 
-    def get_images_list_Z_pattern(self, work_path, wait_per_frame=3):
+    def get_images_list_Z_pattern(self, work_path):
         photo_name = ""
         old_xPos = self.printer.xPos
         old_yPos = self.printer.yPos
         step_xAxis = self.step_per_fov
         step_yAxis = (self.step_per_fov * 3) / 4  # keep aspect ratio as images are 4/3
+        self.build_focus_map(step_xAxis, step_yAxis)
         logging.info(f"[STITCHERZ]: Capturing {self.fovs[0]}x{self.fovs[1]} FoVs")
         for i in range(0, self.fovs[1]):
             for j in range(0, self.fovs[0]):
-                self.autofocus.auto_focus_fine()
-                time.sleep(wait_per_frame)
+                self.focus_tile()
+                self.autofocus.wait_for_stage()
                 sample = self.camera.get_opencv_from_stream()
+                position = (self.printer.xPos, self.printer.yPos)
                 if j < self.fovs[0] - 1:
                     self.printer.move_xAxis(step_xAxis)
                 photo_name = photo_name = self.get_photo_name(i, j, 1)                  
                 logging.info(f"[STITCHERZ]: Saving {photo_name}")
                 cv2.imwrite(f"{work_path}/{photo_name}", sample)
                 self.image_list.append(photo_name)
-            self.printer.set_xPos(old_xPos)
-            self.printer.move_yAxis(-step_yAxis)
-            time.sleep(1)
+                self.add_tile(i, j, 1, f"{work_path}/{photo_name}", sample, position)
+            # back to the row start and down in one diagonal move
+            self.printer.move_to(x=old_xPos, y=self.printer.yPos - step_yAxis)
 
-        self.printer.set_xPos(old_xPos)
-        self.printer.set_yPos(old_yPos)
+        self.printer.move_to(x=old_xPos, y=old_yPos)
 
-    def get_fs_image_list_2_pattern(self, wait_per_frame, work_path):
+    def get_fs_image_list_2_pattern(self, work_path):
         images = []
         focus_stack = FocusStack()
         old_xPos = self.printer.xPos
         old_yPos = self.printer.yPos
         step_xAxis = self.step_per_fov
         step_yAxis = (self.step_per_fov * 3) / 4  # keep aspect ratio as images are 4/3
+        self.build_focus_map(step_xAxis, step_yAxis)
         logging.info(f"[STITCHER-FS2]: Capturing FS {self.fovs[0]}x{self.fovs[1]} FoVs")
         for i in range(0, self.fovs[1]):
-            self.create_work_folder(work_path, i)
             for j in range(0, self.fovs[0]):
-                work_folder = self.create_work_folder(f"{work_path}/{i}", j)
-                self.autofocus.auto_focus_fine()
-                time.sleep(wait_per_frame)
-                focus_stack.capture_samples(3, work_folder)  # image capture
-                self.threads_list.append(
-                    threading.Thread(
-                        target=self._thread_focus_stack,
-                        args=(work_path, work_folder, i, j,0),
-                    )
-                )  # focus stack processing
-                self.threads_list[j + (i * self.fovs[1])].start()
+                self.focus_tile()
+                self.autofocus.wait_for_stage()
+                samples = focus_stack.capture_samples(
+                    self.fs_samples, self.fs_step, autofocus=False
+                )  # image capture, the samples stay in memory
+                position = (self.printer.xPos, self.printer.yPos)
+                self.start_focus_stack(work_path, samples, i, j, 0, position)
                 if j < self.fovs[0] - 1:
                     self.printer.move_xAxis(step_xAxis)
 
             step_xAxis = -step_xAxis
             logging.info(f"[STITCHER-FS2]: 2 Patern changing xStep to: {step_xAxis}")
             self.printer.move_yAxis(-step_yAxis)
-            time.sleep(1)
         self.wait_threads()
-        self.printer.set_xPos(old_xPos)
-        self.printer.set_yPos(old_yPos)
+        self.printer.move_to(x=old_xPos, y=old_yPos)
         
-    def get_fs_image_list_Z_pattern(self, wait_per_frame, work_path):
+    def get_fs_image_list_Z_pattern(self, work_path):
         images = []
         focus_stack = FocusStack()
         old_xPos = self.printer.xPos
         old_yPos = self.printer.yPos
         step_xAxis = self.step_per_fov
         step_yAxis = (self.step_per_fov * 3) / 4  # keep aspect ratio as images are 4/3
+        self.build_focus_map(step_xAxis, step_yAxis)
         logging.info(f"[STITCHER-FSZ]: Capturing FS {self.fovs[0]}x{self.fovs[1]} FoVs")
         for i in range(0, self.fovs[1]):
-            self.create_work_folder(work_path, i)
             for j in range(0, self.fovs[0]):
-                work_folder = self.create_work_folder(f"{work_path}/{i}", j)
-                self.autofocus.auto_focus_fine()
-                time.sleep(wait_per_frame)
-                focus_stack.capture_samples(3, work_folder)  # image capture
-                self.threads_list.append(
-                    threading.Thread(
-                        target=self._thread_focus_stack,
-                        args=(work_path, work_folder, i, j,1),
-                    )
-                )  # focus stack processing
-                self.threads_list[j + (i * self.fovs[1])].start()
+                self.focus_tile()
+                self.autofocus.wait_for_stage()
+                samples = focus_stack.capture_samples(
+                    self.fs_samples, self.fs_step, autofocus=False
+                )  # image capture, the samples stay in memory
+                position = (self.printer.xPos, self.printer.yPos)
+                self.start_focus_stack(work_path, samples, i, j, 1, position)
                 if j < self.fovs[0] - 1:
                     self.printer.move_xAxis(step_xAxis)
 
-            self.printer.set_xPos(old_xPos)
-            self.printer.move_yAxis(-step_yAxis)
-            time.sleep(1)
+            # back to the row start and down in one diagonal move
+            self.printer.move_to(x=old_xPos, y=self.printer.yPos - step_yAxis)
         self.wait_threads()
-        self.printer.set_xPos(old_xPos)
-        self.printer.set_yPos(old_yPos)
+        self.printer.move_to(x=old_xPos, y=old_yPos)
 
-    def _thread_focus_stack(self, work_path, work_folder, row, column,pattern):
-        focus_stack = FocusStack()
-        output_path = focus_stack.run_focus_stack(work_folder)
-        result = cv2.imread(output_path, 1)
+    def build_focus_map(self, step_xAxis, step_yAxis):
+        # anchors over the raster area, the stage is back at the start after
+        self.focus_map = None
+        if not self.use_focus_map:
+            return
+        x0 = self.printer.xPos
+        y0 = self.printer.yPos
+        focus_map = FocusMap(self.autofocus)
+        if focus_map.build(
+            (x0, x0 + (self.fovs[0] - 1) * step_xAxis),
+            (y0, y0 - (self.fovs[1] - 1) * step_yAxis),
+            self.fovs,
+        ):
+            self.focus_map = focus_map
+            self.printer.move_to(x=x0, y=y0)
+
+    def focus_tile(self):
+        if self.focus_map is None:
+            self.autofocus.auto_focus_fine()
+        else:
+            self.focus_map.focus_tile(self.printer.xPos, self.printer.yPos)
+
+    def start_focus_stack(self, work_path, samples, row, column, pattern, position):
+        # one tile is fused while the next one is captured, waiting for the
+        # previous keeps a single stack of samples in memory
+        if self.threads_list:
+            self.threads_list[-1].join()
+        self.threads_list.append(
+            threading.Thread(
+                target=self._thread_focus_stack,
+                args=(work_path, samples, row, column, pattern, position),
+            )
+        )  # focus stack processing
+        self.threads_list[-1].start()
+
+    def _thread_focus_stack(self, work_path, samples, row, column, pattern, position):
+        result = FocusFusion().fuse(samples)
         photo_name = self.get_photo_name(row, column,pattern)
         cv2.imwrite(f"{work_path}/{photo_name}", result)
         self.image_list.append(f"{photo_name}")
+        self.add_tile(
+            row, column, pattern, f"{work_path}/{photo_name}", result, position
+        )
         logging.info(f"[STITCHER-FS]: Saving {photo_name}")
 
     def get_photo_name(self,row, column,pattern):
-        if pattern == 0:
-            if row % 2:
-                # impar
-                photo_name = f"c{format(self.fovs[0]-1-column,'04')}_r{format(row,'04')}.tif"
-            else:
-                photo_name = f"c{format(column,'04')}_r{format(row,'04')}.tif"
-        else:
-            photo_name = f"c{format(column,'04')}_r{format(row,'04')}.tif"
+        column = self.get_grid_column(row, column, pattern)
+        photo_name = f"c{format(column,'04')}_r{format(row,'04')}.tif"
         return photo_name
 
+    def get_grid_column(self, row, column, pattern):
+        # the 2 pattern captures odd rows right to left
+        if pattern == 0 and row % 2:
+            return self.fovs[0] - 1 - column
+        return column
+
+    def start_pipeline(self):
+        self.pipeline = None
+        if self.backend != "native":
+            return
+        lens = self.printer.lens
+        if lens is None or lens.fov_x is None:
+            logging.warning("[STITCHER] Lens without fov_x, stitching with hugin")
+            self.backend = "hugin"
+            return
+        step_xAxis = self.step_per_fov
+        step_yAxis = (self.step_per_fov * 3) / 4
+        self.pipeline = StitchPipeline(
+            (step_xAxis, step_yAxis), lens.fov_x, tuple(lens.orientation)
+        )
+
+    def add_tile(self, row, column, pattern, path, image, position):
+        # registration starts while the stage moves to the next tile
+        self.tile_positions[os.path.basename(path)] = position
+        if self.pipeline is not None:
+            column = self.get_grid_column(row, column, pattern)
+            self.pipeline.add(column, row, path, image, position)
+
+    def save_tiles(self, work_path):
+        # stage positions of the tiles, to stitch them again with restitch
+        lens = self.printer.lens
+        tiles = {
+            "fov_x": lens.fov_x if lens is not None else None,
+            "orientation": lens.orientation if lens is not None else None,
+            "step": [self.step_per_fov, (self.step_per_fov * 3) / 4],
+            "positions": self.tile_positions,
+        }
+        with open(f"{work_path}/tiles.json", "w") as f:
+            json.dump(tiles, f, indent=4)
+
+    def restitch(self, work_folder_name):
+        # stitches the tiles of a previous capture again with self.backend,
+        # to compare the backends on the same images
+        work_path = f"./tmp/stitch/{work_folder_name}"
+        if not os.path.isdir(work_path):
+            logging.warning(f"[STITCHER] No capture at {work_path}")
+            return "error"
+        tiles = {"fov_x": None, "step": None, "positions": {}}
+        if os.path.exists(f"{work_path}/tiles.json"):
+            with open(f"{work_path}/tiles.json") as f:
+                tiles = json.load(f)
+        self.image_list = sorted(
+            name for name in os.listdir(work_path) if TILE_REGEX.match(name)
+        )
+        self.pipeline = None
+        if self.backend == "native":
+            fov_x = tiles["fov_x"]
+            orientation = tiles.get("orientation")
+            if self.printer.lens is not None:
+                fov_x = fov_x or self.printer.lens.fov_x
+                orientation = orientation or self.printer.lens.orientation
+            if fov_x is None:
+                logging.warning("[STITCHER] Lens without fov_x, stitching with hugin")
+                self.backend = "hugin"
+            else:
+                step = tiles["step"] or [self.step_per_fov, (self.step_per_fov * 3) / 4]
+                self.pipeline = StitchPipeline(
+                    tuple(step), fov_x, tuple(orientation or ("x", "-y"))
+                )
+                for name in self.image_list:
+                    column, row = TILE_REGEX.match(name).groups()
+                    position = tiles["positions"].get(name)
+                    self.pipeline.add(
+                        int(column),
+                        int(row),
+                        f"{work_path}/{name}",
+                        position=tuple(position) if position else None,
+                    )
+        logging.info(
+            f"[STITCHER] Stitching {len(self.image_list)} tiles of {work_folder_name}"
+        )
+        return self.run_stitch(work_path)
+
     def wait_threads(self):
         for thread in self.threads_list:
             thread.join()
         logging.info(f"[STITCHER]: Threads joined")
 
     def run_stitch(self, work_path):
+        # every backend writes single/out.jpg or single/out.dzi, returns its
+        # path or "error" if it failed
+        start_time = time.time()
+        os.makedirs(f"{work_path}/single", exist_ok=True)
+        output_path = f"{work_path}/single/out.jpg"
+        dzi_path = f"{work_path}/single/out.dzi"
+        if self.pipeline is not None:
+            # the native mosaic goes to the tiles without a full JPEG
+            result = self.pipeline.finish(
+                dzi_path if self.output == "dzi" else output_path
+            )
+        elif self.backend == "opencv":
+            result = self.run_opencv_stitch(work_path, output_path)
+        else:
+            result = self.run_hugin_stitch(work_path, output_path)
+        elapsed_s = time.time() - start_time
+        logging.info(
+            f"[STITCHER] {self.backend} stitched {len(self.image_list)} tiles "
+            f"in {elapsed_s:.2f} s"
+        )
+        if result == output_path and self.output == "dzi":
+            start_time = time.time()
+            result = DeepZoom().save(cv2.imread(output_path, 1), dzi_path)
+            logging.info(f"[STITCHER] DeepZoom in {time.time() - start_time:.2f} s")
+        return result
+
+    def run_hugin_stitch(self, work_path, output_path):
         args = ["xy-stitch"] + self.image_list
         status = subprocess.run(args, cwd=work_path)
         args = ["xy-ts"] + ["--ignore-crop"]
         status = subprocess.run(args, cwd=work_path)
+        if not os.path.exists(output_path):
+            return "error"
+        return output_path
+
+    def run_opencv_stitch(self, work_path, output_path):
+        images = [cv2.imread(f"{work_path}/{name}", 1) for name in self.image_list]
+        stitcher = cv2.Stitcher_create(cv2.Stitcher_SCANS)
+        stitcher.setPanoConfidenceThresh(0.2)
+        status, stitched = stitcher.stitch(images)
+        logging.info(f"[STITCHER]: Panorama status {status}")
+        if status != cv2.Stitcher_OK:
+            return "error"
+        cv2.imwrite(output_path, stitched)
+        return output_path
 
     def check_tmp_folder(self, dir_path):
         if not os.path.exists(f"./tmp/stitch/{dir_path}"):
@@ -216,8 +401,3 @@ class Stitcher:
         if len(folder_list) > 10:
             for folder_name in folder_list[:10]:
                 shutil.rmtree(os.path.join(dir_path, folder_name))
-
-    def create_work_folder(self, dir_path, index):
-        if not os.path.exists(f"{dir_path}/{index}"):
-            os.mkdir(f"{dir_path}/{index}")
-        return f"{dir_path}/{index}"
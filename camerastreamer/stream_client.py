@@ -0,0 +1,113 @@
+import time
+import threading
+import itertools
+
+
+class StreamClient:
+    # Bookkeeping of one MJPEG viewer. A viewer always gets the newest frame
+    # once it is ready for one, frames published while it was still sending
+    # the previous one (slow socket) or waiting for its fps limit are dropped.
+    def __init__(self, client_id, stream, address, max_fps):
+        self.client_id = client_id
+        self.stream = stream
+        self.address = address
+        self.max_fps = max_fps
+        self.target_fps = max_fps  # lowered by AdaptiveQuality on slow links
+        self.link_rate = None  # bytes/s measured while writing frames
+        self.connected_at = time.time()
+        # writes of the current throughput window
+        self.rate_window = 2
+        self.window_start = self.connected_at
+        self.window_bytes = 0
+        self.window_seconds = 0
+        self.sequence = 0  # sequence of the last delivered frame
+        self.next_frame_time = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.bytes_sent = 0
+
+    def wait_time(self):
+        # seconds until the fps limit allows another frame
+        return max(0, self.next_frame_time - time.time())
+
+    def deliver(self, sequence, frame, sent_at):
+        # called once the frame has been written to the client, sent_at is
+        # when the write started and paces the next frame
+        if self.sequence and sequence > self.sequence + 1:
+            self.dropped += sequence - self.sequence - 1
+        self.sequence = sequence
+        self.delivered += 1
+        self.bytes_sent += len(frame)
+        if self.target_fps:
+            self.next_frame_time = sent_at + 1 / self.target_fps
+
+    def written(self, size, seconds):
+        # the write of a frame took seconds. A single write mostly times the
+        # socket buffer, the link rate is measured over the writes of a
+        # rate_window seconds window
+        self.window_bytes += size
+        self.window_seconds += seconds
+        now = time.time()
+        if now - self.window_start >= self.rate_window:
+            self.link_rate = self.window_bytes / max(self.window_seconds, 0.001)
+            self.window_start = now
+            self.window_bytes = 0
+            self.window_seconds = 0
+
+    def to_dict(self):
+        return {
+            "id": self.client_id,
+            "stream": self.stream,
+            "address": self.address,
+            "max_fps": self.max_fps,
+            "target_fps": round(self.target_fps, 1),
+            "link_kbps": (
+                None if self.link_rate is None else round(self.link_rate * 8 / 1000)
+            ),
+            "connected_s": round(time.time() - self.connected_at, 1),
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "bytes_sent": self.bytes_sent,
+        }
+
+
+class StreamClients:
+    __instance__ = None
+
+    def __init__(self):
+        if StreamClients.__instance__ is None:
+            self.clients = {}
+            self.lock = threading.Lock()
+            self.ids = itertools.count(1)
+            self.default_max_fps = 15
+            self.max_fps_limit = 30
+            StreamClients.__instance__ = self
+        else:
+            raise Exception("StreamClients is a singleton")
+
+    @staticmethod
+    def get_instance():
+        if not StreamClients.__instance__:
+            StreamClients()
+        return StreamClients.__instance__
+
+    def add(self, stream, address, max_fps=None):
+        if max_fps is None or max_fps <= 0:
+            max_fps = self.default_max_fps
+        max_fps = min(max_fps, self.max_fps_limit)
+        with self.lock:
+            client = StreamClient(next(self.ids), stream, address, max_fps)
+            self.clients[client.client_id] = client
+        return client
+
+    def remove(self, client):
+        with self.lock:
+            self.clients.pop(client.client_id, None)
+
+    def get_clients(self):
+        with self.lock:
+            return list(self.clients.values())
+
+    def to_list(self):
+        with self.lock:
+            return [client.to_dict() for client in self.clients.values()]
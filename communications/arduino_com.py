@@ -1,6 +1,7 @@
 import time
 import serial
 import logging
+from communications.serial_worker import SerialWorker
 
 SERIAL_SPEED = 115200
 
@@ -8,51 +9,91 @@ SERIAL_SPEED = 115200
 class Arduino:
     __instance__ = None
 
-    def __init__(self, serial_port):
+    def __init__(self, serial_port, ser=None):
         if Arduino.__instance__ is None:
             self.serial_port = serial_port
             self.bottom_light = False
             self.rgbw_ring = [0, 0, 0, 255]
-            self.ser = serial.Serial(self.serial_port, SERIAL_SPEED)
-            time.sleep(5)  # new serial connection makes the printer resets it self
+            if ser is None:
+                self.ser = serial.Serial(self.serial_port, SERIAL_SPEED, timeout=2)
+                time.sleep(5)  # new serial connection makes the printer resets it self
+            else:
+                self.ser = ser  # already open and answering, no reset wait
+                self.ser.reset_input_buffer()
+            # one answer line per command, commands go out one at a time
+            self.worker = SerialWorker(self.ser, "Arduino", window=1)
             Arduino.__instance__ = self
         else:
             raise Exception("There's only one Arduino!!")
 
     @staticmethod
-    def get_instance(serial_port=None):
+    def get_instance(serial_port=None, ser=None):
         if not Arduino.__instance__:
             if serial_port is not None:
-                Arduino(serial_port)
+                Arduino(serial_port, ser)
         return Arduino.__instance__
 
+    def led_state(self):
+        # hashable snapshot of the lights, part of the focus cache key
+        ring = tuple(
+            tuple(light) if isinstance(light, list) else light
+            for light in self.rgbw_ring
+        )
+        return self.bottom_light, ring
+
     def send_command(self, comm):
         logging.info(f"[Arduino] Sending com: {comm[:-1]}")
-        self.ser.write(comm.encode())
-        response = self.ser.readline().decode()
+        response = self.worker.send(comm).result()[-1]
         logging.info(f"[Arduino] Response: {response[:-1]}")
+        return response
+
+    def queue_command(self, comm):
+        # non blocking, returns a Future with the response lines
+        logging.info(f"[Arduino] Queueing com: {comm[:-1]}")
+        return self.worker.send(comm)
+
+    def run_command(self, comm, on_done, wait=True):
+        # on_done updates the tracked state once the Arduino answered.
+        # Returns the response line, or the Future when wait is False
+        if wait:
+            response = self.send_command(comm)
+            on_done()
+            return response
+        future = self.queue_command(comm)
+        future.add_done_callback(lambda future: on_done())
+        return future
 
-    def bottom_lights_on(self):
-        self.send_command("L012 1\n")
-        logging.info("[Arduino] Bottom Light ON")
-        self.bottom_light = True
+    def bottom_lights_on(self, wait=True):
+        def on_done():
+            logging.info("[Arduino] Bottom Light ON")
+            self.bottom_light = True
+
+        return self.run_command("L012 1\n", on_done, wait)
+
+    def bottom_lights_off(self, wait=True):
+        def on_done():
+            logging.info("[Arduino] Bottom Light OFF")
+            self.bottom_light = False
 
-    def bottom_lights_off(self):
-        self.send_command("L012 0\n")
-        logging.info("[Arduino] Bottom Light OFF")
-        self.bottom_light = False
+        return self.run_command("L012 0\n", on_done, wait)
 
-    def set_rgbw_ring(self, red, green, blue, white):
+    def set_rgbw_ring(self, red, green, blue, white, wait=True):
         # L008 Rxxx Gxxx Bxxx Wxxx
         comm = f"R{str(red).zfill(3)} G{str(green).zfill(3)} B{str(blue).zfill(3)} W{str(white).zfill(3)}"
-        self.send_command(f"L008 {comm}\n")
-        logging.info(f"[Arduino] RGBW Lights: {comm}")
-        for light in range(len(self.rgbw_ring)):
-            self.rgbw_ring[light] = [red, green, blue, white]
 
-    def set_rgbw_light(self, red, green, blue, white, light):
+        def on_done():
+            logging.info(f"[Arduino] RGBW Lights: {comm}")
+            for light in range(len(self.rgbw_ring)):
+                self.rgbw_ring[light] = [red, green, blue, white]
+
+        return self.run_command(f"L008 {comm}\n", on_done, wait)
+
+    def set_rgbw_light(self, red, green, blue, white, light, wait=True):
         # L008 Rxxx Gxxx Bxxx Wxxx Lxx
         comm = f"R{str(red).zfill(3)} G{str(green).zfill(3)} B{str(blue).zfill(3)} W{str(white).zfill(3)} L {str(light).zfill(2)}"
-        self.send_command(f"L008 {comm}\n")
-        logging.info(f"[Arduino]: RGBW Light: {comm}")
-        self.rgbw_ring[light] = [red, green, blue, white]
+
+        def on_done():
+            logging.info(f"[Arduino]: RGBW Light: {comm}")
+            self.rgbw_ring[light] = [red, green, blue, white]
+
+        return self.run_command(f"L008 {comm}\n", on_done, wait)
@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import serial
+import logging
+import threading
+import serial.tools.list_ports
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import termios
+except ImportError:  # not a POSIX system
+    termios = None
+
+SERIAL_SPEED = 115200
+DEVICES = ("printer", "arduino")
+HANDSHAKE = b"M117 Server booting... \r\n"
+PROBE_TIMEOUT = 4  # s for a port that may be booting
+VERIFY_TIMEOUT = 1.5  # s for a cached port to answer
+
+
+def hold_dtr(ser):
+    # Linux raises DTR when a port is opened, which resets the boards, and
+    # drops it on close while HUPCL is set. Clearing HUPCL leaves DTR up when
+    # the server exits, so the next open doesn't pulse it. The first open
+    # after the adapter is plugged in still resets the board. DTR is left
+    # high: lowering it would make every later open raise it again
+    if termios is None:
+        return
+    attrs = termios.tcgetattr(ser.fileno())
+    attrs[2] &= ~termios.HUPCL
+    termios.tcsetattr(ser.fileno(), termios.TCSANOW, attrs)
+
+
+class DeviceManager:
+    # Finds which ttyUSB port is the printer and which the Arduino and keeps
+    # track of their initialisation, so the server can answer while the stage
+    # is still homing. Ports are opened without resetting the boards once the
+    # first open set them up (hold_dtr), every candidate is probed at the same
+    # time and the port -> device mapping is cached by USB serial number.
+    # Cached ports only get a quick handshake and are probed again if they
+    # don't answer as expected.
+    __instance__ = None
+
+    def __init__(self, cache_path="./config/devices.json"):
+        if DeviceManager.__instance__ is None:
+            self.cache_path = cache_path
+            self.lock = threading.Lock()
+            self.state = {device: "waiting" for device in DEVICES}
+            self.ports = {device: None for device in DEVICES}
+            self.elapsed_s = {device: None for device in DEVICES}
+            self.started_at = time.time()
+            self.thread = None
+            DeviceManager.__instance__ = self
+        else:
+            raise Exception("DeviceManager is a singleton")
+
+    @staticmethod
+    def get_instance():
+        if not DeviceManager.__instance__:
+            DeviceManager()
+        return DeviceManager.__instance__
+
+    def start(self, init_device):
+        # init_device(device, port, ser, lines) runs for each device found,
+        # in the background and in parallel. lines are what the board sent
+        # during the probe
+        self.started_at = time.time()
+        self.thread = threading.Thread(
+            target=self._init_devices, args=(init_device,), daemon=True
+        )
+        self.thread.start()
+
+    def set_state(self, device, state):
+        with self.lock:
+            self.state[device] = state
+            if state in ("ready", "not found", "error"):
+                self.elapsed_s[device] = round(time.time() - self.started_at, 2)
+        logging.info(f"[\033[92mINITCOM\033[0m] {device}: {state}")
+
+    def is_ready(self, device=None):
+        devices = DEVICES if device is None else (device,)
+        return all(self.state[device] == "ready" for device in devices)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "ready": self.is_ready(),
+                "devices": {
+                    device: {
+                        "state": self.state[device],
+                        "port": self.ports[device],
+                        "elapsed_s": self.elapsed_s[device],
+                    }
+                    for device in DEVICES
+                },
+            }
+
+    @staticmethod
+    def port_key(port):
+        # cheap CH340 clones have no serial number, the USB path is stable
+        return port.serial_number or port.location or port.hwid
+
+    def load_cache(self):
+        try:
+            with open(self.cache_path) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def save_cache(self, cache):
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, "w") as cache_file:
+            json.dump(cache, cache_file, indent=4)
+        os.replace(tmp_path, self.cache_path)
+
+    @staticmethod
+    def open_port(candidate):
+        ser = serial.Serial()
+        ser.port = candidate
+        ser.baudrate = SERIAL_SPEED
+        ser.timeout = 0.5
+        ser.open()
+        hold_dtr(ser)
+        return ser
+
+    @staticmethod
+    def handshake(ser, timeout):
+        # (device answering on ser or None, lines read). A booting board may
+        # miss the first command, it is sent again once the port goes quiet
+        deadline = time.time() + timeout
+        lines = []
+        ser.write(HANDSHAKE)
+        sent_again = False
+        marlin = False  # boot banner or echo lines seen
+        while time.time() < deadline:
+            response = ser.readline().decode(errors="replace").strip()
+            if not response:
+                if not sent_again:
+                    ser.write(HANDSHAKE)
+                    sent_again = True
+                continue
+            lines.append(response)
+            if response.startswith("ok"):
+                return "printer", lines
+            if response == "start" or response.startswith("echo:"):
+                marlin = True  # Marlin also says echo:Unknown command
+            elif "Unknown" in response:
+                return "arduino", lines
+        return ("printer" if marlin else None), lines
+
+    def probe(self, candidate, timeout=PROBE_TIMEOUT):
+        # returns (device, open serial, lines read) so the port isn't opened
+        # again and the printer can tell if it saw a boot banner. (None,
+        # None, []) if nothing known answers or the port can't be opened
+        logging.info(f"[\033[92mINITCOM\033[0m] Trying to connect to {candidate} ...")
+        ser = None
+        try:
+            ser = self.open_port(candidate)
+            device, lines = self.handshake(ser, timeout)
+        except (serial.SerialException, OSError) as e:
+            logging.warning(f"[\033[92mINITCOM\033[0m] {candidate} failed: {e}")
+            device = None
+        logging.info(f"[\033[92mINITCOM\033[0m] {candidate} is {device}")
+        if device is None:
+            if ser is not None:
+                ser.close()
+            return None, None, []
+        return device, ser, lines
+
+    def verify(self, candidate, device):
+        # quick handshake on a cached port, probed again if it isn't device
+        found, ser, lines = self.probe(candidate, VERIFY_TIMEOUT)
+        if found == device:
+            return found, ser, lines
+        logging.info(f"[\033[92mINITCOM\033[0m] {candidate} is no longer {device}")
+        if ser is not None:
+            ser.close()
+        return self.probe(candidate)
+
+    def check_port(self, cache, port):
+        device = cache.get(self.port_key(port))
+        if device in DEVICES:
+            logging.info(f"[\033[92mINITCOM\033[0m] {device} cached at {port.name}")
+            return self.verify(f"/dev/{port.name}", device)
+        return self.probe(f"/dev/{port.name}")
+
+    def find_devices(self):
+        # {device: (port, open serial, lines read by the probe)}
+        cache = self.load_cache()
+        found = {}
+        ports = [
+            port
+            for port in serial.tools.list_ports.comports()
+            if "ttyUSB" in port.name[:-1]
+        ]
+        if not ports:
+            return found
+        with ThreadPoolExecutor(len(ports)) as pool:
+            results = pool.map(lambda port: self.check_port(cache, port), ports)
+            for port, (device, ser, lines) in zip(ports, results):
+                if device is None:
+                    cache.pop(self.port_key(port), None)
+                    continue
+                if device in found:
+                    ser.close()
+                    continue
+                found[device] = (f"/dev/{port.name}", ser, lines)
+                cache[self.port_key(port)] = device
+        self.save_cache(cache)
+        return found
+
+    def forget(self, port_name):
+        # a cached port failed, it will be probed on the next boot
+        cache = self.load_cache()
+        for port in serial.tools.list_ports.comports():
+            if f"/dev/{port.name}" == port_name:
+                cache.pop(self.port_key(port), None)
+        self.save_cache(cache)
+
+    def _init_device(self, init_device, device, port, ser, lines):
+        self.set_state(device, "initialising")
+        try:
+            init_device(device, port, ser, lines)
+            self.set_state(device, "ready")
+        except Exception as e:
+            logging.warning(f"[\033[92mINITCOM\033[0m] {device} failed: {e}")
+            self.forget(port)
+            self.set_state(device, "error")
+
+    def _init_devices(self, init_device):
+        for device in DEVICES:
+            self.set_state(device, "probing")
+        found = self.find_devices()
+        with ThreadPoolExecutor(len(DEVICES)) as pool:
+            for device in DEVICES:
+                if device not in found:
+                    logging.info(
+                        f"[\033[92mINITCOM\033[0m] {device} not found check connection"
+                    )
+                    self.set_state(device, "not found")
+                    continue
+                port, ser, lines = found[device]
+                self.ports[device] = port
+                pool.submit(self._init_device, init_device, device, port, ser, lines)
@@ -0,0 +1,132 @@
+import re
+import time
+import logging
+from communications.serial_worker import SerialWorker
+
+RESEND_REGEX = re.compile(r"(?:Resend:|rs)\s*N?(\d+)")
+# T:25.00 /0.00 B:24.80 /0.00 @:0 B@:0, alone or after an ok
+TEMPERATURE_REGEX = re.compile(r"\b([TB]\d?):(-?\d+\.?\d*)\s*/(-?\d+\.?\d*)")
+
+
+class GcodeError(Exception):
+    pass
+
+
+class GcodeSender(SerialWorker):
+    # Streams G-code to Marlin with line numbers and checksums so the planner
+    # buffer never runs dry. Up to `window` commands are in flight, every ok
+    # acknowledges the oldest one (Marlin answers in order) and frees a slot.
+    # Resend requests are served from the in flight lines, temperature
+    # reports and busy/echo messages are parsed without blocking anyone.
+    def __init__(self, ser, window=4, on_reset=None):
+        self.line_number = 0
+        self.resend_from = None
+        self.duplicate_resends = 0
+        self.skip_oks = 0
+        self.temperatures = {}  # heater: (current, target)
+        self.busy_since = None  # last "busy: processing" keepalive
+        self.on_reset = on_reset  # called when the firmware reboots
+        super().__init__(ser, "\033[94mGCODE\033[0m", window)
+        self.send("M110 N0", number=0)  # reset firmware line numbers
+
+    @staticmethod
+    def checksum(line):
+        checksum = 0
+        for byte in line.encode():
+            checksum ^= byte
+        return checksum
+
+    def encode(self, command):
+        # line numbers are given in write order
+        if command.number is None:
+            command.number = self.line_number + 1
+        self.line_number = command.number
+        line = f"N{command.number} {command.command.strip()}"
+        return f"{line}*{self.checksum(line)}\n".encode()
+
+    def handle_line(self, response):
+        stripped = response.strip()
+        resend = RESEND_REGEX.match(stripped)
+        if resend:
+            self._resend(int(resend.group(1)))
+        elif stripped.startswith("ok"):
+            self._parse_temperatures(stripped)
+            self._acknowledge(response)
+        elif "Error:Printer halted" in stripped:
+            logging.warning("\033[91mPRINTER HALTED")
+            self.fail_all(GcodeError(stripped))
+        elif stripped.startswith("Error:"):
+            logging.warning(f"[{self.name}] {stripped}")
+        elif stripped in ("start", "echo:start"):
+            self.handle_unsolicited(response)
+        elif stripped.startswith("T:") or stripped.startswith("echo:busy"):
+            self.handle_unsolicited(response)
+        else:
+            with self.lock:
+                command = self.in_flight[0] if self.in_flight else None
+                if command is not None:
+                    command.lines.append(response)
+            if command is None:
+                self.handle_unsolicited(response)
+
+    def handle_unsolicited(self, response):
+        stripped = response.strip()
+        if stripped.startswith("echo:busy"):
+            self.busy_since = time.time()
+        elif stripped.startswith("T:"):
+            self._parse_temperatures(stripped)
+        elif stripped in ("start", "echo:start"):
+            logging.warning(f"[{self.name}] Firmware restarted")
+            self.reset()
+        else:
+            logging.info(f"[{self.name}] {stripped}")
+
+    def reset(self):
+        # the firmware rebooted: what was in flight is lost and it counts
+        # lines from 0 again, waiting callers get a GcodeError
+        self.fail_all(GcodeError("firmware reset"))
+        with self.lock:
+            self.line_number = 0
+            self.resend_from = None
+            self.duplicate_resends = 0
+            self.skip_oks = 0
+        self.send("M110 N0", number=0)
+        if self.on_reset is not None:
+            self.on_reset()
+
+    def _parse_temperatures(self, line):
+        for heater, current, target in TEMPERATURE_REGEX.findall(line):
+            self.temperatures[heater] = (float(current), float(target))
+
+    def _acknowledge(self, response):
+        with self.lock:
+            if self.skip_oks:
+                # ok that follows a Resend request, the line wasn't executed
+                self.skip_oks -= 1
+                return
+            if not self.in_flight:
+                return
+            command = self.in_flight[0]
+            command.lines.append(response)
+            if command.number == self.resend_from:
+                self.resend_from = None
+        self.busy_since = None
+        self.complete()
+
+    def _resend(self, number):
+        # Marlin sends "Resend: N" + "ok" for the bad line and again for every
+        # line already sent after it, resend them only once
+        with self.lock:
+            self.skip_oks += 1
+            if self.resend_from == number and self.duplicate_resends > 0:
+                self.duplicate_resends -= 1
+                return
+            self.resend_from = number
+            pending = [
+                command for command in self.in_flight if command.number >= number
+            ]
+            self.duplicate_resends = len(pending) - 1
+            logging.info(f"[{self.name}] Resending from line {number}")
+            for command in pending:
+                command.lines = []
+                self.ser.write(command.line)
@@ -1,15 +1,26 @@
+import os
+import re
+import json
 import time
+import threading
 import serial
 import logging
+from communications.gcode_sender import GcodeSender
+from communications.device_manager import hold_dtr
 
 
 SERIAL_SPEED = 115200
+# M114 report: X:69.00 Y:104.00 Z:3.20 E:0.00 Count X:...
+POSITION_REGEX = re.compile(r"X:(-?\d+\.?\d*) Y:(-?\d+\.?\d*) Z:(-?\d+\.?\d*)")
+STATE_PATH = "./tmp/printer_state.json"
+POSITION_TOLERANCE = 0.01  # mm between the saved and the reported position
+INIT_TIMEOUT = 30  # s for each command while initialising, homing included
 
 
 class Printer:
     __instance__ = None
 
-    def __init__(self, serial_port):
+    def __init__(self, serial_port, ser=None, boot_lines=None):
         if Printer.__instance__ is None:
             self.xPos = 0.0
             self.yPos = 0.0
@@ -17,50 +28,219 @@ class Printer:
             self.zPos_focus = 0.0
             self.feedrate = 0
             self.lens = None
+            self.saved_lens = None  # magnification of the persisted state
+            self.did_home = False
             self.serial_port = serial_port
             self.mode = 0  # 0 absolute, 1 relative
-            self.ser = serial.Serial(self.serial_port, SERIAL_SPEED, timeout=8)
-            time.sleep(4)
-            self.home()
-            self.center()
+            self.state_lock = threading.Lock()
+            # held while a mode change and its move are queued
+            self.move_lock = threading.Lock()
+            # s to wait for each answer, None once initialised as long moves
+            # and M400 can take any time
+            self.timeout = INIT_TIMEOUT
+            if ser is None:
+                self.ser = self.open_serial()
+            else:
+                # opened without a reset by the port probe, which read
+                # boot_lines from it
+                self.ser = ser
+            firmware_reset = self.wait_boot(boot_lines or [])
+            self.ser.timeout = 8
+            self.ser.flushInput()  # boot messages
+            self.sender = GcodeSender(self.ser, window=4, on_reset=self.on_reset)
+            try:
+                # temperatures are then reported every 5s as unsolicited lines
+                self.queue_command("M155 S5\n")
+                if firmware_reset or not self.restore_state():
+                    self.home()
+                    self.center()
+            except Exception:
+                # no answer, the DeviceManager reports the error
+                self.sender.close()
+                self.ser.close()
+                raise
+            self.timeout = None
             Printer.__instance__ = self
         else:
             raise Exception("There's only one 3d Printer!!")
 
     @staticmethod
-    def get_instance(serial_port=None):
+    def get_instance(serial_port=None, ser=None, boot_lines=None):
         if not Printer.__instance__:
             if serial_port is not None:
-                Printer(serial_port)
+                Printer(serial_port, ser, boot_lines)
         return Printer.__instance__
 
+    def open_serial(self):
+        # a DTR pulse resets the board, which loses the position. hold_dtr
+        # keeps DTR up so a restarted server finds the firmware where it was
+        ser = serial.Serial()
+        ser.port = self.serial_port
+        ser.baudrate = SERIAL_SPEED
+        ser.open()
+        hold_dtr(ser)
+        return ser
+
+    def wait_boot(self, seen=(), timeout=4):
+        # True if the firmware (re)booted: it prints "start" on boot, a
+        # running firmware stays quiet. seen are lines already read from the
+        # port, by the probe
+        self.ser.timeout = 0.5
+        start_time = time.time()
+        quiet = 0
+        lines = list(seen)
+        while time.time() - start_time < timeout:
+            if lines:
+                line = lines.pop(0)
+            else:
+                line = self.ser.readline().decode(errors="replace").strip()
+            if line in ("start", "echo:start"):
+                logging.info("[\033[96mPRINTER\033[0m] Firmware booted")
+                time.sleep(1)  # config echo after start
+                return True
+            quiet = quiet + 1 if not line else 0
+            if quiet >= 3:
+                return False
+        return True  # still talking, assume it booted
+
+    def on_reset(self):
+        # the firmware rebooted on its own, its position is unknown and it
+        # starts in absolute mode
+        logging.warning("[\033[96mPRINTER\033[0m] Firmware reset, home needed")
+        with self.move_lock:
+            self.mode = 0
+        self.did_home = False
+        self.save_state()
+
+    def save_state(self):
+        # written after confirmed moves, replaced atomically so a crash
+        # never leaves a half written file
+        state = {
+            "xPos": self.xPos,
+            "yPos": self.yPos,
+            "zPos": self.zPos,
+            "zPos_focus": self.zPos_focus,
+            "feedrate": self.feedrate,
+            "lens": self.lens.magnification if self.lens is not None else None,
+            "did_home": self.did_home,
+        }
+        with self.state_lock:
+            os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
+            tmp_path = f"{STATE_PATH}.tmp"
+            with open(tmp_path, "w") as state_file:
+                json.dump(state, state_file)
+            os.replace(tmp_path, STATE_PATH)
+
+    def load_state(self):
+        try:
+            with open(STATE_PATH) as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return None
+
+    def restore_state(self):
+        # True if the saved state matches the firmware, homing is skipped
+        state = self.load_state()
+        if state is None or not state.get("did_home"):
+            return False
+        position = self.get_position()
+        saved = (state["xPos"], state["yPos"], state["zPos"])
+        if position is None or any(
+            abs(reported - stored) > POSITION_TOLERANCE
+            for reported, stored in zip(position, saved)
+        ):
+            logging.info(
+                f"[\033[96mPRINTER\033[0m] Saved position {saved} but at {position}"
+            )
+            return False
+        self.xPos, self.yPos, self.zPos = position
+        self.zPos_focus = state["zPos_focus"]
+        self.saved_lens = state["lens"]
+        self.did_home = True
+        # the firmware mode is unknown, force absolute
+        self.queue_command("G90\n")
+        self.mode = 0
+        self.set_feedrate(state["feedrate"])
+        logging.info(f"[\033[96mPRINTER\033[0m] State restored at {position}")
+        return True
+
     def send_command(self, comm):
+        return self.send_query(comm)[-1]
+
+    def send_query(self, comm):
+        # returns every line received for the command, its ok is the last one
         logging.info(f"[\033[96mPRINTER\033[0m] Sending com: {comm[:-1]}")
-        self.ser.flushInput()
-        self.ser.write(comm.encode())
-        response = self.ser.readline().decode()
-        while "ok" not in response or "start" not in response:
+        lines = self.sender.send(comm).result(self.timeout)
+        for response in lines:
             logging.info(f"[\033[94mPRINTER\033[0m] Response: {response[:-1]}")
+        return lines
 
-            if "start" in response or "ok" in response:
-                break
-            if "Error:Printer halted" in response:
-                logging.warning("\033[91mPRINTER ERROR QUITTING")
-                quit()
-            response = self.ser.readline().decode()
-        self.ser.flushInput()
-        return response
+    def queue_command(self, comm):
+        # non blocking, returns a Future with the response lines
+        logging.info(f"[\033[96mPRINTER\033[0m] Queueing com: {comm[:-1]}")
+        return self.sender.send(comm)
+
+    def run_command(self, comm, on_ok, wait=True, mode=None):
+        # on_ok updates the tracked state once the firmware accepted comm.
+        # The G90/G91 for mode and comm are queued together, another thread
+        # can't switch the mode between them. Returns the response line, or
+        # the Future when wait is False
+        with self.move_lock:
+            if mode is not None:
+                self.check_mode(mode)
+            future = self.queue_command(comm)
+        if wait:
+            response = future.result(self.timeout)[-1]
+            logging.info(f"[\033[94mPRINTER\033[0m] Response: {response[:-1]}")
+            if "ok\n" in response:
+                on_ok()
+                self.save_state()
+            return response
+
+        def done(future):
+            if future.exception() is None and "ok\n" in future.result()[-1]:
+                on_ok()
+                self.save_state()
+
+        future.add_done_callback(done)
+        return future
+
+    def send_commands(self, comms):
+        # streams the commands back to back, the firmware planner stays full
+        logging.info(f"[\033[96mPRINTER\033[0m] Streaming {len(comms)} commands")
+        return self.sender.send_all(comms, self.timeout)
+
+    def get_position(self):
+        # position reported by the firmware, None if M114 wasn't understood
+        for line in self.send_query("M114\n"):
+            match = POSITION_REGEX.search(line)
+            if match:
+                return tuple(float(value) for value in match.groups())
+        return None
+
+    def wait_for_moves(self):
+        # moves are non blocking, M400 is only acknowledged once the planner
+        # has executed every queued move. The tracked position is then synced
+        # with the firmware one
+        self.send_command("M400\n")
+        position = self.get_position()
+        if position is not None:
+            self.xPos, self.yPos, self.zPos = position
+            self.save_state()
+        return position
 
     def check_mode(self, desired_mode):
         # checks if the printer is in the correct mode and sends the correct gcode
+        # the mode change is only queued, commands are executed in order.
+        # Called with move_lock held
         if desired_mode != self.mode:
             if desired_mode == 0:
                 # change to absolute
-                self.send_command("G90\n")
+                self.queue_command("G90\n")
                 self.mode = 0
             else:
                 # change to relative
-                self.send_command("G91\n")
+                self.queue_command("G91\n")
                 self.mode = 1
 
     def print_display(self, text):
@@ -81,83 +261,168 @@ class Printer:
             self.yPos = 0
             self.zPos = 0
             self.did_home = True
+            self.save_state()
             logging.info(f"[\033[96mPRINTER\033[0m] Home ok")
         return response
 
-    def set_xPos(self, pos):
+    # moves and feedrate changes block until the firmware accepts them,
+    # with wait=False they return a Future and the state updates on the ok
+
+    def set_xPos(self, pos, wait=True):
         mess = f"G1 X{pos}\n"
-        self.check_mode(0)
-        response = self.send_command(mess)
-        if "ok\n" in response:
+
+        def on_ok():
             logging.info(f"[\033[96mPRINTER\033[0m] xAxis to pos: {pos}")
             self.xPos = pos
-        return response
 
-    def set_yPos(self, pos):
+        return self.run_command(mess, on_ok, wait, mode=0)
+
+    def set_yPos(self, pos, wait=True):
         mess = f"G1 Y{pos}\n"
-        self.check_mode(0)
-        response = self.send_command(mess)
-        if "ok\n" in response:
+
+        def on_ok():
             logging.info(f"[\033[96mPRINTER\033[0m] yAxis to pos: {pos}")
             self.yPos = pos
-        return response
 
-    def set_zPos(self, pos):
+        return self.run_command(mess, on_ok, wait, mode=0)
+
+    def set_zPos(self, pos, wait=True):
+        response = None
         if self.is_move_save(pos):
             mess = f"G1 Z{pos}\n"
-            self.check_mode(0)
-            response = self.send_command(mess)
-            if "ok\n" in response:
+
+            def on_ok():
                 logging.info(f"[\033[96mPRINTER\033[0m] zAxis to pos: {pos}")
                 self.zPos = pos
+
+            response = self.run_command(mess, on_ok, wait, mode=0)
         else:
             logging.warning("That was not save, not moving anywhere :(")
         return response
 
-    def set_feedrate(self, feedrate):
+    def set_feedrate(self, feedrate, wait=True):
         mess = f"G0 F{feedrate}\n"
-        response = self.send_command(mess)
-        if "ok\n" in response:
+
+        def on_ok():
             logging.info(f"[\033[96mPRINTER\033[0m] Feedrate changed to: {feedrate}")
             self.feedrate = feedrate
-        response
 
-    def move_xAxis(self, cor):
+        return self.run_command(mess, on_ok, wait)
+
+    def move_xAxis(self, cor, wait=True):
         mess = f"G0 X{cor}\n"
-        self.check_mode(1)
-        response = self.send_command(mess)
-        if "ok\n" in response:
+
+        def on_ok():
             logging.info(f"[\033[96mPRINTER\033[0m] xAxis cor: {cor}")
             self.xPos += cor
 
-    def move_yAxis(self, cor):
+        return self.run_command(mess, on_ok, wait, mode=1)
+
+    def move_yAxis(self, cor, wait=True):
         mess = f"G0 Y{cor}\n"
-        self.check_mode(1)
-        response = self.send_command(mess)
-        if "ok\n" in response:
+
+        def on_ok():
             logging.info(f"[\033[96mPRINTER\033[0m] yAxis cor: {cor}")
             self.yPos += cor
 
-    def move_zAxis(self, cor):
+        return self.run_command(mess, on_ok, wait, mode=1)
+
+    def move_zAxis(self, cor, wait=True):
+        response = None
         if self.is_move_save(self.zPos + cor):
             mess = f"G0 Z{cor}\n"
-            self.check_mode(1)
-            response = self.send_command(mess)
-            if "ok\n" in response:
+
+            def on_ok():
                 logging.info(f"[\033[96mPRINTER\033[0m] zAxis cor: {cor}")
                 self.zPos += cor
+
+            response = self.run_command(mess, on_ok, wait, mode=1)
         else:
             logging.warning("That move was not save :(")
+        return response
+
+    @staticmethod
+    def axes_command(code, x=None, y=None, z=None, feed=None):
+        # single G-code line for the given axes, None axes are left out
+        words = [code]
+        for axis, value in (("X", x), ("Y", y), ("Z", z), ("F", feed)):
+            if value is not None:
+                words.append(f"{axis}{round(value, 4)}")
+        return " ".join(words) + "\n"
+
+    def move_to(self, x=None, y=None, z=None, feed=None, wait=True):
+        # absolute coordinated move, every axis arrives at the same time.
+        # The feedrate given stays as the printer feedrate
+        if z is not None and not self.is_move_save(z):
+            logging.warning("That was not save, not moving anywhere :(")
+            return None
+        mess = self.axes_command("G1", x, y, z, feed)
+
+        def on_ok():
+            logging.info(f"[\033[96mPRINTER\033[0m] Move to: {mess[3:-1]}")
+            if x is not None:
+                self.xPos = x
+            if y is not None:
+                self.yPos = y
+            if z is not None:
+                self.zPos = z
+            if feed is not None:
+                self.feedrate = feed
+
+        return self.run_command(mess, on_ok, wait, mode=0)
+
+    def move_by(self, dx=None, dy=None, dz=None, feed=None, wait=True):
+        # relative coordinated move
+        if dz is not None and not self.is_move_save(self.zPos + dz):
+            logging.warning("That move was not save :(")
+            return None
+        mess = self.axes_command("G0", dx, dy, dz, feed)
+
+        def on_ok():
+            logging.info(f"[\033[96mPRINTER\033[0m] Move by: {mess[3:-1]}")
+            self.xPos += dx or 0
+            self.yPos += dy or 0
+            self.zPos += dz or 0
+            if feed is not None:
+                self.feedrate = feed
+
+        return self.run_command(mess, on_ok, wait, mode=1)
+
+    def move_path(self, waypoints, feed=None):
+        # streams absolute (x, y, z) waypoints back to back, None keeps an
+        # axis where it is. Returns once every line has been accepted
+        position = [self.xPos, self.yPos, self.zPos]
+        comms = []
+        for waypoint in waypoints:
+            x, y, z = waypoint
+            if z is not None and not self.is_move_save(z):
+                logging.warning(f"Waypoint {waypoint} not save, path not sent :(")
+                return None
+            comms.append(self.axes_command("G1", x, y, z, feed if not comms else None))
+            position = [
+                old if new is None else new for old, new in zip(position, waypoint)
+            ]
+        logging.info(f"[\033[96mPRINTER\033[0m] Streaming {len(comms)} commands")
+        with self.move_lock:
+            self.check_mode(0)
+            futures = [self.sender.send(comm) for comm in comms]
+        responses = [future.result(self.timeout) for future in futures]
+        if all("ok\n" in lines[-1] for lines in responses):
+            self.xPos, self.yPos, self.zPos = position
+            if feed is not None:
+                self.feedrate = feed
+            self.save_state()
+            logging.info(f"[\033[96mPRINTER\033[0m] Path of {len(comms)} moves ok")
+        return responses
 
     def center(self):
-        self.set_zPos(3)
-        self.set_feedrate(3000)
-        self.set_zPos(20)
-        self.set_yPos(104)
-        self.set_xPos(69)
-        self.set_zPos(3.2)
+        # streamed as one path, the position is read back at the end
+        self.move_path(
+            [(None, None, 3), (None, None, 20), (69, 104, None), (None, None, 3.2)],
+            feed=3000,
+        )
         self.set_feedrate(1000)
-        time.sleep(10)
+        self.wait_for_moves()
         logging.info("[\033[96mPRINTER\033[0m] Center OK")
 
     def change_lens(self):
@@ -0,0 +1,110 @@
+import queue
+import threading
+import logging
+from collections import deque
+from concurrent.futures import Future
+
+
+class InFlight:
+    def __init__(self, command, future, number=None):
+        self.command = command
+        self.future = future
+        self.number = number
+        self.line = None  # bytes actually written, kept for resends
+        self.lines = []  # responses received so far
+
+
+class SerialWorker:
+    # Owns a serial port so callers on different threads can't interleave
+    # bytes or steal each other's responses. A writer thread sends queued
+    # commands (at most `window` waiting for an answer) and a reader thread
+    # matches the answers to them in order and resolves their futures. Lines
+    # that don't answer any command go to handle_unsolicited.
+    def __init__(self, ser, name, window=1):
+        self.ser = ser
+        self.name = name
+        self.window = threading.Semaphore(window)
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.in_flight = deque()
+        self.running = True
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.reader = threading.Thread(target=self._read_loop, daemon=True)
+        self.writer.start()
+        self.reader.start()
+
+    def send(self, command, number=None):
+        # non blocking, returns a Future with the response lines
+        future = Future()
+        self.queue.put(InFlight(command, future, number))
+        return future
+
+    def send_all(self, commands, timeout=None):
+        # queues a sequence of commands and waits for all of them
+        futures = [self.send(command) for command in commands]
+        return [future.result(timeout) for future in futures]
+
+    def close(self):
+        self.running = False
+        self.queue.put(None)
+
+    def encode(self, command):
+        # bytes written for a command, subclasses add framing
+        return command.encode()
+
+    def _write_loop(self):
+        while self.running:
+            command = self.queue.get()
+            if command is None:
+                break
+            self.window.acquire()
+            with self.lock:
+                command.line = self.encode(command)
+                self.in_flight.append(command)
+                self.ser.write(command.line)
+
+    def _read_loop(self):
+        while self.running:
+            try:
+                response = self.ser.readline().decode(errors="replace")
+            except Exception as e:
+                if self.running:
+                    logging.warning(f"[{self.name}] Port lost: {e}")
+                break
+            if not response:
+                continue  # serial timeout
+            try:
+                self.handle_line(response)
+            except Exception as e:
+                logging.warning(f"[{self.name}] Bad line {response!r}: {e}")
+
+    def handle_line(self, response):
+        # by default every line answers the oldest command
+        with self.lock:
+            if not self.in_flight:
+                command = None
+            else:
+                command = self.in_flight[0]
+                command.lines.append(response)
+        if command is None:
+            self.handle_unsolicited(response)
+        else:
+            self.complete()
+
+    def handle_unsolicited(self, response):
+        logging.info(f"[{self.name}] {response.strip()}")
+
+    def complete(self):
+        # resolves the oldest command with the lines it got
+        with self.lock:
+            command = self.in_flight.popleft()
+        command.future.set_result(command.lines)
+        self.window.release()
+
+    def fail_all(self, error):
+        with self.lock:
+            pending = list(self.in_flight)
+            self.in_flight.clear()
+        for command in pending:
+            command.future.set_exception(error)
+            self.window.release()
@@ -16,7 +16,7 @@ def install():
     check_status(subprocess.run(args))
     args = ["sudo"] + ["apt"] + ["-y"] + ["install"] + ["hugin-tools"] + ["enblend"] + ["imagemagick"] + ["libopencv-dev"] + ["build-essential"] + ["python3-opencv"] + ["python3-tflite-runtime"]
     check_status(subprocess.run(args))
-    args = ["pip3"] + ["install"] + ["xystitch"] + ["picamerax"] + ["Flask"] + ["flask-restful"]
+    args = ["pip3"] + ["install"] + ["xystitch"] + ["picamerax"] + ["Flask"] + ["flask-restful"] + ["uvicorn"] + ["a2wsgi"]
     check_status(subprocess.run(args))
 
     args = ["sudo"] + ["cp"] + ["config.txt"] + ["/boot/config.txt"]
@@ -5,8 +5,10 @@ import os
 import sys
 import logging
 import argparse
-import serial
-import serial.tools.list_ports
+import threading
+from startup_timing import StartupTiming
+
+IMPORT_START = time.time()
 from flask import (
     Flask,
     render_template,
@@ -17,22 +19,40 @@ from flask import (
     send_file,
 )
 from flask_restful import Api
+
+# OpenCV, TFLite and the modules using them are imported by their routes (or
+# by warm_up) so the live feed doesn't wait for them
 from camerastreamer.camera_streamer import CameraStreamer
-from camerastreamer.focus_stack import FocusStack
-from camerastreamer.filter import Filter
-from camerastreamer.auto_focus import AutoFocus
-from camerastreamer.stitcher import Stitcher
 from camerastreamer.lens import LensFactory
+from camerastreamer.focus_metric import FocusMetric
+from camerastreamer.stream_client import StreamClients
+from camerastreamer.adaptive_quality import AdaptiveQuality
 from communications.printer_com import Printer
 from communications.arduino_com import Arduino
-from inference.inference import Inference
+from communications.device_manager import DeviceManager
 from api.camera_settings import CameraSettings, CameraAutoFocus
 from api.led import Leds
 from api.stepper_motors import Steppers, StepperHome, StepperCenter, StepperChangeLens
+from api.stream_clients import StreamClientsResource
+from api.status import Status
+from api.focus_cache import FocusCacheResource
 
+StartupTiming.get_instance().mark("imports", time.time() - IMPORT_START)
 
 API_ROOT = "/api/v1"
 DEFAULT_PORT = 5000
+DEFAULT_LENS = 20
+MOSAIC_MAX_AGE = 3600  # s browsers keep mosaic tiles without asking again
+# routes that need the printer and the Arduino, answered with 503 until both
+# are initialised
+DEVICE_ROUTES = (
+    f"{API_ROOT}/steppers",
+    f"{API_ROOT}/leds",
+    f"{API_ROOT}/camera/autofocus",
+    "/autofocus",
+    "/focusstackphoto.jpg",
+    "/stitch",
+)
 # os.chdir("/home/pi/Visilab/MicroHikari3D-Server")
 
 
@@ -56,6 +76,16 @@ _FLASK_APP_ = Flask(__name__.split(".")[0])
 _FLASK_API_ = Api(_FLASK_APP_)
 
 
+@_FLASK_APP_.before_request
+def check_devices():
+    needs_devices = request.path.startswith(DEVICE_ROUTES) or (
+        request.path == "/photo.jpg" and request.args.get("filter", "none") != "none"
+    )
+    manager = DeviceManager.get_instance()
+    if needs_devices and not manager.is_ready():
+        return jsonify(manager.to_dict()), 503
+
+
 @_FLASK_APP_.route("/")
 def index():
     # Video streaming home page.
@@ -63,19 +93,45 @@ def index():
     return render_template("pi_home.html")
 
 
-def gen(camera):
+def gen(camera, stream, address, max_fps):
     # Video streaming generator function.  For more on generator functions see Miguel Gringberg's beautiful post here:  https://blog.miguelgrinberg.com/post/video-streaming-with-flask
-    # Stream will remain open until the connection is closed
-    while True:
-        frame = camera.get_frame()
-        yield (b"--frame\r\n" b"Content-Type: image/jpeg\r\n\r\n" + frame + b"\r\n")
+    # Stream will remain open until the connection is closed. The yield blocks
+    # while the client socket is full, the next frame is then the newest one.
+    # The client is registered here, a response that is never iterated
+    # doesn't leave it behind
+    client = StreamClients.get_instance().add(stream, address, max_fps)
+    try:
+        AdaptiveQuality.get_instance().start()
+        while True:
+            time.sleep(client.wait_time())  # client fps limit
+            sequence, frame = camera.wait_frame(client.sequence, stream=client.stream)
+            if sequence == client.sequence:
+                # no new frame yet, the camera may be busy taking a photo
+                continue
+            write_start = time.time()
+            yield (b"--frame\r\n" b"Content-Type: image/jpeg\r\n\r\n" + frame + b"\r\n")
+            # resumed once the server has written the chunk to the socket
+            client.deliver(sequence, frame, write_start)
+            client.written(len(frame), time.time() - write_start)
+    finally:
+        StreamClients.get_instance().remove(client)
 
 
 @_FLASK_APP_.route("/video_feed.mjpeg", methods=["GET"])
 def video_feed():
     # Video streaming route. Put this in the src attribute of an img tag.
+    # ?res=high|low|thumb picks one of the simulcast streams, ?fps= limits
+    # the frame rate sent to this client
+    camera = CameraStreamer.get_instance()
+    stream = request.args.get("res", "high")
+    if stream not in camera.broadcasts:
+        return "Unknown stream", 400
+    try:
+        max_fps = float(request.args.get("fps", 0))
+    except ValueError:
+        return "Bad args", 400
     return Response(
-        gen(CameraStreamer.get_instance()),
+        gen(camera, stream, request.remote_addr, max_fps),
         mimetype="multipart/x-mixed-replace; boundary=frame",
     )
 
@@ -91,6 +147,8 @@ def photo():
         camera = CameraStreamer.get_instance()
         photo = camera.get_photo()
     else:
+        from camerastreamer.filter import Filter
+
         filter = Filter()
         photo = filter.filter(filter_option)
     if photo is None:
@@ -107,12 +165,22 @@ def focus_stack_photo():
         n_focus = int(args.get("nfocus", 3))
         step = float(args.get("step", 0.02))
         filter_option = args.get("filter", None)
+        # ?engine=external runs the focus-stack binary on JPEG samples
+        engine = args.get("engine", "native")
+        # ?save=1 keeps the samples and the result in ./tmp/fs
+        save = bool(int(args.get("save", 0)))
     except:
         return "Bad args", 400
     if filter_option is None or filter_option == "none":
-        focus_stack = FocusStack()
-        photo = focus_stack.get_focus_stack_img(n_focus,step)
+        from camerastreamer.focus_stack import FocusStack, ENGINES
+
+        if engine not in ENGINES:
+            return "Bad args", 400
+        focus_stack = FocusStack(engine)
+        photo = focus_stack.get_focus_stack_img(n_focus, step, save)
     else:
+        from camerastreamer.filter import Filter
+
         filter = Filter()
         photo = filter.filter_fs(filter_option, n_focus)
     if photo is None:
@@ -122,8 +190,24 @@ def focus_stack_photo():
 
 @_FLASK_APP_.route("/autofocus", methods=["GET"])
 def autofocus():
+    from camerastreamer.auto_focus import AutoFocus
+
     args = request.args
-    auto_focuser = AutoFocus()
+    # ?metric=&roi=&downsample= override the camera focus metric settings
+    try:
+        metric = CameraStreamer.get_instance().focus_metric.copy(
+            args.get("metric"),
+            float(args["roi"]) if "roi" in args else None,
+            int(args["downsample"]) if "downsample" in args else None,
+        )
+    except ValueError:
+        return "Bad args", 400
+    auto_focuser = AutoFocus(metric)
+    # ?search=hill uses the step by step fine focus, ?search=sweep continuous
+    # z moves
+    if args.get("search", "model") not in ["model", "hill", "sweep"]:
+        return "Bad args", 400
+    auto_focuser.search = args.get("search", "model")
     if "fine" in args:
         auto_focuser.auto_focus_fine()
     else:
@@ -133,6 +217,8 @@ def autofocus():
 
 @_FLASK_APP_.route("/inference", methods=["GET"])
 def inference():
+    from inference.inference import Inference
+
     args = request.args
     if "model" in args:
         model_name = args.get("model")
@@ -147,22 +233,39 @@ def inference():
 
 @_FLASK_APP_.route("/stitch", methods=["GET"])
 def stitch():
+    from camerastreamer.stitcher import Stitcher, BACKENDS, OUTPUTS
+
     args = request.args
     fov_x = 3
     fov_y = 3
     step_per_fov = 0.8
     focus_stack = False
     pattern = 0
+    focus_map = True
+    backend = "hugin"
     try:
         fov_x = int(args.get("fovx", 3))
         fov_y = int(args.get("fovy", 3))
         step_per_fov = float(args.get("step", 0.8))
         focus_stack = bool(args.get("focusstack", False))
         pattern = int(args.get("pattern", 0))
+        # ?focusmap=0 autofocuses every tile
+        focus_map = bool(int(args.get("focusmap", 1)))
+        # ?backend=native registers the tiles while capturing, it needs the
+        # lens fov_x calibrated. opencv stitches after the capture
+        backend = args.get("backend", "hugin")
+        # ?tiles=<capture folder> stitches a previous capture again
+        tiles = args.get("tiles")
+        # ?output=dzi answers with the DeepZoom mosaic served by /mosaic
+        output = args.get("output", "jpeg")
     except:
         return "BAD QUERY", 400
-    stitcher = Stitcher(fov_x, fov_y, step_per_fov)
-    if focus_stack == True:
+    if backend not in BACKENDS or output not in OUTPUTS:
+        return "BAD QUERY", 400
+    stitcher = Stitcher(fov_x, fov_y, step_per_fov, focus_map, backend, output)
+    if tiles is not None:
+        file_path = stitcher.restitch(os.path.basename(tiles))
+    elif focus_stack == True:
         print('FS-Stitch')
         file_path = stitcher.focus_stack_stitch(pattern)
     else:
@@ -170,9 +273,41 @@ def stitch():
 
     if file_path == "error":
         return "Server error", 500
+    if file_path.endswith(".dzi"):
+        # ./tmp/stitch/<capture folder>/single/out.dzi
+        name = os.path.basename(os.path.dirname(os.path.dirname(file_path)))
+        return jsonify({"name": name, "dzi": f"/mosaic/{name}/out.dzi"})
     return send_file(file_path, mimetype="image/JPEG")
 
 
+@_FLASK_APP_.route("/mosaic/<name>/out.dzi", methods=["GET"])
+def mosaic_descriptor(name):
+    # DeepZoom descriptor, OpenSeadragon loads the tiles next to it
+    return send_mosaic_file(name, "out.dzi", "application/xml")
+
+
+@_FLASK_APP_.route(
+    "/mosaic/<name>/out_files/<int:level>/<int:column>_<int:row>.jpg",
+    methods=["GET"],
+)
+def mosaic_tile(name, level, column, row):
+    return send_mosaic_file(name, f"out_files/{level}/{column}_{row}.jpg", "image/JPEG")
+
+
+def send_mosaic_file(name, path, mimetype):
+    # ETag from the file mtime and size, a stitched again mosaic gets new ones
+    file_path = os.path.abspath(
+        os.path.join("./tmp/stitch", os.path.basename(name), "single", path)
+    )
+    if not os.path.isfile(file_path):
+        return "Not found", 404
+    response = send_file(
+        file_path, mimetype=mimetype, max_age=MOSAIC_MAX_AGE, conditional=True
+    )
+    response.cache_control.public = True
+    return response
+
+
 def get_internet_ip():
     # hacky solution
     print()
@@ -181,43 +316,45 @@ def get_internet_ip():
     return s.getsockname()[0]
 
 
+def init_device(lens):
+    # called by the DeviceManager for each device found, in parallel
+    def init(device, port, ser, lines):
+        if device == "printer":
+            printer = Printer.get_instance(port, ser, lines)
+            printer.print_display(get_internet_ip())
+            lens_factory = LensFactory()
+            # the lens of the restored state unless one was given
+            magnification = lens if lens is not None else printer.saved_lens
+            printer.lens = lens_factory.create_lens(magnification or DEFAULT_LENS)
+        else:
+            Arduino.get_instance(port, ser)
+        StartupTiming.get_instance().mark(f"{device}_ready")
+
+    return init
+
+
 def init_communications(lens):
-    port_candidates = serial.tools.list_ports.comports()
-    printer_ok = False
-    arduino_ok = False
-    for port in port_candidates:
-        if "ttyUSB" in port.name[:-1]:
-            candidate = f"/dev/{port.name}"
-            logging.info(
-                f"[\033[92mINITCOM\033[0m] Trying to connect to {candidate} ..."
-            )
-            ser = serial.Serial(candidate, 115200, timeout=2)
-            time.sleep(2)
-            ser.write(b"M117 Server booting... \r\n")
-            response = ser.readline().decode()
-            logging.info(f"[\033[92mINITCOM\033[0m] Response: {response[:-1]}")
-            if "echo:start" in response or "ok" in response:
-                ser.close()
-                logging.info("[\033[92mINITCOM\033[0m] Printer Found")
-                printer = Printer.get_instance(candidate)
-                time.sleep(2)
-                printer.print_display(get_internet_ip())
-                lens_factory = LensFactory()
-                printer.lens = lens_factory.create_lens(lens)
-                logging.info("[\033[92mINITCOM\033[0m] Printer Ready")
-                printer_ok = True
-            if "Unknown" in response:
-                logging.info("[\033[92mINITCOM\033[0m] Arduino Found")
-                ser.close()
-                Arduino.get_instance(candidate)
-                logging.info("[\033[92mINITCOM\033[0m] Arduino Ready")
-                arduino_ok = True
-    if not arduino_ok:
-        logging.info("[\033[92mINITCOM\033[0m] Arduino not found check connection")
-        sys.exit()
-    if not printer_ok:
-        logging.info("[\033[92mINITCOM\033[0m] Printer not found check connection")
-        sys.exit()
+    # devices are probed and homed in the background, GET /api/v1/status
+    # tells when they are ready
+    DeviceManager.get_instance().start(init_device(lens))
+
+
+def warm_up():
+    # first frame ready before the first viewer connects, then the modules
+    # the other routes need are loaded in the background
+    timing = StartupTiming.get_instance()
+    CameraStreamer.get_instance().get_frame()
+    timing.mark("first_frame")
+    warm_up_start = time.time()
+    import cv2
+    import camerastreamer.stitcher
+    import camerastreamer.filter
+
+    try:
+        import inference.inference
+    except ImportError as e:
+        logging.warning(f"[STARTUP] Inference not available: {e}")
+    timing.mark("warm_up", time.time() - warm_up_start)
 
 
 # Setup Api Resource
@@ -228,13 +365,28 @@ _FLASK_API_.add_resource(StepperHome, f"{API_ROOT}/steppers/home")
 _FLASK_API_.add_resource(StepperCenter, f"{API_ROOT}/steppers/center")
 _FLASK_API_.add_resource(StepperChangeLens, f"{API_ROOT}/steppers/changelens")
 _FLASK_API_.add_resource(Leds, f"{API_ROOT}/leds")
+_FLASK_API_.add_resource(StreamClientsResource, f"{API_ROOT}/stream/clients")
+_FLASK_API_.add_resource(Status, f"{API_ROOT}/status")
+_FLASK_API_.add_resource(FocusCacheResource, f"{API_ROOT}/camera/focuscache")
 
 
 if __name__ == "__main__":
     # Arguments
     parser = argparse.ArgumentParser(description="MicroHikari3D Server")
     parser.add_argument(
-        "-l", "--lens", action="store", type=float, help="default Lens", default=20
+        "-l", "--lens", action="store", type=float, help="default Lens", default=None
+    )
+    parser.add_argument(
+        "--asgi",
+        action="store_true",
+        help="serve with uvicorn, stream viewers run as coroutines",
+    )
+    parser.add_argument(
+        "--workers",
+        action="store",
+        type=int,
+        help="threads for the REST routes in asgi mode",
+        default=10,
     )
     args = parser.parse_args()
     lens = args.lens
@@ -243,6 +395,12 @@ if __name__ == "__main__":
         format="%(asctime)s %(message)s", stream=sys.stdout, level=logging.INFO
     )
     init_communications(lens)
-    _FLASK_APP_.run(host="0.0.0.0", port=DEFAULT_PORT, debug=False, threaded=True)
+    threading.Thread(target=warm_up, daemon=True).start()
+    if args.asgi:
+        import asgi_server
+
+        asgi_server.run(_FLASK_APP_, "0.0.0.0", DEFAULT_PORT, args.workers)
+    else:
+        _FLASK_APP_.run(host="0.0.0.0", port=DEFAULT_PORT, debug=False, threaded=True)
 
     # _FLASK_APP_.run(host='0.0.0.0', port=DEFAULT_PORT, debug=True,threaded=True, ssl_context=('ssl/cert.pem', 'ssl/key.pem'))
@@ -0,0 +1,36 @@
+import time
+import logging
+import threading
+
+
+class StartupTiming:
+    # Seconds taken by each startup step (imports, device init, first frame,
+    # warm up), reported in the log and by GET /api/v1/status
+    __instance__ = None
+
+    def __init__(self):
+        if StartupTiming.__instance__ is None:
+            self.start_time = time.time()
+            self.steps = {}
+            self.lock = threading.Lock()
+            StartupTiming.__instance__ = self
+        else:
+            raise Exception("StartupTiming is a singleton")
+
+    @staticmethod
+    def get_instance():
+        if not StartupTiming.__instance__:
+            StartupTiming()
+        return StartupTiming.__instance__
+
+    def mark(self, step, seconds=None):
+        # duration of a step, or time since the server started if None
+        if seconds is None:
+            seconds = time.time() - self.start_time
+        with self.lock:
+            self.steps[step] = round(seconds, 3)
+        logging.info(f"[STARTUP] {step}: {seconds:.2f} s")
+
+    def to_dict(self):
+        with self.lock:
+            return dict(self.steps)
@@ -0,0 +1,89 @@
+#!/usr/bin/env/python3
+
+import os
+import sys
+import tempfile
+import unittest
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camerastreamer.deep_zoom import DeepZoom
+
+
+class TestDeepZoom(unittest.TestCase):
+    """DeepZoom pyramid on synthetic images, no camera needed"""
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        self.image = rng.integers(0, 255, (301, 517, 3), dtype=np.uint8)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_levels(self):
+        self.assertEqual(DeepZoom.levels(1, 1), 1)
+        self.assertEqual(DeepZoom.levels(256, 100), 9)
+        self.assertEqual(DeepZoom.levels(257, 100), 10)
+
+    def test_half(self):
+        half = DeepZoom.half(self.image)
+        # odd sizes round up, the last row and column average with themselves
+        self.assertEqual(half.shape, (151, 259, 3))
+        block = self.image[:2, :2].reshape(-1, 3).astype(np.float64).mean(axis=0)
+        self.assertLessEqual(np.abs(half[0, 0] - block).max(), 0.5)
+        self.assertLessEqual(
+            np.abs(half[-1, -1].astype(int) - self.image[-1, -1]).max(), 1
+        )
+        self.assertEqual(DeepZoom.half(self.image[:1, :1]).shape, (1, 1, 3))
+
+    def test_half_strips(self):
+        # memory mapped in strips, the same as resizing it at once even with
+        # an odd number of rows
+        scratch_path = f"{self.folder.name}/half.raw"
+        half = DeepZoom.half(self.image, scratch_path, strip_height=16)
+        self.assertIsInstance(half, np.memmap)
+        expected = DeepZoom.half(self.image)
+        self.assertEqual(half.shape, expected.shape)
+        self.assertTrue(np.array_equal(half, expected))
+
+    def test_save(self):
+        dzi_path = f"{self.folder.name}/out.dzi"
+        deep_zoom = DeepZoom(tile_size=128, overlap=1)
+        self.assertEqual(deep_zoom.save(self.image, dzi_path), dzi_path)
+        with open(dzi_path) as f:
+            descriptor = f.read()
+        self.assertIn('TileSize="128"', descriptor)
+        self.assertIn('Width="517" Height="301"', descriptor)
+        files_path = f"{self.folder.name}/out_files"
+        levels = DeepZoom.levels(517, 301)
+        self.assertEqual(len(os.listdir(files_path)), levels)
+        # full size level, 5x3 tiles with the overlap on inner borders
+        last = f"{files_path}/{levels - 1}"
+        self.assertEqual(len(os.listdir(last)), 15)
+        self.assertEqual(cv2.imread(f"{last}/0_0.jpg").shape, (129, 129, 3))
+        self.assertEqual(cv2.imread(f"{last}/1_1.jpg").shape, (130, 130, 3))
+        self.assertEqual(cv2.imread(f"{last}/4_2.jpg").shape, (46, 6, 3))
+        self.assertEqual(cv2.imread(f"{files_path}/0/0_0.jpg").shape, (1, 1, 3))
+
+    def test_save_memmap(self):
+        # a mosaic larger than memory_mb is halved on disk, the scratch
+        # levels are removed afterwards
+        mosaic_path = f"{self.folder.name}/mosaic.raw"
+        mosaic = np.memmap(
+            mosaic_path, dtype=np.uint8, mode="w+", shape=self.image.shape
+        )
+        mosaic[:] = self.image
+        dzi_path = f"{self.folder.name}/out.dzi"
+        DeepZoom(memory_mb=0).save(mosaic, dzi_path)
+        self.assertEqual(
+            [name for name in os.listdir(self.folder.name) if name.endswith(".raw")],
+            ["mosaic.raw"],
+        )
+        levels = DeepZoom.levels(517, 301)
+        self.assertTrue(os.path.exists(f"{self.folder.name}/out_files/{levels - 2}"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env/python3
+
+import unittest
+import json
+import requests
+
+SERVER_ADDRESS = "http://localhost:5000"
+SERVER_API_URI = f"{SERVER_ADDRESS}/api/v1"
+
+
+class TestFocusCache(unittest.TestCase):
+    def change_value(self, choices, value_str):
+        try:
+            for new_value in choices:
+                new_data = {f"{value_str}": new_value}
+                result = requests.put(
+                    f"{SERVER_API_URI}/camera/focuscache", json=new_data
+                )
+                self.assertEqual(result.status_code, 200)
+                result = json.loads(result.content)
+                self.assertEqual(new_data[value_str], result[value_str])
+        except Exception as error:
+            raise error
+
+    """Focus cache test"""
+
+    def test_list_entries(self):
+        result = requests.get(f"{SERVER_API_URI}/camera/focuscache")
+        self.assertEqual(result.status_code, 200)
+        result = json.loads(result.content)
+        self.assertIsInstance(result["entries"], list)
+
+    def test_clear(self):
+        result = requests.delete(f"{SERVER_API_URI}/camera/focuscache")
+        self.assertEqual(result.status_code, 200)
+        result = json.loads(result.content)
+        self.assertEqual(result["entries"], [])
+
+    def test_change_tolerance(self):
+        self.change_value([0.1, 0.5, 0.2], "tolerance")
+
+    def test_change_max_drift(self):
+        self.change_value([1.0, 2.0], "max_drift")
+
+    def test_bad_value_tolerance(self):
+        new_data = {"tolerance": -1}
+        result = requests.put(f"{SERVER_API_URI}/camera/focuscache", json=new_data)
+        self.assertEqual(result.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env/python3
+
+import os
+import sys
+import unittest
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camerastreamer.focus_fusion import FocusFusion
+
+
+def stack(shifts=((0, 0), (0, 0), (0, 0)), size=(600, 400)):
+    # a sharp sample and slices that are each in focus on one third of the
+    # rows, moved by shifts (x, y) px as the stage drifts
+    width, height = size
+    rng = np.random.default_rng(0)
+    sample = cv2.resize(
+        rng.integers(0, 255, (height // 4, width // 4, 3), dtype=np.uint8),
+        size,
+        interpolation=cv2.INTER_CUBIC,
+    )
+    blurred = cv2.GaussianBlur(sample, (0, 0), 4)
+    slices = []
+    for i, (shift_x, shift_y) in enumerate(shifts):
+        image = blurred.copy()
+        rows = slice(i * height // 3, (i + 1) * height // 3)
+        image[rows] = sample[rows]
+        matrix = np.float32([[1, 0, shift_x], [0, 1, shift_y]])
+        slices.append(
+            cv2.warpAffine(image, matrix, size, borderMode=cv2.BORDER_REFLECT)
+        )
+    return sample, blurred, slices
+
+
+def error(image, sample, border=40):
+    difference = image.astype(int) - sample.astype(int)
+    return np.abs(difference[border:-border, border:-border]).mean()
+
+
+class TestFocusFusion(unittest.TestCase):
+    """Focus stacking on synthetic slices, no camera needed"""
+
+    def test_fuse(self):
+        sample, blurred, slices = stack()
+        fused = FocusFusion(align=False).fuse(slices)
+        self.assertEqual(fused.shape, sample.shape)
+        self.assertEqual(fused.dtype, np.uint8)
+        # much closer to the sharp sample than any slice
+        self.assertLess(error(fused, sample), error(blurred, sample) / 3)
+        for image in slices:
+            self.assertLess(error(fused, sample), error(image, sample) / 2)
+
+    def test_bands(self):
+        # fusing in bands gives the image fused at once
+        sample, blurred, slices = stack()
+        whole = FocusFusion(align=False, band_height=448).fuse(slices)
+        bands = FocusFusion(align=False, band_height=64).fuse(slices)
+        self.assertLessEqual(np.abs(whole.astype(int) - bands).max(), 3)
+
+    def test_align(self):
+        sample, blurred, slices = stack(((0, 0), (6, -4), (-5, 3)))
+        fusion = FocusFusion()
+        shifts = [fusion.shift(image) for image in slices]
+        self.assertIsNone(shifts[0])
+        for (shift_x, shift_y), expected in zip(shifts[1:], [(6, -4), (-5, 3)]):
+            self.assertAlmostEqual(shift_x, expected[0], delta=1)
+            self.assertAlmostEqual(shift_y, expected[1], delta=1)
+        aligned = FocusFusion().fuse(slices)
+        unaligned = FocusFusion(align=False).fuse(slices)
+        self.assertLess(error(aligned, sample), error(unaligned, sample))
+        self.assertLess(error(aligned, sample), error(blurred, sample) / 2)
+
+    def test_single_slice(self):
+        sample, blurred, slices = stack()
+        fused = FocusFusion().fuse(slices[:1])
+        self.assertLessEqual(np.abs(fused.astype(int) - slices[0]).max(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
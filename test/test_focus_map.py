@@ -0,0 +1,108 @@
+#!/usr/bin/env/python3
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camerastreamer.focus_map import FocusMap
+
+
+class FakePrinter:
+    def __init__(self):
+        self.xPos = 0
+        self.yPos = 0
+        self.zPos = 0
+
+    def move_to(self, x=None, y=None):
+        self.xPos = x
+        self.yPos = y
+
+    def set_zPos(self, z):
+        self.zPos = z
+
+
+class FakeAutoFocus:
+    """Sample surface z = surface(x, y), the focus value drops away from it.
+    Positions in blank are featureless, never sharp"""
+
+    def __init__(self, surface, blank=()):
+        self.printer = FakePrinter()
+        self.surface = surface
+        self.blank = set(blank)
+        self.searches = 0
+
+    def measure(self):
+        position = (self.printer.xPos, self.printer.yPos)
+        if position in self.blank:
+            return 5.0
+        error = abs(self.printer.zPos - self.surface(*position))
+        return 100.0 / (1 + 100 * error)
+
+    def auto_focus_fine(self):
+        self.searches += 1
+        self.printer.set_zPos(
+            round(self.surface(self.printer.xPos, self.printer.yPos), 4)
+        )
+        return self.printer.zPos, self.measure()
+
+
+class TestFocusMap(unittest.TestCase):
+    """Focus map on a synthetic tilted sample, no printer needed"""
+
+    def test_anchor_positions(self):
+        self.assertIsNone(FocusMap.anchor_positions((0, 1), (0, 1), (2, 2)))
+        self.assertEqual(len(FocusMap.anchor_positions((0, 4), (0, 4), (3, 3))), 5)
+        grid = FocusMap.anchor_positions((0, 10), (0, 10), (6, 6))
+        self.assertEqual(len(grid), 9)
+        # serpentine, the second row goes back
+        self.assertEqual(grid[3], (10.0, 5.0))
+
+    def test_plane(self):
+        autofocus = FakeAutoFocus(lambda x, y: 2.5 + 0.01 * x - 0.02 * y)
+        focus_map = FocusMap(autofocus)
+        self.assertTrue(focus_map.build((0, 4), (0, 4), (4, 4)))
+        self.assertEqual(len(focus_map.coefficients), 3)
+        self.assertAlmostEqual(focus_map.predict(3, 1), 2.51, places=4)
+        # tiles on the plane need no autofocus
+        searches = autofocus.searches
+        autofocus.printer.move_to(x=3, y=1)
+        z, value = focus_map.focus_tile(3, 1)
+        self.assertAlmostEqual(z, 2.51, places=4)
+        self.assertEqual(autofocus.searches, searches)
+        self.assertEqual(focus_map.refinements, 0)
+
+    def test_quadratic(self):
+        surface = lambda x, y: 2.5 + 0.001 * x * x + 0.002 * x * y
+        focus_map = FocusMap(FakeAutoFocus(surface))
+        focus_map.build((0, 10), (0, 10), (6, 6))
+        self.assertEqual(len(focus_map.coefficients), 6)
+        self.assertAlmostEqual(focus_map.predict(7, 3), surface(7, 3), places=4)
+
+    def test_refinement(self):
+        # a bump the plane doesn't model is refined and becomes an anchor
+        surface = lambda x, y: 2.5 + (0.05 if (x, y) == (1, 3) else 0)
+        autofocus = FakeAutoFocus(surface)
+        focus_map = FocusMap(autofocus)
+        focus_map.build((0, 4), (0, 4), (4, 4))
+        anchors = len(focus_map.anchors)
+        autofocus.printer.move_to(x=1, y=3)
+        z, value = focus_map.focus_tile(1, 3)
+        self.assertAlmostEqual(z, 2.55, places=4)
+        self.assertEqual(focus_map.refinements, 1)
+        self.assertEqual(len(focus_map.anchors), anchors + 1)
+
+    def test_blank_tile(self):
+        # a featureless tile is refined but doesn't bend the surface
+        autofocus = FakeAutoFocus(lambda x, y: 2.5, blank=[(2, 2)])
+        focus_map = FocusMap(autofocus)
+        focus_map.build((0, 4), (0, 4), (4, 4))
+        anchors = len(focus_map.anchors)
+        autofocus.printer.move_to(x=2, y=2)
+        focus_map.focus_tile(2, 2)
+        self.assertEqual(focus_map.refinements, 1)
+        self.assertEqual(len(focus_map.anchors), anchors)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env/python3
+
+import os
+import sys
+import math
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camerastreamer.focus_search import FocusSearch, fit_peak
+
+
+def sharpness(peak, width=0.03):
+    # gaussian focus curve over a small background, like a laplacian
+    # variance through a focus sweep
+    def measure_at(z):
+        return 1000 * math.exp(-((z - peak) ** 2) / (2 * width**2)) + 10
+
+    return measure_at
+
+
+class TestFocusSearch(unittest.TestCase):
+    """Focus search on synthetic focus curves, no printer needed"""
+
+    def test_fit_peak(self):
+        zs = [0.9, 1.0, 1.1]
+        values = [math.exp(-((z - 1.02) ** 2) / 0.02) for z in zs]
+        self.assertAlmostEqual(fit_peak(zs, values, "gaussian"), 1.02, places=6)
+        self.assertAlmostEqual(fit_peak([0, 1, 2], [1, 2, 1], "parabola"), 1)
+        # a valley has no peak
+        self.assertIsNone(fit_peak([0, 1, 2], [2, 1, 2], "parabola"))
+
+    def test_peak_near_start(self):
+        search = FocusSearch(sharpness(2.512))
+        z, value = search.search(2.5)
+        self.assertAlmostEqual(z, 2.512, delta=search.tolerance)
+        self.assertLessEqual(len(search.samples), search.max_evaluations)
+        self.assertTrue(search.converged)
+
+    def test_peak_far_from_start(self):
+        # the bracket has to grow towards the peak
+        search = FocusSearch(sharpness(2.7), model="parabola")
+        z, value = search.search(2.5)
+        self.assertAlmostEqual(z, 2.7, delta=2 * search.tolerance)
+
+    def test_limits(self):
+        # the peak is beyond the travel, the search stops at the limit
+        search = FocusSearch(sharpness(-0.1), limits=(0, 10))
+        z, value = search.search(0.05)
+        self.assertEqual(z, 0)
+        self.assertTrue(all(0 <= z <= 10 for z in search.samples))
+        self.assertFalse(search.converged)
+
+    def test_budget(self):
+        # a flat curve never brackets, the search gives up on budget
+        search = FocusSearch(lambda z: 5.0, max_evaluations=6)
+        search.search(2.5)
+        self.assertLessEqual(len(search.samples), 6)
+        self.assertFalse(search.converged)
+
+    def test_not_converged(self):
+        # bracketed, but the budget runs out before the peak is narrowed
+        # down. The best sample is returned but not reported as the peak
+        search = FocusSearch(sharpness(2.5, width=0.3), step=0.5, max_evaluations=4)
+        search.search(2.4)
+        self.assertLessEqual(len(search.samples), 4)
+        self.assertFalse(search.converged)
+        search = FocusSearch(sharpness(2.5, width=0.3), step=0.05)
+        search.search(2.4)
+        self.assertTrue(search.converged)
+
+    def test_bad_model(self):
+        with self.assertRaises(ValueError):
+            FocusSearch(sharpness(1), model="cubic")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env/python3
+
+import os
+import sys
+import time
+import queue
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from communications.gcode_sender import GcodeSender, GcodeError
+
+
+class FakeMarlin:
+    """Serial port answering like Marlin: checks line numbers and checksums,
+    corrupts the lines listed in corrupt once and reboots on M997"""
+
+    def __init__(self, corrupt=()):
+        self.corrupt = set(corrupt)
+        self.last = 0
+        self.executed = []
+        self.booting = False
+        self.input = queue.Queue()
+        self.output = queue.Queue()
+        self.timeout = 0.2
+        threading.Thread(target=self.firmware, daemon=True).start()
+
+    def write(self, line):
+        self.input.put(line.decode())
+
+    def readline(self):
+        try:
+            return self.output.get(timeout=self.timeout).encode()
+        except queue.Empty:
+            return b""
+
+    def resend(self, error):
+        self.output.put(f"Error:{error}, Last Line: {self.last}\n")
+        self.output.put(f"Resend: {self.last + 1}\n")
+        self.output.put("ok\n")
+
+    def firmware(self):
+        while True:
+            line = self.input.get().strip()
+            if self.booting:
+                continue  # lost while rebooting
+            body, checksum = line.rsplit("*", 1)
+            number = int(body.split()[0][1:])
+            command = body.split(" ", 1)[1]
+            if command in self.corrupt:
+                self.corrupt.remove(command)
+                checksum = -1
+            if command.startswith("M110"):
+                self.last = 0
+                self.output.put("ok\n")
+            elif int(checksum) != GcodeSender.checksum(body):
+                self.resend("checksum mismatch")
+            elif number != self.last + 1:
+                self.resend("Line Number is not Last Line Number+1")
+            elif command == "M997":
+                threading.Thread(target=self.reboot, daemon=True).start()
+            else:
+                self.last = number
+                self.executed.append(command)
+                self.output.put("ok\n")
+
+    def reboot(self):
+        self.booting = True
+        time.sleep(0.3)
+        self.last = 0
+        self.booting = False
+        self.output.put("start\n")
+
+
+class TestGcodeSender(unittest.TestCase):
+    """G-code streaming test with a fake Marlin, no printer needed"""
+
+    def test_checksum(self):
+        self.assertEqual(GcodeSender.checksum("N1 G28"), 18)
+        sender = GcodeSender(FakeMarlin())
+        self.assertEqual(sender.send("G28").result(timeout=5), ["ok\n"])
+        sender.close()
+
+    def test_resend(self):
+        commands = [f"G0 X{i}" for i in range(10)]
+        # a corrupted line in the middle of a full window
+        ser = FakeMarlin(corrupt=["G0 X3", "G0 X7"])
+        sender = GcodeSender(ser, window=4)
+        responses = sender.send_all(commands, timeout=5)
+        self.assertEqual(responses, [["ok\n"]] * len(commands))
+        # every line executed once and in order
+        self.assertEqual(ser.executed, commands)
+        sender.close()
+
+    def test_temperatures(self):
+        sender = GcodeSender(FakeMarlin())
+        sender.handle_line("T:205.10 /210.00 B:24.80 /0.00 @:0 B@:0\n")
+        self.assertEqual(sender.temperatures["T"], (205.1, 210.0))
+        self.assertEqual(sender.temperatures["B"], (24.8, 0.0))
+        sender.close()
+
+    def test_firmware_reset(self):
+        resets = []
+        ser = FakeMarlin()
+        sender = GcodeSender(ser, window=4, on_reset=lambda: resets.append(1))
+        self.assertEqual(sender.send_all(["G0 X1", "G0 X2"], timeout=5)[-1], ["ok\n"])
+        lost = sender.send("M997")
+        with self.assertRaises(GcodeError):
+            lost.result(timeout=5)
+        self.assertEqual(resets, [1])
+        # the line numbers start over after the reboot
+        responses = sender.send_all(["G0 X3", "G0 X4"], timeout=5)
+        self.assertEqual(responses, [["ok\n"], ["ok\n"]])
+        self.assertEqual(ser.executed, ["G0 X1", "G0 X2", "G0 X3", "G0 X4"])
+        sender.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env/python3
+
+import unittest
+import json
+import requests
+
+SERVER_ADDRESS = "http://localhost:5000"
+
+
+class TestMosaic(unittest.TestCase):
+    """DeepZoom mosaic test"""
+
+    def test_stitch_dzi(self):
+        result = requests.get(
+            f"{SERVER_ADDRESS}/stitch",
+            params={"fovx": 2, "fovy": 2, "output": "dzi"},
+        )
+        self.assertEqual(result.status_code, 200)
+        result = json.loads(result.content)
+        result = requests.get(f"{SERVER_ADDRESS}{result['dzi']}")
+        self.assertEqual(result.status_code, 200)
+        self.assertIn("TileSize", result.text)
+
+    def test_tile_caching(self):
+        mosaic = json.loads(
+            requests.get(
+                f"{SERVER_ADDRESS}/stitch",
+                params={"fovx": 2, "fovy": 2, "output": "dzi"},
+            ).content
+        )
+        tile_url = f"{SERVER_ADDRESS}/mosaic/{mosaic['name']}/out_files/0/0_0.jpg"
+        result = requests.get(tile_url)
+        self.assertEqual(result.status_code, 200)
+        self.assertIn("max-age", result.headers["Cache-Control"])
+        result = requests.get(
+            tile_url, headers={"If-None-Match": result.headers["ETag"]}
+        )
+        self.assertEqual(result.status_code, 304)
+
+    def test_missing_tile(self):
+        result = requests.get(f"{SERVER_ADDRESS}/mosaic/missing/out_files/0/0_0.jpg")
+        self.assertEqual(result.status_code, 404)
+
+    def test_bad_output(self):
+        # /stitch answers 503 before looking at the query until the printer
+        # and the Arduino are ready
+        status = json.loads(requests.get(f"{SERVER_ADDRESS}/api/v1/status").content)
+        if not status["ready"]:
+            self.skipTest("devices not ready")
+        result = requests.get(f"{SERVER_ADDRESS}/stitch", params={"output": "png"})
+        self.assertEqual(result.status_code, 400)
+        result = requests.get(f"{SERVER_ADDRESS}/stitch", params={"backend": "gimp"})
+        self.assertEqual(result.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
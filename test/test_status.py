@@ -0,0 +1,35 @@
+#!/usr/bin/env/python3
+
+import unittest
+import json
+import requests
+
+SERVER_ADDRESS = "http://localhost:5000"
+SERVER_API_URI = f"{SERVER_ADDRESS}/api/v1"
+
+
+class TestStatus(unittest.TestCase):
+    """Status test"""
+
+    def test_status(self):
+        result = requests.get(f"{SERVER_API_URI}/status")
+        self.assertEqual(result.status_code, 200)
+        result = json.loads(result.content)
+        self.assertIn("ready", result)
+        for device in ["printer", "arduino"]:
+            self.assertIn(
+                result["devices"][device]["state"],
+                ["waiting", "probing", "initialising", "ready", "not found", "error"],
+            )
+
+    def test_device_routes_wait_for_devices(self):
+        status = json.loads(requests.get(f"{SERVER_API_URI}/status").content)
+        result = requests.get(f"{SERVER_API_URI}/steppers")
+        if status["ready"]:
+            self.assertEqual(result.status_code, 200)
+        else:
+            self.assertEqual(result.status_code, 503)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env/python3
+
+import os
+import sys
+import tempfile
+import unittest
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camerastreamer.stitch_pipeline import StitchPipeline, reset_peak_rss, peak_rss_mb
+
+PX_PER_MM = 100
+TILE = 400  # px, fov_x of 4 mm
+
+
+def texture(seed=0, size=2000):
+    # smooth random sample, phase correlation needs structure at the
+    # downsampled scale
+    rng = np.random.default_rng(seed)
+    noise = rng.integers(0, 255, (size, size, 3), dtype=np.uint8).astype(np.float32)
+    blurred = cv2.GaussianBlur(noise, (0, 0), 4)
+    return cv2.normalize(blurred, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+
+class TestStitchPipeline(unittest.TestCase):
+    """Tile registration and placement on a synthetic sample"""
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.sample = texture()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def scan(self, pipeline, jitter, orientation=("x", "-y")):
+        # 3x3 grid, 3 mm x 2 mm steps. jitter is the px the stage missed
+        # each tile by. Returns the true mosaic px of every tile
+        truth = {}
+        for column in range(3):
+            for row in range(3):
+                stage = {"x": column * 3.0, "y": -row * 2.0}
+                px = []
+                for axis in orientation:
+                    sign = -1 if axis.startswith("-") else 1
+                    px.append(int(sign * stage[axis[-1]] * PX_PER_MM) + 700)
+                x = px[0] + jitter[(column, row)][0]
+                y = px[1] + jitter[(column, row)][1]
+                truth[(column, row)] = (x, y)
+                pipeline.add(
+                    column,
+                    row,
+                    f"{self.folder.name}/c{column:04d}_r{row:04d}.tif",
+                    np.ascontiguousarray(self.sample[y : y + TILE, x : x + TILE]),
+                    (stage["x"], stage["y"]),
+                )
+        pipeline.queue.put(None)
+        pipeline.worker.join()
+        return truth
+
+    @staticmethod
+    def jitter(seed=1):
+        rng = np.random.default_rng(seed)
+        return {(c, r): rng.integers(-20, 21, 2) for c in range(3) for r in range(3)}
+
+    def assertPlaced(self, pipeline, truth, delta):
+        # the stage positions alone miss by up to 20 px, the pairs measure
+        # within a downsampled px and a tile is two pairs from the corner
+        x0 = min(x for x, y in truth.values())
+        y0 = min(y for x, y in truth.values())
+        for tile, (x, y) in truth.items():
+            self.assertAlmostEqual(pipeline.positions[tile][0], x - x0, delta=delta)
+            self.assertAlmostEqual(pipeline.positions[tile][1], y - y0, delta=delta)
+
+    def test_register_pair(self):
+        pipeline = StitchPipeline((3.0, 2.0), 4.0)
+        jitter = self.jitter()
+        truth = self.scan(pipeline, jitter)
+        self.assertEqual(len(pipeline.pairs), 12)
+        for a, b, (dx, dy), trusted in pipeline.pairs:
+            self.assertTrue(trusted)
+            # within one downsampled px
+            self.assertAlmostEqual(dx, truth[b][0] - truth[a][0], delta=4)
+            self.assertAlmostEqual(dy, truth[b][1] - truth[a][1], delta=4)
+
+    def test_solve(self):
+        pipeline = StitchPipeline((3.0, 2.0), 4.0)
+        truth = self.scan(pipeline, self.jitter())
+        pipeline.solve()
+        self.assertPlaced(pipeline, truth, 8)
+
+    def test_orientation(self):
+        # camera rotated 90 degrees, grid neighbours overlap along other axes
+        orientation = ("-y", "x")
+        pipeline = StitchPipeline((3.0, 2.0), 4.0, orientation)
+        truth = self.scan(pipeline, self.jitter(), orientation)
+        # a pair the stage missed by a lot may not register, its
+        # neighbours place the tile anyway
+        self.assertGreaterEqual(sum(pair[3] for pair in pipeline.pairs), 10)
+        pipeline.solve()
+        self.assertPlaced(pipeline, truth, 8)
+
+    def test_wrong_fov(self):
+        # with a far too small fov_x the strips don't overlap, the pairs
+        # fall back to the stage positions
+        pipeline = StitchPipeline((3.0, 2.0), 1.0)
+        self.scan(pipeline, self.jitter())
+        self.assertFalse(any(pair[3] for pair in pipeline.pairs))
+
+    def test_finish(self):
+        pipeline = StitchPipeline((3.0, 2.0), 4.0, memory_mb=4)
+        truth = self.scan(pipeline, self.jitter())
+        output_path = f"{self.folder.name}/out.png"
+        self.assertEqual(pipeline.finish(output_path), output_path)
+        mosaic = cv2.imread(output_path, 1)
+        x0 = min(x for x, y in truth.values())
+        y0 = min(y for x, y in truth.values())
+        expected = self.sample[y0 : y0 + mosaic.shape[0], x0 : x0 + mosaic.shape[1]]
+        self.assertLess(np.abs(mosaic.astype(int) - expected).mean(), 20)
+        # the decoded tiles and the canvas are removed
+        leftovers = [
+            name
+            for name in os.listdir(self.folder.name)
+            if name.endswith((".npy", ".canvas"))
+        ]
+        self.assertEqual(leftovers, [])
+
+    @unittest.skipUnless(reset_peak_rss(), "needs /proc/self/clear_refs")
+    def test_peak_rss(self):
+        # the peak restarts from the current RSS, not the process lifetime
+        peak = np.ones(64 * 1024 * 1024 // 8)
+        del peak
+        lifetime = peak_rss_mb()
+        self.assertTrue(reset_peak_rss())
+        before = peak_rss_mb()
+        self.assertLess(before, lifetime - 48)
+        peak = np.ones(32 * 1024 * 1024 // 8)
+        self.assertGreater(peak_rss_mb(), before + 24)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env/python3
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camerastreamer.stream_client import StreamClient, StreamClients
+
+
+class TestStreamClient(unittest.TestCase):
+    """Stream viewer bookkeeping, no server needed"""
+
+    def test_deliver(self):
+        client = StreamClient(1, "low", "127.0.0.1", 5)
+        sent_at = time.time()
+        client.deliver(1, b"x" * 100, sent_at)
+        client.deliver(4, b"x" * 50, sent_at)
+        self.assertEqual(client.sequence, 4)
+        self.assertEqual(client.delivered, 2)
+        self.assertEqual(client.dropped, 2)
+        self.assertEqual(client.bytes_sent, 150)
+        # the fps limit counts from when the write started
+        self.assertAlmostEqual(client.next_frame_time, sent_at + 1 / 5)
+        self.assertLessEqual(client.wait_time(), 1 / 5)
+
+    def test_written(self):
+        client = StreamClient(1, "high", "127.0.0.1", 15)
+        client.written(1000, 0.01)
+        # no rate until a window has passed
+        self.assertIsNone(client.link_rate)
+        client.window_start -= client.rate_window
+        client.written(3000, 0.01)
+        self.assertAlmostEqual(client.link_rate, 4000 / 0.02)
+        self.assertEqual(client.window_bytes, 0)
+
+    def test_to_dict(self):
+        client = StreamClient(7, "thumb", "10.0.0.2", 10)
+        client.deliver(1, b"frame", time.time())
+        result = client.to_dict()
+        self.assertEqual(result["id"], 7)
+        self.assertEqual(result["stream"], "thumb")
+        self.assertIsNone(result["link_kbps"])
+        self.assertEqual(result["delivered"], 1)
+        self.assertEqual(result["bytes_sent"], 5)
+
+    def test_clients(self):
+        clients = StreamClients.get_instance()
+        client = clients.add("low", "127.0.0.1", 100)
+        # fps capped to the limit, the default when not given
+        self.assertEqual(client.max_fps, clients.max_fps_limit)
+        self.assertEqual(clients.add("low", None).max_fps, clients.default_max_fps)
+        self.assertIn(client, clients.get_clients())
+        clients.remove(client)
+        self.assertNotIn(client, clients.get_clients())
+        self.assertIsInstance(clients.to_list(), list)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env/python3
+
+import unittest
+import json
+import requests
+
+SERVER_ADDRESS = "http://localhost:5000"
+SERVER_API_URI = f"{SERVER_ADDRESS}/api/v1"
+
+
+class TestStreamClients(unittest.TestCase):
+    def change_value(self, choices, value_str):
+        try:
+            for new_value in choices:
+                new_data = {f"{value_str}": new_value}
+                result = requests.put(f"{SERVER_API_URI}/stream/clients", json=new_data)
+                self.assertEqual(result.status_code, 200)
+                result = json.loads(result.content)
+                self.assertEqual(new_data[value_str], result[value_str])
+        except Exception as error:
+            raise error
+
+    """Stream clients test"""
+
+    def test_list_clients(self):
+        result = requests.get(f"{SERVER_API_URI}/stream/clients")
+        self.assertEqual(result.status_code, 200)
+        result = json.loads(result.content)
+        self.assertIsInstance(result["clients"], list)
+
+    def test_client_counters(self):
+        stream = requests.get(
+            f"{SERVER_ADDRESS}/video_feed.mjpeg?res=low&fps=5", stream=True
+        )
+        try:
+            self.assertEqual(stream.status_code, 200)
+            next(stream.iter_content(1024))
+            result = requests.get(f"{SERVER_API_URI}/stream/clients")
+            clients = json.loads(result.content)["clients"]
+            client = [c for c in clients if c["stream"] == "low"][0]
+            self.assertEqual(client["max_fps"], 5)
+            self.assertGreaterEqual(client["delivered"], 1)
+            self.assertGreaterEqual(client["dropped"], 0)
+        finally:
+            stream.close()
+
+    def test_default_max_fps(self):
+        choices = [5, 15, 30]
+        self.change_value(choices, "default_max_fps")
+
+    def test_adaptive_quality(self):
+        new_data = {"adaptive": True, "min_quality": 30, "max_quality": 80}
+        result = requests.put(f"{SERVER_API_URI}/stream/clients", json=new_data)
+        self.assertEqual(result.status_code, 200)
+        result = json.loads(result.content)
+        self.assertEqual(result["adaptive"]["min_quality"], 30)
+        self.assertEqual(result["adaptive"]["max_quality"], 80)
+
+    """Test not accepted values"""
+
+    def change_bad_value(self, choices, value_str):
+        try:
+            for new_value in choices:
+                new_data = {f"{value_str}": new_value}
+                result = requests.put(f"{SERVER_API_URI}/stream/clients", json=new_data)
+                self.assertEqual(result.status_code, 400)
+        except Exception as error:
+            raise error
+
+    def test_bad_default_max_fps(self):
+        choices = [0, -5, 100, "test"]
+        self.change_bad_value(choices, "default_max_fps")
+
+    def test_bad_quality_limits(self):
+        new_data = {"min_quality": 90, "max_quality": 50}
+        result = requests.put(f"{SERVER_API_URI}/stream/clients", json=new_data)
+        self.assertEqual(result.status_code, 400)
+
+    def test_bad_stream(self):
+        result = requests.get(f"{SERVER_ADDRESS}/video_feed.mjpeg?res=huge")
+        self.assertEqual(result.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()